@@ -1,22 +1,185 @@
 import datetime
+import hashlib
 import json
+import sqlite3 as sql
 
 from flask import Flask, jsonify, render_template, request
 from flask_caching import Cache
 
-from channel_distribution import ChannelDistribution
-from scan_summary import ScanSummary
-from track_channel import TrackChannels
+import db
+import figures
+import graphs
+import jobs
+import metrics
+from db import data_version, migrate
+from warmer import warmer
 
 config = {
-    "CACHE_TYPE": "simple",
-    "CACHE_DEFAULT_TIMEOUT": 300
+    # Shared by every worker on the host, entries are keyed by data version
+    "CACHE_TYPE": "sqlite_cache.sqlite",
+    "CACHE_SQLITE_PATH": "cache.db",
+    "CACHE_THRESHOLD": 2000, # entries
+    "CACHE_MAX_SIZE": 512 * 1024 * 1024, # bytes
+    "CACHE_DEFAULT_TIMEOUT": 86400, # backstop for antenna & mapping edits
+    "WARMER_INTERVAL": 30, # seconds between checks for new scans
+    # Graph computations run in a process pool (see jobs.py)
+    "JOB_WORKERS": 2,
+    "JOB_QUEUE_SIZE": 8, # jobs waiting for a worker before requests get 429
+    "JOB_TIMEOUT": 30, # seconds before requests get 504
+    # Journal mode monitor.db is switched to at startup (None leaves it, "WAL" lets reads
+    # and the scanner's writes run concurrently) & milliseconds reads wait on its locks
+    "DB_JOURNAL_MODE": None,
+    "DB_BUSY_TIMEOUT": 5000,
+    # Seconds before a request's sampled stacks are dumped to PROFILE_DIR (None disables sampling)
+    "PROFILE_SLOW_REQUESTS": None,
+    "PROFILE_DIR": "profiles"
 }
 
 app = Flask("flask_app")
 app.config.from_mapping(config)
 cache = Cache(app)
 
+db.journal_mode = app.config["DB_JOURNAL_MODE"]
+db.busy_timeout = app.config["DB_BUSY_TIMEOUT"]
+
+# Job pool workers import this module as __mp_main__ (python app.py) and skip its side effects
+pool_worker = __name__ == "__mp_main__"
+
+# Create any missing index the graph queries rely on (idempotent)
+if not pool_worker:
+    migrate()
+
+jobs.workers = app.config["JOB_WORKERS"]
+jobs.queue_size = app.config["JOB_QUEUE_SIZE"]
+jobs.timeout = app.config["JOB_TIMEOUT"]
+metrics.profile_threshold = app.config["PROFILE_SLOW_REQUESTS"]
+metrics.profile_dir = app.config["PROFILE_DIR"]
+
+# Precompute figures in the background whenever new scans land
+# (and load the metadata store & channel distribution cubes after startup)
+warmer.interval = app.config["WARMER_INTERVAL"]
+
+if not pool_worker:
+    warmer.start(app)
+
+@app.before_request
+def start_warmer():
+    # Forked workers (i.e. gunicorn --preload) start their own thread
+    warmer.start(app)
+
+@app.before_request
+def start_timing():
+    metrics.begin()
+
+@app.after_request
+def server_timing(response):
+    response.headers["Server-Timing"] = metrics.end(request.endpoint, response.status_code)
+    return response
+
+@app.teardown_request
+def end_timing(error):
+    # Requests that raised skip after_request (end is a no-op otherwise)
+    metrics.end(request.endpoint, 500)
+
+def versioned_key():
+    """Cache key of the request (path & sorted query string) at the current data version
+
+    New scans change the version, so cached responses are never stale and
+    entries of older versions age out of the LRU cache.
+    """
+    args = str(sorted(request.args.items(multi=True))).encode()
+    return f"view{request.path}?{hashlib.md5(args).hexdigest()}{'&bdata' if binary() else ''}@{data_version()}"
+
+def scan_key():
+    """Cache key of a scan api request by the scan its scantime resolves to
+
+    Pages send the current time, so keys by scantime would never repeat.
+    """
+    # Imported on first use like the graph modules (see graphs.py)
+    from scan_summary import nearest_scan
+
+    antenna = request.args.get("antenna", None, type=int)
+    scan = nearest_scan(request.args.get("scantime", None, type=int), antenna) if antenna is not None else None
+    return f"view{request.path}?antenna={antenna}&scan={scan}{'&bdata' if binary() else ''}@{data_version()}"
+
+def time_arg(name):
+    """Local (GMT-04:00) datetime request arg (i.e. 2020-07-01 00:00:00), None when not given
+
+    @return time - naive pandas Timestamp (times with a timezone are converted to local time)
+    @raise InvalidRequest - when the arg isn't a datetime
+    """
+    value = request.args.get(name, None, type=str)
+
+    if value is None:
+        return None
+
+    # Imported on first use like the graph modules (see graphs.py)
+    import pandas as pd
+
+    try:
+        time = pd.Timestamp(value)
+    except ValueError:
+        time = pd.NaT
+
+    if time is pd.NaT:
+        raise InvalidRequest(f"{name} must be a datetime (i.e. 2020-07-01 00:00:00)")
+
+    if time.tzinfo is not None:
+        time = time.tz_convert("Etc/GMT+4").tz_localize(None)
+
+    return time
+
+def binary():
+    """Whether numeric arrays are sent as typed arrays (format=bdata, or Accept preferring figures.bdata_mimetype)
+    """
+    if "format" in request.args:
+        return request.args["format"] == "bdata"
+
+    return request.accept_mimetypes.best_match(["application/json", figures.bdata_mimetype]) == figures.bdata_mimetype
+
+def figure_response(body, binary):
+    response = app.response_class(body, mimetype=figures.bdata_mimetype if binary else "application/json")
+    response.vary.add("Accept")
+    return response
+
+def json_response(obj):
+    """Response with a JSON body holding figures (serialized in one pass, see figures.dumps)
+    """
+    return figure_response(figures.dumps(obj, binary()), binary())
+
+def job_response(job, **kwargs):
+    """Response with the JSON body computed by a job in the process pool (see jobs.run)
+    """
+    return figure_response(jobs.run(job, binary=binary(), **kwargs), binary())
+
+class InvalidRequest(Exception):
+    """Raised by views for request args they can't serve
+    """
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+@app.errorhandler(InvalidRequest)
+def invalid_request(error):
+    return jsonify(error=str(error)), error.status
+
+@app.errorhandler(jobs.Busy)
+def busy(error):
+    # Raised before the view returns, so nothing is cached
+    return jsonify(error="Too many graph requests, try again shortly"), 429, {"Retry-After": "5"}
+
+@app.errorhandler(jobs.TimedOut)
+def timed_out(error):
+    return jsonify(error="The graph took too long to compute"), 504
+
+@app.errorhandler(sql.OperationalError)
+def database_locked(error):
+    # The scanner held monitor.db longer than DB_BUSY_TIMEOUT (other errors stay 500s)
+    if "locked" not in str(error) and "busy" not in str(error):
+        raise error
+
+    return jsonify(error="The database is busy, try again shortly"), 503, {"Retry-After": "5"}
+
 @app.route("/")
 @app.route("/home")
 @app.route("/home/")
@@ -33,88 +196,161 @@ def help_page():
 def apis():
     return render_template("api.html", title="API")
 
+@app.route("/metrics")
+def prometheus_metrics():
+    # Metrics of this worker process only
+    return app.response_class(metrics.exposition(), mimetype="text/plain; version=0.0.4")
+
 # ---- Graphing Programs ----
 
 # Track Channel
 @app.route("/graphs/trackchannel")
 @app.route("/graphs/trackchannel/")
-@cache.cached(timeout=3600)
+@cache.cached(make_cache_key=versioned_key)
 def track_channel():
-    graph = TrackChannels()
-    return render_template(
-        "trackChannel.html",
-        title="Track Channel",
-        antennaMap=json.dumps(graph.antenna_map),
-        defaultAntenna=graph.default_antenna
-        )
+    with graphs.track_channels() as graph:
+        return render_template(
+            "trackChannel.html",
+            title="Track Channel",
+            antennaMap=json.dumps(graph.antenna_map),
+            defaultAntenna=graph.default_antenna
+            )
 
 @app.route("/graphs/trackchannel/api")
-@cache.cached(timeout=3600, query_string=True)
+@app.route("/graphs/trackchannel/viewportapi")
+@cache.cached(make_cache_key=versioned_key)
 def track_channel_api():
+    # Only the defaults are read here, the figure is computed by a job
+    with graphs.track_channels() as graph:
+        antenna = request.args.get("antenna", graph.default_antenna, type=int)
+
+    # Downsampling (full resolution unless a point budget or pixel width is given)
+    points = request.args.get("points", None, type=int)
+    width = request.args.get("width", None, type=int)
+    method = request.args.get("downsample", "lttb", type=str)
+
+    if (points is not None and points <= 0) or (width is not None and width <= 0):
+        raise InvalidRequest("points and width must be positive")
+
+    if points is None and width is not None:
+        # lttb keeps one point per pixel, minmax two (the min and max)
+        points = 2 * width if method == "minmax" else width
+
+    if points is not None:
+        # The first, last and at least one selected point
+        points = max(points, 3)
+
+    # Viewport (visible time range)
+    start = time_arg("start")
+    end = time_arg("end")
+
+    # Trace selection (all measurements and channels by default)
+    measurements = request.args.getlist("measurement", type=str)
+    channels = request.args.getlist("channels", type=int)
+
+    # Delta update: only scans after the version (scan_instance) a polling page already plotted
+    since = request.args.get("since", None, type=int)
+
+    return job_response(jobs.track_channel, antenna=antenna, points=points, method=method, start=start, end=end, 
+                        measurements=measurements, channels=channels, since=since)
+
+@app.route("/graphs/trackchannel/export")
+def track_channel_export():
+    # Streamed chunk by chunk (not cached, the body is never held in memory)
+    # by a graph of its own, as the stream outlives the view
+    from track_channel import TrackChannels
+
     graph = TrackChannels()
     antenna = request.args.get("antenna", graph.default_antenna, type=int)
-    return jsonify(figure=graph.get_json(antenna=antenna), labels=json.dumps(graph.labels), annotations=graph.mdf["annotations"].tolist())
+    format = request.args.get("format", "ndjson", type=str)
+    # Parsed before the stream starts, so bad times get a 400 rather than a truncated body
+    start = time_arg("start")
+    end = time_arg("end")
+    measurements = request.args.getlist("measurement", type=str)
+    channels = request.args.getlist("channels", type=int)
+
+    if format not in ("ndjson", "csv"):
+        return jsonify(error="format must be ndjson or csv"), 400
+
+    chunks = graph.export(antenna=antenna, format=format, start=start, end=end,
+                          measurements=measurements, channels=channels)
+
+    if format == "csv":
+        return app.response_class(chunks, mimetype="text/csv",
+                                  headers={"Content-Disposition": f"attachment; filename=antenna{antenna}.csv"})
+
+    return app.response_class(chunks, mimetype="application/x-ndjson")
 
 
 # Scan Summary
 @app.route("/graphs/scansummary")
 @app.route("/graphs/scansummary/")
-@cache.cached(timeout=3600)
+@cache.cached(make_cache_key=versioned_key)
 def scan_summary():
-    graph = ScanSummary()
-    return render_template(
-        "scanSummary.html",
-        title="Scan Summary",
-        figure=graph.get_json(antenna=graph.default_antenna),
-        antennaMap=json.dumps(graph.antenna_map),
-        defaultAntenna=graph.default_antenna
-        )
+    with graphs.scan_summary() as graph:
+        return render_template(
+            "scanSummary.html",
+            title="Scan Summary",
+            figure=graph.get_json(antenna=graph.default_antenna),
+            antennaMap=json.dumps(graph.antenna_map),
+            defaultAntenna=graph.default_antenna
+            )
 
 @app.route("/graphs/scansummary/scanapi")
-@cache.cached(timeout=3600, query_string=True)
+@cache.cached(make_cache_key=scan_key)
 def scan_summary_scan_api():
-    graph = ScanSummary()
     scan = request.args.get("scantime", datetime.datetime.now(), type=int)
     antenna = request.args.get("antenna", None, type=int)
-    return jsonify(figure=graph.get_json(scantime=scan, antenna=antenna), scantime=graph.start_time)
+
+    with graphs.scan_summary() as graph:
+        figure = graph.get_figure(scantime=scan, antenna=antenna)
+        return json_response({"figure": figure, "scantime": graph.start_time})
 
 @app.route("/graphs/scansummary/antennaapi")
-@cache.cached(timeout=3600, query_string=True)
+@cache.cached(make_cache_key=versioned_key)
 def scan_summary_antenna_api():
-    graph = ScanSummary()
-    antenna = request.args.get("antenna", graph.default_antenna, type=int)
-    return jsonify(range=graph.get_antenna_range(antenna=antenna))
+    with graphs.scan_summary() as graph:
+        antenna = request.args.get("antenna", graph.default_antenna, type=int)
+        return jsonify(range=graph.get_antenna_range(antenna=antenna))
+
+@app.route("/graphs/scansummary/timelineapi")
+@cache.cached(make_cache_key=versioned_key)
+def scan_summary_timeline_api():
+    with graphs.scan_summary() as graph:
+        antenna = request.args.get("antenna", graph.default_antenna, type=int)
+        return json_response({"timeline": graph.get_timeline(antenna=antenna)})
 
 # Channel Distribution
 @app.route("/graphs/channeldistribution")
 @app.route("/graphs/channeldistribution/")
-@cache.cached(timeout=3600)
+@cache.cached(make_cache_key=versioned_key)
 def channel_distribution():
-    graph = ChannelDistribution()
-    return render_template(
-        "channelDistribution.html",
-        title="Channel Distribution",
-        figure=graph.get_json(channel=graph.default_channel, antenna=graph.default_antenna),
-        defaultChannel=graph.default_channel,
-        defaultAntenna=graph.default_antenna,
-        legendTitle=graph.channel_label,
-        channelMap=json.dumps(graph.labels),
-        antennaMap=json.dumps(graph.antenna_map),
-        weatherMap=json.dumps(graph.weather_map)
-        )
+    with graphs.channel_distribution() as graph:
+        return render_template(
+            "channelDistribution.html",
+            title="Channel Distribution",
+            figure=graph.get_json(channel=graph.default_channel, antenna=graph.default_antenna),
+            defaultChannel=graph.default_channel,
+            defaultAntenna=graph.default_antenna,
+            legendTitle=graph.channel_label,
+            channelMap=json.dumps(graph.labels),
+            antennaMap=json.dumps(graph.antenna_map),
+            weatherMap=json.dumps(graph.weather_map)
+            )
 
-@app.route("/graphs/channeldistribution/channelapi")
-@cache.cached(timeout=3600, query_string=True)
-def channel_distribution_channel_api():
-    graph = ChannelDistribution()
-    
-    # Request Args
-    channel = request.args.get("channel", graph.default_channel, type=int)
+def distribution_antenna(graph):
+    """Antenna of a channel distribution request
+    """
     antenna = request.args.get("antenna", graph.default_antenna, type=int)
-    model = request.args.get("model", "kde", type=str)
-    histnorm = request.args.get("histnorm", "", type=str)
 
-    # Filter Conditions
+    if antenna not in graph.antenna_map:
+        raise InvalidRequest(f"Unknown antenna {antenna}", 404)
+
+    return antenna
+
+def distribution_filters(graph):
+    """Filter conditions of a channel distribution request
+    """
     filter_conditions = {}
     inversetod = request.args.get("inversetod", type=bool)
 
@@ -126,35 +362,89 @@ def channel_distribution_channel_api():
     humidity = request.args.getlist("humidity", type=int)
     weatherstatus = request.args.get("weatherstatus", type=str)
 
+    for name, condition in zip(["tod", "daterange", "temp", "windspeed", "winddirection", "humidity"],
+                               [tod, daterange, temp, windspeed, winddirection, humidity]):
+        if len(condition) not in (0, 2):
+            raise InvalidRequest(f"{name} takes a start and an end (use the parameter twice)")
+
+    if any(hour < 0 or hour > 24 for hour in tod):
+        raise InvalidRequest("tod hours must be between 0 and 24")
+
+    if inversetod and not tod:
+        raise InvalidRequest("inversetod needs tod hours")
+
     for condition, label in zip([tod, daterange, temp, windspeed, winddirection, humidity, weatherstatus], graph.filter_col_labels):
         filter_conditions[label] = condition 
 
     # Convert Hours to Seconds
     filter_conditions["hour_of_day"] = [hour * 3600 for hour in tod] if len(filter_conditions["hour_of_day"]) > 0 else filter_conditions["hour_of_day"]
 
-    return jsonify(
-        graph.get_json(
-            channel=channel, 
-            antenna=antenna, 
-            model=model, 
-            histnorm=histnorm,
-            filter_conditions = filter_conditions,
-            inversetod=inversetod
-        )
+    return filter_conditions, inversetod
+
+@app.route("/graphs/channeldistribution/channelapi")
+@cache.cached(make_cache_key=versioned_key)
+def channel_distribution_channel_api():
+    # Request Args
+    with graphs.channel_distribution() as graph:
+        channel = request.args.get("channel", graph.default_channel, type=int)
+        antenna = distribution_antenna(graph)
+        filter_conditions, inversetod = distribution_filters(graph)
+
+    if channel is None:
+        raise InvalidRequest("The db has no channels", 404)
+
+    model = request.args.get("model", "kde", type=str)
+    histnorm = request.args.get("histnorm", "", type=str)
+    raw = request.args.get("raw", type=bool) # Raw samples instead of binned counts
+
+    return job_response(
+        jobs.channel_distribution,
+        channel=channel, 
+        antenna=antenna, 
+        model=model, 
+        histnorm=histnorm,
+        filter_conditions = filter_conditions,
+        inversetod=inversetod,
+        binned=not raw
+    )
+
+@app.route("/graphs/channeldistribution/batchapi")
+@cache.cached(make_cache_key=versioned_key)
+def channel_distribution_batch_api():
+    # Request Args (all of the antenna's channels unless channels are given)
+    with graphs.channel_distribution() as graph:
+        antenna = distribution_antenna(graph)
+        filter_conditions, inversetod = distribution_filters(graph)
+
+    channels = request.args.getlist("channels", type=str)
+    model = request.args.get("model", "kde", type=str)
+    histnorm = request.args.get("histnorm", "", type=str)
+    raw = request.args.get("raw", type=bool)
+
+    channels = None if not channels or "all" in channels else [int(channel) for channel in channels if channel.isdigit()]
+
+    return job_response(
+        jobs.channel_distributions,
+        channels=channels, 
+        antenna=antenna, 
+        model=model, 
+        histnorm=histnorm,
+        filter_conditions = filter_conditions,
+        inversetod=inversetod,
+        binned=not raw
     )
 
 @app.route("/graphs/channeldistribution/antennaapi")
-@cache.cached(timeout=3600, query_string=True)
+@cache.cached(make_cache_key=versioned_key)
 def channel_distribution_antenna_api():
-    graph = ChannelDistribution()
-    
-    # Request Args
-    antenna = request.args.get("antenna", graph.default_antenna, type=int)
+    with graphs.channel_distribution() as graph:
+        # Request Args
+        antenna = request.args.get("antenna", graph.default_antenna, type=int)
 
-    return jsonify(
-        channelMap=graph.get_channel_map(antenna=antenna), 
-        weatherMap=graph.get_weather_map(antenna=antenna)
-    )
+        return jsonify(
+            channelMap=graph.get_channel_map(antenna=antenna), 
+            weatherMap=graph.get_weather_map(antenna=antenna)
+        )
 
 if __name__ == "__main__":
     app.run(host="198.137.202.74", port="58000", debug=False)
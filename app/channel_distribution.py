@@ -3,57 +3,70 @@
 
 import numpy as np
 import pandas as pd
-import plotly
-import plotly.graph_objects as go
-from plotly.figure_factory import create_distplot
 
+import density
+import figures
+import metrics
+import rollup
+import snapshot
+from cube import cubes
 from db import load
+from metadata import store
 
 
 class ChannelDistribution():
     def __init__(self):
-        # default channel is latest scan
-        self.channel = None
-        self.labels = None
         self.signal_measurements = ["snq", "ss", "seq"]
+        self.colors = ["rgb(31, 119, 180)", "rgb(255, 127, 14)", "rgb(44, 160, 44)"]
 
-        self.default_antenna = load("SELECT configured_antenna_instance FROM monitor")["configured_antenna_instance"].to_list()[0]
-        self.default_channel = load("""SELECT channel FROM mapping WHERE channel IN (SELECT DISTINCT channel FROM signal 
-                                        INNER JOIN scan ON signal.scan_instance = scan.scan_instance WHERE antenna_instance=? 
-                                        AND snq>0) ORDER BY channel ASC LIMIT 1""", self.default_antenna)["channel"].values.tolist()[0]
-
-        antenna_df = load("SELECT * FROM antenna")
-        self.antenna_map = {instance: {"name": str(instance) + "; " + "Name: " + name + ", Location: " + location + ", Direction: " + str(direction) + " degrees, Comments: "}
-                            for instance, name, location, direction, comment in zip(antenna_df["antenna_instance"], antenna_df["name"], antenna_df["location"], 
-                            antenna_df["direction"], antenna_df["comment"])}
+        self.filter_col_labels = ["hour_of_day", "weather.start_time", "temperature", "wind_direction", "wind_speed", "humidity", "status"]
+        self.max_filter_conditions = 7
 
-        # Remove quotations
-        for i, description in enumerate(self.antenna_map.values()):
-            if "'" in self.antenna_map[i + 1]["name"]:
-                self.antenna_map[i + 1]["name"] = self.antenna_map[i + 1]["name"].replace("'", "")
-            
-            if "\"" in self.antenna_map[i + 1]["name"]:
-                self.antenna_map[i + 1]["name"] = self.antenna_map[i + 1]["name"].replace("\"", "")
+        self.refresh()
 
+    def refresh(self):
+        """Brings the defaults up to date with the metadata store and clears the last figure (see graphs.py)
+        """
+        store.refresh()
+        self.default_antenna = store.default_antenna
+        # The lowest mapped channel (any channel when none is mapped, None without channels)
+        channels = sorted(store.channels(self.default_antenna))
+        self.default_channel = next((channel for channel in channels if store.virtual_channels(channel)), 
+                                    channels[0] if channels else None)
+
+        self.antenna_map = store.antenna_map
         self.weather_map = { 
-            self.default_antenna: 
-            load("""SELECT DISTINCT(status) FROM weather INNER JOIN 
-                    scan ON weather.start_time = scan.start_time WHERE 
-                    antenna_instance=?""", self.default_antenna)["status"].values.tolist()
+            self.default_antenna: store.weather_statuses(self.default_antenna)
         }
 
-        self.filter_col_labels = ["hour_of_day", "weather.start_time", "temperature", "wind_direction", "wind_speed", "humidity", "status"]
-        self.max_filter_conditions = 7
+        self.reset()
 
-    def _build_df(self, channel, antenna, filter_conditions, inversetod):
+    def reset(self):
+        """Drops the state (and data frames) of the last figure
+        """
+        # default channel is latest scan
+        self.channel = None
+        self.labels = None
+        self.real_channels = None
+        self.df = None
+        self.counts = None # channel -> measurement -> counts by value, when built from rollups
+        self.figs = None
+        self.fig = None
+        self.channel_label = None
+
+    @metrics.timed
+    def _build_df(self, channels, antenna, filter_conditions, inversetod):
         qstrings = []
         qvalues = []
+        clauses = [("channel", "in", channels)] # the same conditions for the cube & snapshot
 
         if filter_conditions != None:
             if inversetod:
                 start_splice = 1
                 qstrings.append(" AND (hour_of_day>=? OR hour_of_day<=?)")
                 qvalues.extend(filter_conditions["hour_of_day"])
+                clauses.append([("hour_of_day", ">=", filter_conditions["hour_of_day"][0]), 
+                                ("hour_of_day", "<=", filter_conditions["hour_of_day"][1])])
             else:
                 start_splice = 0
             
@@ -63,120 +76,200 @@ class ChannelDistribution():
 
                 if filter_conditions[col_label]:
                     qvalues.extend(filter_conditions[col_label])
+                    clauses.append((col_label.split(".")[-1], ">=", filter_conditions[col_label][0]))
+                    clauses.append((col_label.split(".")[-1], "<=", filter_conditions[col_label][1]))
 
             if filter_conditions["status"] != None:
                 qstrings.append(" AND status=?")
                 qvalues.append(filter_conditions["status"])
+                clauses.append(("status", "==", filter_conditions["status"]))
 
         else:
             qstrings = ["" for i in range(self.max_filter_conditions)]
 
-        self.df = load(
-            """SELECT signal.scan_instance, signal.ss, signal.snq, signal.seq, 
-            scan.antenna_instance, weather.start_time, weather.start_time - 
-            strftime('%s', weather.start_time, "unixepoch", "start of day") 
-            as hour_of_day, weather.reference_time, weather.status, 
-            weather.temperature, weather.wind_direction, weather.status, 
-            weather.temperature, weather.wind_direction, weather.sunset 
-            FROM signal 
-            LEFT JOIN scan ON signal.scan_instance = scan.scan_instance 
-            LEFT JOIN weather ON scan.start_time = weather.start_time 
-            WHERE channel=? AND antenna_instance=?""" + "".join(qstrings),
-            channel, antenna, *qvalues
-        )
-
-        channeldf = load("""SELECT DISTINCT channel FROM signal INNER JOIN 
-                            scan ON signal.scan_instance = scan.scan_instance 
-                            WHERE antenna_instance=? AND snq>0;""", antenna)
-
-        self.real_channels = sorted(channeldf["channel"].values.tolist(), reverse=True)
+        select = ["scan_instance", "channel", "ss", "snq", "seq", "antenna_instance", "start_time", "hour_of_day", 
+                  "reference_time", "status", "temperature", "wind_direction", "sunset"]
+        cubes.refresh(load=False)
+        self.df = cubes.query(antenna, select, clauses)
+
+        if self.df is None:
+            self.df = snapshot.query(antenna, select, clauses)
+
+        if self.df is None:
+            self.df = load(
+                """SELECT signal.scan_instance, signal.channel, signal.ss, signal.snq, signal.seq, 
+                scan.antenna_instance, weather.start_time, weather.start_time - 
+                strftime('%s', weather.start_time, "unixepoch", "start of day") 
+                as hour_of_day, weather.reference_time, weather.status, 
+                weather.temperature, weather.wind_direction, weather.status, 
+                weather.temperature, weather.wind_direction, weather.sunset 
+                FROM signal 
+                LEFT JOIN scan ON signal.scan_instance = scan.scan_instance 
+                LEFT JOIN weather ON scan.start_time = weather.start_time 
+                WHERE channel IN (""" + ", ".join("?" for channel in channels) + """) 
+                AND antenna_instance=?""" + "".join(qstrings),
+                *channels, antenna, *qvalues
+            )
+
+        self.real_channels = store.channels(antenna)
+
+    @metrics.timed
+    def _build_counts(self, channels, antenna, filter_conditions):
+        """Counts each channel's measurement values from the rollups
+
+        Only date ranges can be answered by rollups (whole days and hours,
+        the rest of the range is counted from raw rows). self.counts stays
+        None when other filters are set or the rollups are behind the db.
+        """
+        self.counts = None
+
+        if filter_conditions is not None and any(filter_conditions[label] for label in self.filter_col_labels if label != "weather.start_time"):
+            return
+
+        if rollup.current() is None:
+            return
+
+        daterange = filter_conditions["weather.start_time"] if filter_conditions is not None else []
+        counts, raw = rollup.histograms(antenna, channels, *(daterange or [None, None]))
+        unfiltered = {label: [] for label in self.filter_col_labels}
+        unfiltered["status"] = None
+
+        for first, last in raw:
+            self._build_df(channels, antenna, dict(unfiltered, **{"weather.start_time": [first, last]}), False)
+
+            for channel, rows in self.df.groupby("channel"):
+                for signal in self.signal_measurements:
+                    counts[int(channel)][signal] += np.bincount(np.clip(rows[signal].values.astype(np.int64), 0, 255), minlength=256)
 
+        self.counts = counts
+        self.real_channels = store.channels(antenna)
+
+    @metrics.timed
     def _build_labels(self, antenna):
-        """Builds graph labels with real and virtual channel numbers
+        """Builds graph labels with real and virtual channel numbers (see MetadataStore.labels)
+        """
+        self.labels = store.labels(antenna, "distribution", self.real_channels)
+
+    @metrics.timed
+    def _graph(self, channels, curve, histnorm, binned):
+        """Builds the figure of each channel, with the curves and histograms 
+        of every channel computed together
         """
-        self.labels = {channel: str(channel) + ": " for channel in self.real_channels}
-        self.mapping = load("""SELECT channel, virtual FROM mapping 
-                                WHERE channel IN (SELECT DISTINCT channel 
-                                FROM signal INNER JOIN scan ON signal.scan_instance
-                                 = scan.scan_instance WHERE antenna_instance=? 
-                                AND snq>0)""", antenna)
-
-        for real, virtual in zip(self.mapping["channel"].values, self.mapping["virtual"].values):
-            if real in self.real_channels:
-                self.labels[real] += ", " + str(virtual)
-
-        for channel in self.labels.keys():
-            self.labels[channel] = self.labels[channel].replace(", ", "", 1)
-
-    def _graph(self, curve, histnorm):
-        # scan_range used to avoid a singular matrix error
-        # resulting from the signal measurements forming a singular matrix
-        scan_range = len(self.df["snq"])
-
-        if scan_range > 1:
-            for i in reversed(range(1, len(self.df["snq"]) + 1)):
-                try:
-                    lines = create_distplot([self.df["snq"].iloc[0:i], self.df["ss"].iloc[0:i], self.df["seq"].iloc[0:i]], self.signal_measurements,
-                                                bin_size=1, curve_type=curve, show_rug=False, histnorm=histnorm)
-                    scan_range = i
-                    models = [lines.data[3], lines.data[4], lines.data[5]]
-                    break
-                except np.linalg.LinAlgError:
-                    # Error Raised: 
-                    # numpy.linalg.LinAlgError: singular matrix
-                    pass
+        if self.counts is not None:
+            # Values counted by the rollups, weighted by their counts
+            values = np.arange(256)
+            series = [values[self.counts[channel][signal] > 0] for channel in channels for signal in self.signal_measurements]
+            weights = [self.counts[channel][signal][self.counts[channel][signal] > 0] for channel in channels for signal in self.signal_measurements]
         else:
-            models = [go.Scatter(x=[scan_range], y = self.df[signal], legendgroup=signal, showlegend=False) for signal in self.signal_measurements]
-
-        self.fig = go.Figure(data=[
-            go.Histogram(x=self.df["snq"].iloc[0:scan_range], name="snq", legendgroup="snq", 
-                opacity=0.75, bingroup=1, xbins={"size": 1}, marker={"line": {"color": "black", "width": 1.5}}),
-            go.Histogram(x=self.df["ss"].iloc[0:scan_range], name="ss", legendgroup="ss", 
-                opacity=0.75, bingroup=1, xbins={"size": 1}, marker={"line": {"color": "black", "width": 1.5}}),
-            go.Histogram(x=self.df["seq"].iloc[0:scan_range], name="seq", legendgroup="seq", 
-                opacity=0.75, bingroup=1, xbins={"size": 1}, marker={"line": {"color": "black", "width": 1.5}}),
-            models[0],
-            models[1],
-            models[2]
-        ])
-        self.fig.update_traces(visible=True)
-
-    def get_json(self, channel=None, antenna=None, model="kde", histnorm="", filter_conditions=None, inversetod=False):
-        self._build_df(channel, antenna, filter_conditions, inversetod)
+            samples = dict(list(self.df.groupby("channel")))
+            empty = self.df.iloc[0:0]
+            series = [samples.get(channel, empty)[signal].values for channel in channels for signal in self.signal_measurements]
+            weights = None
+
+        groups = [i for i in range(len(channels)) for signal in self.signal_measurements]
+        x, curves = density.curves(series, curve, histnorm, groups=groups, weights=weights)
+
+        if binned:
+            # Counts are binned here, so the payload no longer grows with
+            # the number of scans. Curves are scaled to the bars' units.
+            bins, heights, counts = density.histograms(series, histnorm, groups=groups, weights=weights)
+
+            if histnorm != "probability":
+                curves = [y * n for y, n in zip(curves, counts)]
+
+        self.figs = {}
+
+        for i, channel in enumerate(channels):
+            traces = range(i * len(self.signal_measurements), (i + 1) * len(self.signal_measurements))
+
+            if binned:
+                histograms = [figures.trace("bar", x=bins[trace], y=heights[trace], name=signal, legendgroup=signal, opacity=0.75, 
+                                width=1, marker={"line": {"color": "black", "width": 1.5}}, visible=True)
+                              for signal, trace in zip(self.signal_measurements, traces)]
+            else:
+                histograms = [figures.trace("histogram", x=series[trace], name=signal, legendgroup=signal, opacity=0.75, 
+                                bingroup=1, xbins={"size": 1}, marker={"line": {"color": "black", "width": 1.5}}, visible=True)
+                              for signal, trace in zip(self.signal_measurements, traces)]
+
+            models = [figures.trace("scatter", x=x[trace], y=curves[trace], mode="lines", name=signal, legendgroup=signal, 
+                        showlegend=False, marker={"color": color}, visible=True)
+                      for signal, trace, color in zip(self.signal_measurements, traces, self.colors)]
+
+            self.figs[channel] = figures.figure(histograms + models)
+
+    def get_figure(self, channel=None, antenna=None, model="kde", histnorm="", filter_conditions=None, inversetod=False, binned=True):
+        """Distribution figure (dict) of a channel's signal measurements
+
+        Binned figures hold bar traces of per-bin counts (probabilities when
+        histnorm is "probability") with curves in the same units. Otherwise
+        histogram traces carry every raw sample and curves are densities.
+        Binned figures of date ranges (or of all scans) are counted from the
+        rollups when they are current (see rollup.histograms).
+        """
+        self._build([channel], antenna, filter_conditions, inversetod, binned)
         self._build_labels(antenna)
-        self._graph(model, histnorm)
-        self.channel_label = self.labels[channel] if channel in self.labels.keys() else self.labels[list(self.labels)[0]]
+        self._graph([channel], model, histnorm, binned)
+        self.fig = self.figs[channel]
+        # An antenna without channels has no labels of its own
+        labels = self.labels or store.labels(antenna, "distribution", [channel])
+        self.channel_label = labels[channel] if channel in labels.keys() else labels[list(labels)[0]]
         self.channel_label = self.channel_label.replace(": ", "<br>---<br>")
         self.channel_label = self.channel_label.replace(", ", "<br>")
 
-        return plotly.io.to_json(self.fig)
+        return self.fig
 
-    def get_channel_map(self, antenna=None):
-        existing_antennas = load("SELECT antenna_instance FROM antenna")["antenna_instance"].tolist()
+    def get_figures(self, channels=None, antenna=None, model="kde", histnorm="", filter_conditions=None, inversetod=False, binned=True):
+        """Distribution figures (dicts) of several channels under one filter set
 
-        if antenna not in existing_antennas:
-            antenna = self.default_antenna
+        A single query reads every channel and all curves and histograms are
+        computed in one pass. Each figure equals get_figure's for the channel.
 
-        channeldf = load("""SELECT DISTINCT channel FROM signal INNER JOIN 
-                            scan ON signal.scan_instance = scan.scan_instance 
-                            WHERE antenna_instance=? AND snq>0;""", antenna)
+        @param[in] channels - list of real channels (default all of the antenna's)
+        @return figures - dict of channel -> figure
+        """
+        if channels is None:
+            channels = store.channels(antenna)
 
-        self.real_channels = sorted(channeldf["channel"].values.tolist(), reverse=True)
+        if not channels:
+            return {}
+
+        self._build(channels, antenna, filter_conditions, inversetod, binned)
+        self._build_labels(antenna)
+        self._graph(channels, model, histnorm, binned)
+
+        return self.figs
+
+    def _build(self, channels, antenna, filter_conditions, inversetod, binned):
+        # Rollup counts when they can answer, else the raw rows
+        self.counts = None
+
+        if binned:
+            self._build_counts(channels, antenna, filter_conditions)
+
+        if self.counts is None:
+            self._build_df(channels, antenna, filter_conditions, inversetod)
+
+    @metrics.timed
+    def get_json(self, *args, **kwargs):
+        """Distribution figure of a channel's signal measurements as a JSON str (see get_figure)
+        """
+        return figures.dumps(self.get_figure(*args, **kwargs)).decode()
+
+    def get_channel_map(self, antenna=None):
+        if antenna not in store.antennas:
+            antenna = self.default_antenna
+
+        self.real_channels = store.channels(antenna)
 
         self._build_labels(antenna)
         return self.labels
 
     def get_weather_map(self, antenna=None):
-        existing_antennas = load("SELECT antenna_instance FROM antenna")["antenna_instance"].tolist()
-
-        if antenna not in existing_antennas:
+        if antenna not in store.antennas:
             antenna = self.default_antenna
 
         self.weather_map = { 
-            antenna: 
-            load("""SELECT DISTINCT(status) FROM weather INNER JOIN 
-                    scan ON weather.start_time = scan.start_time WHERE 
-                    antenna_instance=?""", antenna)["status"].values.tolist()
+            antenna: store.weather_statuses(antenna)
         }
 
         return self.weather_map
@@ -0,0 +1,255 @@
+"""Resident per-antenna signal cubes for filtered distribution queries
+
+Every filter combination of the Channel Distribution page used to be a new
+SQL string and a full join. Each process instead keeps the joined data of
+every antenna in NumPy arrays (scans x channels per signal measurement,
+plus aligned weather columns), so a filter is a few boolean masks. Only
+processes that answer distribution queries (the job pool workers) load the
+cubes, in the background on their first query (queries fall back to the
+snapshot or the db until then), and only scans that landed since are appended.
+"""
+
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+import snapshot
+from db import data_version, load
+from metadata import store
+
+signal_measurements = ["snq", "ss", "seq"]
+weather_columns = ["start_time", "hour_of_day", "reference_time", "temperature", "wind_direction", "wind_speed",
+                   "humidity", "sunset"]
+
+# Signal value of channels a scan didn't measure
+missing = -1
+
+# Scans of an antenna read at a time by a refresh
+window_scans = 10000
+
+
+class Cube():
+    """Joined signal, scan and weather rows of an antenna as arrays
+
+    One row per scan (or per weather row of a scan, as the weather join
+    repeats scans with several), one column per channel. NULL weather
+    values are NaN (None for status), so comparisons with them never match.
+    """
+    def __init__(self, antenna):
+        self.antenna = antenna
+        self.scan_instance = np.empty(0, dtype=np.int64)
+        self.channels = {} # channel -> column
+        self.signals = {measurement: np.empty((0, 0), dtype=np.int16) for measurement in signal_measurements}
+        self.weather = {column: np.empty(0) for column in weather_columns}
+        self.weather["status"] = np.empty(0, dtype=object)
+
+    @classmethod
+    def of(cls, antenna, rows):
+        """Cube of the joined rows of some scans of an antenna
+        """
+        repeats = rows.groupby(["scan_instance", "channel"]).cumcount().values
+        keys, first, inverse = np.unique(np.stack([rows["scan_instance"].values, repeats], axis=1), axis=0,
+                                         return_index=True, return_inverse=True)
+
+        cube = cls(antenna)
+        for channel in rows["channel"].unique().tolist():
+            cube.channels.setdefault(channel, len(cube.channels))
+
+        columns = np.array([cube.channels[channel] for channel in rows["channel"].tolist()], dtype=np.int64)
+        cube.scan_instance = keys[:, 0]
+
+        for measurement in signal_measurements:
+            cube.signals[measurement] = np.full((len(keys), len(cube.channels)), missing, dtype=np.int16)
+            cube.signals[measurement][inverse.ravel(), columns] = rows[measurement].values
+
+        for column in weather_columns:
+            cube.weather[column] = pd.to_numeric(rows[column]).values.astype(float)[first]
+
+        status = rows["status"].values[first]
+        cube.weather["status"] = np.where(pd.isna(status), None, status)
+
+        return cube
+
+    def appended(self, parts, sealed):
+        """New cube with rows of scans after sealed replaced by the rows of parts
+
+        @param[in] parts - cubes of later scans of the antenna, in scan order (see of)
+        @param[in] sealed - rows of scans up to it are kept
+        """
+        cube = Cube(self.antenna)
+        cube.channels = dict(self.channels)
+        for part in parts:
+            for channel in part.channels:
+                cube.channels.setdefault(channel, len(cube.channels))
+
+        # (cube, rows kept), channels are in column order
+        pieces = [(self, self.scan_instance <= sealed)] + [(part, slice(None)) for part in parts]
+        cube.scan_instance = np.concatenate([piece.scan_instance[rows] for piece, rows in pieces])
+
+        for measurement in signal_measurements:
+            signals = np.full((len(cube.scan_instance), len(cube.channels)), missing, dtype=np.int16)
+            start = 0
+
+            for piece, rows in pieces:
+                values = piece.signals[measurement][rows]
+                signals[start:start + len(values), [cube.channels[channel] for channel in piece.channels]] = values
+                start += len(values)
+
+            cube.signals[measurement] = signals
+
+        for column in weather_columns + ["status"]:
+            cube.weather[column] = np.concatenate([piece.weather[column][rows] for piece, rows in pieces])
+
+        return cube
+
+    def _mask(self, clause):
+        # Rows matching a (column, op, value) clause or a list of them (ORed)
+        if isinstance(clause, list):
+            return np.logical_or.reduce([self._mask(option) for option in clause])
+
+        column, op, value = clause
+        values = self.scan_instance if column == "scan_instance" else self.weather[column]
+
+        with np.errstate(invalid="ignore"):
+            if op == "in":
+                return np.isin(values, list(value))
+
+            return {"==": np.equal, ">=": np.greater_equal, "<=": np.less_equal, ">": np.greater}[op](values, value)
+
+    def query(self, select, where=()):
+        """Rows matching every where clause, one per scan & measured channel (see snapshot.query)
+        """
+        mask = np.ones(len(self.scan_instance), dtype=bool)
+        channels = list(self.channels)
+
+        for clause in where:
+            if isinstance(clause, tuple) and clause[0] == "channel":
+                requested = [clause[2]] if clause[1] == "==" else list(clause[2])
+                channels = [channel for channel in requested if channel in self.channels and channel in channels]
+            else:
+                mask &= self._mask(clause)
+
+        rows = [np.flatnonzero(mask & (self.signals["snq"][:, self.channels[channel]] != missing)) for channel in channels]
+        rows_of = np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+        counts = [len(selected) for selected in rows]
+        columns_of = np.repeat(np.array([self.channels[channel] for channel in channels], dtype=np.int64), counts)
+
+        data = {}
+        for column in select:
+            if column in self.signals:
+                data[column] = self.signals[column][rows_of, columns_of].astype(np.int64)
+            elif column == "channel":
+                data[column] = np.repeat(np.array(channels, dtype=np.int64), counts)
+            elif column == "antenna_instance":
+                data[column] = np.full(len(rows_of), self.antenna, dtype=np.int64)
+            elif column == "scan_instance":
+                data[column] = self.scan_instance[rows_of]
+            else:
+                data[column] = self.weather[column][rows_of]
+
+        return pd.DataFrame(data, columns=list(select))
+
+
+class CubeStore():
+    def __init__(self):
+        self.version = None # db.data_version of the cubes
+        self.sealed = 0 # scans after it are reloaded on refresh (their rows can still land)
+
+        self._cubes = {} # antenna -> Cube (replaced, never modified)
+        self._lock = threading.Lock()
+        self._loader = None # thread of the initial load
+
+        os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        # The lock may have been held by another thread when the process forked
+        self._lock = threading.Lock()
+        self._loader = None
+
+    def _windows(self, antenna):
+        # (after, last) scan_instance ranges of window_scans scans of the antenna that landed since sealed
+        scans = load("SELECT scan_instance FROM scan WHERE antenna_instance=? AND scan_instance>? ORDER BY scan_instance",
+                     antenna, self.sealed)["scan_instance"].values
+        bounds = scans[window_scans - 1::window_scans].tolist()
+
+        if len(scans) and (not bounds or bounds[-1] != scans[-1]):
+            bounds.append(int(scans[-1]))
+
+        return list(zip([self.sealed] + bounds[:-1], bounds))
+
+    def _rows(self, antenna, after, last):
+        # Snapshot when it is current (no row by row conversion), else the db
+        names = [name for name, kind in snapshot.columns]
+        rows = snapshot.query(antenna, names, [("scan_instance", ">", after), ("scan_instance", "<=", last)])
+
+        if rows is None:
+            return snapshot.rows(after, last=last, antenna=antenna)
+
+        return rows
+
+    def refresh(self, load=True):
+        """Appends scans that landed since the last refresh
+
+        Costs a single data_version lookup unless new scans landed. Antennas
+        are read window_scans scans at a time, so the joined rows of every
+        scan are never in memory at once.
+
+        @param[in] load - False loads cubes that aren't loaded yet on a background
+                          thread, so requests never wait for the initial load
+        """
+        if not load and self.version is None:
+            with self._lock:
+                if self._loader is None or not self._loader.is_alive(): # retried after a failed load
+                    self._loader = threading.Thread(target=self.refresh, name="cubes", daemon=True)
+                    self._loader.start()
+
+            return
+
+        version = data_version()
+
+        if version == self.version:
+            return
+
+        with self._lock:
+            if version == self.version:
+                return
+
+            store.refresh()
+            latest = self.sealed
+
+            for antenna in store.antennas:
+                parts = []
+
+                for after, last in self._windows(antenna):
+                    rows = self._rows(antenna, after, last)
+                    latest = max(latest, last)
+
+                    if len(rows):
+                        parts.append(Cube.of(antenna, rows))
+
+                if parts:
+                    self._cubes[antenna] = self._cubes.get(antenna, Cube(antenna)).appended(parts, self.sealed)
+
+            self.sealed = max(latest - 1, self.sealed)
+            self.version = version
+
+    def query(self, antenna, select, where=()):
+        """Rows of an antenna matching every where clause (see snapshot.query)
+
+        @param[in] antenna - antenna instance
+        @param[in] select - list of snapshot column names
+        @param[in] where - list of clauses (ANDed)
+        @return df - pandas data frame, or None before the cubes are loaded
+        """
+        if self.version is None:
+            return None
+
+        return self._cubes.get(antenna, Cube(antenna)).query(select, where)
+
+
+cubes = CubeStore()
+
+if __name__ == "__main__":
+    pass
@@ -1,14 +1,199 @@
 """Query the db
 """
 
+import contextlib
+import logging
+import os
+import pathlib
+import queue
 import sqlite3 as sql
+import threading
+import time
 
-import pandas as pd
+import metrics
 
 path_to_db = "monitor.db"
 
+# PRAGMAs applied to every pooled connection when it is opened
+pragmas = {
+    "mmap_size": 268435456,  # bytes (256 MiB) of the db file memory mapped
+    "cache_size": -65536,  # negative values are KiB (64 MiB page cache)
+    "temp_store": "MEMORY",
+    "query_only": "ON",
+}
 
-def load(query, *args, path=path_to_db) -> pd.DataFrame:
+# Journal mode migrate switches the db to, None leaves it as is. It is kept
+# in the db file: in WAL mode readers never wait for the scanner's writes
+# (nor block its commits), in the default rollback mode they wait up to
+# busy_timeout while it commits and then fail with "database is locked"
+journal_mode = None
+
+# Milliseconds a connection waits for a lock before "database is locked"
+busy_timeout = 5000
+
+# Idle connections kept open per database
+pool_size = 8
+
+# Seconds a fork of the process waits for the sqlite statements in progress (see in_use)
+fork_timeout = 5
+
+# Prepared statements kept compiled per connection (keyed by query string)
+cached_statements = 256
+
+# Covering indexes for the graph queries: (name, table, columns)
+indexes = [
+    # ChannelDistribution / TrackChannels: WHERE channel=? (or IN) joined to scan
+    ("signal_channel_scan", "signal", ("channel", "scan_instance", "snq", "ss", "seq")),
+    # ScanSummary and metadata refreshes: WHERE scan_instance=? (or >=) AND snq>0
+    ("signal_scan_channel", "signal", ("scan_instance", "channel", "snq", "ss", "seq")),
+    # Track Channel exports: WHERE antenna_instance=? ORDER BY start_time
+    ("scan_antenna_start", "scan", ("antenna_instance", "start_time", "scan_instance")),
+    # Scans of an antenna in scan order: WHERE antenna_instance=? ORDER BY scan_instance
+    ("scan_antenna_instance", "scan", ("antenna_instance", "scan_instance", "start_time")),
+    # weather JOIN scan ON start_time
+    ("scan_start", "scan", ("start_time", "antenna_instance", "scan_instance")),
+    ("weather_start", "weather", ("start_time",)),
+]
+
+# Queries issued through load (query -> latest args), explained by full_scans
+issued = {}
+max_issued = 256
+
+logger = logging.getLogger(__name__)
+
+_pools = {}
+_lock = threading.Lock()
+
+# sqlite statements in progress, which a fork of the process waits for (see in_use)
+_users = 0
+_idle = threading.Condition()
+
+
+def _uri(path, mode="ro") -> str:
+    """Builds a sqlite URI for path (mode=ro never creates or writes the db)
+    """
+    return pathlib.Path(path).resolve().as_uri() + "?mode=" + mode
+
+
+def _open(path) -> sql.Connection:
+    # Connections move between request threads through the pool,
+    # but only one thread uses a connection at a time
+    connection = sql.connect(_uri(path), uri=True, timeout=busy_timeout / 1000, cached_statements=cached_statements,
+                             check_same_thread=False)
+
+    for pragma, value in pragmas.items():
+        connection.execute(f"PRAGMA {pragma}={value}")
+
+    return connection
+
+
+def _pool(path) -> queue.LifoQueue:
+    with _lock:
+        if path not in _pools:
+            _pools[path] = queue.LifoQueue(maxsize=pool_size)
+
+        return _pools[path]
+
+
+@contextlib.contextmanager
+def in_use():
+    """Marks a sqlite statement in progress, which a fork of the process waits for
+
+    sqlite keeps its file lock bookkeeping per process and a forked child
+    inherits it. Forked while a connection holds a lock, the child's own
+    connections skip locking the file and can read pages the scanner is
+    writing ("database disk image is malformed"), so a fork (i.e. of a
+    gunicorn worker) waits until no thread runs a statement. Only single
+    statements and fetches are marked, so the wait is short, and a fork
+    goes ahead after fork_timeout seconds regardless.
+    """
+    global _users
+
+    with _idle:
+        _users += 1
+
+    try:
+        yield
+    finally:
+        with _idle:
+            _users -= 1
+
+            if not _users:
+                _idle.notify_all()
+
+
+def _before_fork():
+    # Held until the fork is done, so no connection takes a lock meanwhile
+    _idle.acquire()
+
+    if not _idle.wait_for(lambda: not _users, fork_timeout):
+        logger.warning("Forking while %d threads use sqlite", _users)
+
+
+def _after_fork_in_parent():
+    _idle.release()
+
+
+@contextlib.contextmanager
+def connection(path=path_to_db):
+    """Checks a read-only connection out of the pool for path
+
+    Connections are opened with mode=ro, configured with pragmas once,
+    and handed back to the pool afterwards so the schema is parsed and
+    statements are prepared only once per connection (statements run on
+    it are marked with in_use by the caller). Reads never hold
+    a transaction open, so a db in WAL mode keeps accepting scanner
+    writes while the app reads from it.
+
+    @param[in] path - path to database
+    @return connection - pooled sqlite3 connection (context manager)
+    """
+    pool = _pool(path)
+
+    try:
+        conn = pool.get_nowait()
+    except queue.Empty:
+        with in_use():
+            conn = _open(path)
+
+    try:
+        yield conn
+    finally:
+        # Read-only connections never hold a transaction, so even a
+        # failed query leaves them safe to reuse
+        try:
+            pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+
+def close_connections():
+    """Closes every idle pooled connection
+    """
+    with _lock:
+        pools = list(_pools.values())
+
+    for pool in pools:
+        while True:
+            try:
+                pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def _reset_after_fork():
+    # sqlite connections must not be shared with a forked child process
+    global _pools, _lock, _users, _idle
+    _pools = {}
+    _lock = threading.Lock()
+    _users = 0
+    _idle = threading.Condition()
+
+
+os.register_at_fork(before=_before_fork, after_in_parent=_after_fork_in_parent, after_in_child=_reset_after_fork)
+
+
+def load(query, *args, path=path_to_db) -> "pd.DataFrame":
     """Converts sqlite3 db query to pandas df
 
     @param[in] query - str with direct sql query (for more complex queries)
@@ -16,19 +201,185 @@ def load(query, *args, path=path_to_db) -> pd.DataFrame:
     @param[in] path - path to database
     @return df - pandas data frame with specified table and conditions
     """
-    connection = sql.connect(path)
-    c = connection.cursor()
+    # Imported on first use, app workers boot without pandas (see graphs.py)
+    import pandas as pd
+
+    if query in issued or len(issued) < max_issued:
+        issued[query] = args
+
+    start = time.perf_counter()
 
-    if args:
-        # Sanitized query
-        df = pd.read_sql_query(query, connection, params=args)
-    else:
-        df = pd.read_sql_query(query, connection)
+    with connection(path) as conn, in_use():
+        try:
+            if args:
+                # Sanitized query
+                df = pd.read_sql_query(query, conn, params=args)
+            else:
+                df = pd.read_sql_query(query, conn)
+        except pd.io.sql.DatabaseError as error:
+            # pandas wraps sqlite3's errors, callers see them as is (i.e. "database is locked")
+            if isinstance(error.__cause__, sql.Error):
+                raise error.__cause__
 
-    connection.close()
+            raise
 
+    metrics.query(query, time.perf_counter() - start, len(df))
     return df
 
 
+def stream(query, *args, path=path_to_db, size=5000):
+    """Yields the rows of a db query in chunks, read with a cursor
+
+    Only one chunk is held in memory at a time, however many rows the
+    query returns. The pooled connection is held until the generator is
+    exhausted or closed (i.e. when a streamed response ends), while a fork
+    only waits for the fetch in progress.
+
+    @param[in] query - str with direct sql query
+    @param[in] args - query args (passed into query string)
+    @param[in] path - path to database
+    @param[in] size - rows per chunk
+    @return chunks - generator of lists of row tuples
+    """
+    if query in issued or len(issued) < max_issued:
+        issued[query] = args
+
+    with connection(path) as conn:
+        with in_use():
+            cursor = conn.execute(query, args)
+
+        try:
+            while True:
+                with in_use():
+                    chunk = cursor.fetchmany(size)
+
+                if not chunk:
+                    break
+
+                yield chunk
+        finally:
+            # Resets the statement before the connection goes back to the pool
+            cursor.close()
+
+
+def data_version(path=path_to_db) -> str:
+    """Version of the graphed data, which changes whenever scans land
+
+    Made of the latest scan_instance, the number of signal rows of that scan
+    (they can land after the scan row itself) and the latest weather
+    start_time. Each part is a single index lookup.
+
+    @param[in] path - path to database
+    @return version - str (i.e. "1200-31-1593561600")
+    """
+    with connection(path) as conn, in_use():
+        version = conn.execute("""SELECT (SELECT MAX(scan_instance) FROM scan), 
+                                  (SELECT COUNT(*) FROM signal WHERE scan_instance=(SELECT MAX(scan_instance) FROM scan)), 
+                                  (SELECT MAX(start_time) FROM weather)""").fetchone()
+
+    return "-".join(str(part) for part in version)
+
+
+def explain(query, *args, path=path_to_db) -> list:
+    """Runs EXPLAIN QUERY PLAN on a query
+
+    @param[in] query - str with direct sql query
+    @param[in] args - query args (passed into query string)
+    @param[in] path - path to database
+    @return plan - list of plan step details (i.e. "SEARCH scan USING INDEX ...")
+    """
+    with connection(path) as conn, in_use():
+        return [row[-1] for row in conn.execute("EXPLAIN QUERY PLAN " + query, args)]
+
+
+def full_scans(path=path_to_db) -> dict:
+    """Finds issued queries whose plan scans a table without an index
+
+    @param[in] path - path to database
+    @return scans - dict of query -> plan steps that are full table scans
+    """
+    scans = {}
+
+    for query, args in list(issued.items()):
+        steps = [step for step in explain(query, *args, path=path) 
+                 if step.startswith("SCAN") and "INDEX" not in step and not step.startswith("SCAN (subquery")]
+
+        if steps:
+            scans[query] = steps
+
+    return scans
+
+
+def migrate(path=path_to_db) -> list:
+    """Creates any missing recommended index, refreshes planner statistics and sets journal_mode
+
+    Idempotent, so it is safe to run at every app startup. ANALYZE only
+    runs when an index was created or the db was never analyzed. A db the
+    app cannot write to is left as is.
+
+    @param[in] path - path to database
+    @return created - names of the indexes created
+    """
+    try:
+        conn = sql.connect(_uri(path, mode="rw"), uri=True)
+    except sql.OperationalError as error:
+        logger.warning("Skipping index migration of %s: %s", path, error)
+        return []
+
+    try:
+        existing = {name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type='index'")}
+        created = []
+
+        for name, table, columns in indexes:
+            if name not in existing:
+                conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})")
+                created.append(name)
+
+        analyzed = conn.execute("SELECT 1 FROM sqlite_master WHERE name='sqlite_stat1'").fetchone()
+
+        if created or not analyzed:
+            conn.execute("ANALYZE")
+
+        conn.commit()
+
+        if journal_mode is not None:
+            # Needs a moment without other connections' transactions (i.e. the scanner's)
+            mode = conn.execute(f"PRAGMA journal_mode={journal_mode}").fetchone()[0]
+
+            if mode.lower() != journal_mode.lower():
+                logger.warning("%s is still in %s journal mode", path, mode)
+    except sql.OperationalError as error:
+        logger.warning("Index migration of %s failed: %s", path, error)
+        return []
+    finally:
+        conn.close()
+
+    return created
+
+
 if __name__ == "__main__":
-    pass
+    # Index advisor: migrate, exercise every graph, report remaining full scans
+    # (the graph modules record their queries in the imported db module)
+    import db
+    from channel_distribution import ChannelDistribution
+    from scan_summary import ScanSummary
+    from track_channel import TrackChannels
+
+    print("Created indexes:", ", ".join(db.migrate()) or "none")
+
+    track_channel = TrackChannels()
+    track_channel.get_json(antenna=track_channel.default_antenna)
+
+    scan_summary = ScanSummary()
+    scan_summary.get_json(antenna=scan_summary.default_antenna)
+    scan_summary.get_antenna_range(antenna=scan_summary.default_antenna)
+
+    channel_distribution = ChannelDistribution()
+    channel_distribution.get_json(channel=channel_distribution.default_channel, antenna=channel_distribution.default_antenna)
+    channel_distribution.get_channel_map(antenna=channel_distribution.default_antenna)
+    channel_distribution.get_weather_map(antenna=channel_distribution.default_antenna)
+
+    for query, steps in db.full_scans().items():
+        print(" ".join(query.split()))
+        for step in steps:
+            print("    " + step)
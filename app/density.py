@@ -0,0 +1,221 @@
+"""Kernel density and normal curves for signal measurement distributions
+
+Measurements are small integers, so each series is reduced to counts of
+its distinct values once and every curve is evaluated from those counts
+(series can also be given as counted already: distinct values & weights).
+All series are evaluated together in a single pass, on one grid or on one
+grid per group of series (i.e. the measurements of each channel).
+"""
+
+import numpy as np
+
+# Points per curve (matches plotly's create_distplot)
+grid_points = 500
+
+# Kernel width used for series without spread (a single value or sample).
+# Their density is a point mass, drawn as a narrow gaussian of unit area.
+min_bandwidth = 0.5
+
+
+def _weighted(series, weights):
+    # Series as float arrays without NaN values, and the weight of each sample
+    series = [np.asarray(samples, dtype=float) for samples in series]
+    weights = [np.ones(len(samples)) if weights is None else np.asarray(sample_weights, dtype=float)
+               for samples, sample_weights in zip(series, weights or series)]
+    kept = [~np.isnan(samples) for samples in series]
+
+    return [samples[keep] for samples, keep in zip(series, kept)], [w[keep] for w, keep in zip(weights, kept)]
+
+
+def support(series, weights=None):
+    """Distinct values of a group of series and how often each occurs
+
+    @param[in] series - list of 1d arrays (NaN values are ignored)
+    @param[in] weights - list of 1d arrays of each sample's count (default 1)
+    @return values - sorted distinct values across all series
+    @return counts - 2d array (series x values) of occurrence counts
+    """
+    series, weights = _weighted(series, weights)
+
+    values, inverse = np.unique(np.concatenate(series), return_inverse=True)
+    owners = np.repeat(np.arange(len(series)), [len(samples) for samples in series])
+    counts = np.bincount(owners * len(values) + inverse.ravel(), weights=np.concatenate(weights), minlength=len(series) * len(values))
+
+    return values, counts.reshape(len(series), len(values)).astype(float)
+
+
+def moments(values, counts, ddof=0):
+    """Sample size, mean and standard deviation of each series
+
+    @param[in] values - distinct values (see support)
+    @param[in] counts - 2d array (series x values) of occurrence counts
+    @param[in] ddof - delta degrees of freedom of the standard deviation
+    @return n, mean, std - 1d arrays (one entry per series)
+    """
+    n = counts.sum(axis=1)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = counts @ values / n
+        deviations = counts * (values[np.newaxis, :] - mean[:, np.newaxis]) ** 2
+        std = np.sqrt(deviations.sum(axis=1) / (n - ddof))
+
+    return n, mean, std
+
+
+def grid(values):
+    """Shared x values for the curves of every series
+    """
+    if len(values) == 0:
+        return np.array([])
+
+    start, end = values[0], values[-1]
+
+    if start == end:
+        start, end = start - 1, end + 1
+
+    return np.linspace(start, end, grid_points)
+
+
+def _grids(values, counts, groups):
+    # Grid of each series' group (rows of groups without samples are empty)
+    groups = np.asarray(groups)
+    grids = {}
+
+    for group in np.unique(groups):
+        grids[group] = grid(values[counts[groups == group].sum(axis=0) > 0])
+
+    return [grids[group] for group in groups]
+
+
+def _gaussians(x, centers, weights, widths):
+    # Sum of weighted unit-area gaussians (series x centers) evaluated at x
+    # (points shared by every series, or one row of points per series)
+    x = np.broadcast_to(x, (len(widths), np.shape(x)[-1]))
+    z = (x[:, np.newaxis, :] - centers[:, :, np.newaxis]) / widths[:, np.newaxis, np.newaxis]
+    norm = widths * np.sqrt(2 * np.pi)
+
+    return np.einsum("sc,scx->sx", weights, np.exp(-0.5 * z ** 2)) / norm[:, np.newaxis]
+
+
+def kde(values, counts, x):
+    """Gaussian kernel density of each series (Scott's rule bandwidth)
+
+    Matches scipy.stats.gaussian_kde, which create_distplot used, but
+    never fails on series without spread.
+
+    @param[in] values - distinct values (see support)
+    @param[in] counts - 2d array (series x values) of occurrence counts
+    @param[in] x - points to evaluate the densities at (or 2d, one row per series)
+    @return y - 2d array (series x points) of densities
+    """
+    n, mean, std = moments(values, counts, ddof=1)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        bandwidth = std * n ** (-1 / 5)
+        weights = counts / n[:, np.newaxis]
+
+    bandwidth = np.where(np.isfinite(bandwidth) & (bandwidth > 0), bandwidth, min_bandwidth)
+
+    centers = np.broadcast_to(values, counts.shape)
+    y = _gaussians(x, centers, np.nan_to_num(weights), bandwidth)
+
+    return y
+
+
+def normal(values, counts, x):
+    """Normal distribution fit (maximum likelihood) of each series
+
+    @param[in] values - distinct values (see support)
+    @param[in] counts - 2d array (series x values) of occurrence counts
+    @param[in] x - points to evaluate the densities at (or 2d, one row per series)
+    @return y - 2d array (series x points) of densities
+    """
+    n, mean, std = moments(values, counts)
+    std = np.where(np.isfinite(std) & (std > 0), std, min_bandwidth)
+    weights = (n > 0).astype(float)[:, np.newaxis]
+
+    return _gaussians(x, np.nan_to_num(mean)[:, np.newaxis], weights, std)
+
+
+def histograms(series, histnorm="", bin_size=1, groups=None, weights=None):
+    """Histograms of several series on shared bins
+
+    Bins are bin_size wide and centered on multiples of bin_size, as
+    plotly bins integer data with xbins.size=1.
+
+    @param[in] series - list of 1d arrays of samples (NaN values are ignored)
+    @param[in] histnorm - "probability" divides counts by each series' size
+    @param[in] bin_size - bin width
+    @param[in] groups - group of each series; each group gets its own bins
+    @param[in] weights - list of 1d arrays of each sample's count (default 1)
+    @return x - bin centers (list of them per series when grouped)
+    @return y - 2d array (series x bins) of counts or probabilities (list of rows when grouped)
+    @return n - 1d array of each series' size
+    """
+    series, weights = _weighted(series, weights)
+    bins = [np.floor(samples / bin_size + 0.5).astype(np.int64) for samples in series]
+    occupied = np.concatenate(bins)
+
+    if len(occupied) == 0:
+        x, y = np.array([]), np.zeros((len(series), 0))
+        return ([x] * len(series), list(y), np.zeros(len(series))) if groups is not None else (x, y, np.zeros(len(series)))
+
+    first, last = occupied.min(), occupied.max()
+    y = np.array([np.bincount(samples - first, weights=sample_weights, minlength=last - first + 1)
+                  for samples, sample_weights in zip(bins, weights)], dtype=float)
+    n = y.sum(axis=1)
+    x = np.arange(first, last + 1) * bin_size
+    occupied = y > 0
+
+    if histnorm == "probability":
+        with np.errstate(invalid="ignore", divide="ignore"):
+            y = np.nan_to_num(y / n[:, np.newaxis])
+
+    if groups is None:
+        return x, y, n
+
+    # Trim each group's bins to the ones its series occupy
+    groups = np.asarray(groups)
+    spans = {}
+
+    for group in np.unique(groups):
+        columns = np.flatnonzero(occupied[groups == group].any(axis=0))
+        spans[group] = slice(columns[0], columns[-1] + 1) if len(columns) else slice(0, 0)
+
+    return [x[spans[group]] for group in groups], [row[spans[group]] for row, group in zip(y, groups)], n
+
+
+def curves(series, model="kde", histnorm="", bin_size=1, groups=None, weights=None):
+    """Density curves of several series on a shared grid
+
+    @param[in] series - list of 1d arrays of samples
+    @param[in] model - "kde" or "normal"
+    @param[in] histnorm - "probability" scales densities to bin probabilities
+    @param[in] bin_size - histogram bin width
+    @param[in] groups - group of each series; each group gets its own grid
+    @param[in] weights - list of 1d arrays of each sample's count (default 1)
+    @return x - shared grid (list of grids per series when grouped)
+    @return y - 2d array (series x grid) of curve values (list of rows when grouped)
+    """
+    values, counts = support(series, weights)
+
+    if groups is None:
+        x = grid(values)
+    else:
+        grids = _grids(values, counts, groups)
+        # Series of empty groups are evaluated on a placeholder grid and dropped
+        x = np.array([points if len(points) else np.zeros(grid_points) for points in grids]).reshape(len(grids), -1)
+
+    y = normal(values, counts, x) if model == "normal" else kde(values, counts, x)
+
+    if histnorm == "probability":
+        y = y * bin_size
+
+    if groups is None:
+        return x, y
+
+    return grids, [row[:len(points)] for row, points in zip(y, grids)]
+
+
+if __name__ == "__main__":
+    pass
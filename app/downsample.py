@@ -0,0 +1,93 @@
+"""Downsamples time series traces to a point budget
+
+Every trace of a figure shares its x values, so both methods take a 2d
+array of y values (points x traces) and select points for all traces at
+once. They return a 2d array of selected row indices (selected x traces).
+"""
+
+import numpy as np
+
+
+def _all(ys):
+    return np.tile(np.arange(len(ys))[:, np.newaxis], (1, ys.shape[1]))
+
+
+def lttb(x, ys, threshold):
+    """Largest-Triangle-Three-Buckets selection
+
+    Keeps the first and last points and, from each of threshold - 2
+    buckets, the point forming the largest triangle with the previously
+    selected point and the average of the next bucket.
+
+    @param[in] x - 1d numeric array of sorted x values
+    @param[in] ys - 2d array (points x traces) of y values
+    @param[in] threshold - points to keep per trace
+    @return indices - 2d array (threshold x traces) of selected rows
+    """
+    n = len(x)
+
+    if threshold >= n or threshold < 3:
+        return _all(ys)
+
+    x = np.asarray(x, dtype=float) - x[0]
+    traces = np.arange(ys.shape[1])
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+
+    selected = np.empty((threshold, ys.shape[1]), dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        # The last bucket's next "bucket" is the last point
+        after = edges[bucket + 2] if bucket + 2 < len(edges) else n
+
+        cx = x[end:after].mean()
+        cy = ys[end:after].mean(axis=0)
+        ax = x[selected[bucket]]
+        ay = ys[selected[bucket], traces]
+
+        area = np.abs((ax - cx) * (ys[start:end] - ay) - (ax - x[start:end, np.newaxis]) * (cy - ay))
+        selected[bucket + 1] = start + area.argmax(axis=0)
+
+    return selected
+
+
+def minmax(x, ys, threshold):
+    """Per-bucket minimum and maximum selection
+
+    Splits the points into threshold // 2 equal buckets and keeps each
+    bucket's lowest and highest point (in x order). Fully vectorized, and
+    never drops a spike.
+
+    @param[in] x - 1d numeric array of sorted x values
+    @param[in] ys - 2d array (points x traces) of y values
+    @param[in] threshold - points to keep per trace
+    @return indices - 2d array (threshold x traces) of selected rows
+    """
+    n = len(x)
+    buckets = threshold // 2
+
+    if threshold >= n or buckets < 1:
+        return _all(ys)
+
+    size = -(-n // buckets)
+    padding = buckets * size - n
+    ys = np.asarray(ys, dtype=float)
+
+    lows = np.pad(np.where(np.isnan(ys), np.inf, ys), ((0, padding), (0, 0)), constant_values=np.inf)
+    highs = np.pad(np.where(np.isnan(ys), -np.inf, ys), ((0, padding), (0, 0)), constant_values=-np.inf)
+
+    offsets = np.arange(buckets)[:, np.newaxis] * size
+    low = lows.reshape(buckets, size, -1).argmin(axis=1) + offsets
+    high = highs.reshape(buckets, size, -1).argmax(axis=1) + offsets
+
+    selected = np.sort(np.stack([low, high], axis=1), axis=1)
+
+    return np.minimum(selected.reshape(2 * buckets, -1), n - 1)
+
+
+methods = {"lttb": lttb, "minmax": minmax}
+
+if __name__ == "__main__":
+    pass
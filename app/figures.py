@@ -0,0 +1,126 @@
+"""Builds plotly figures as plain dicts and serializes them to JSON
+
+plotly.graph_objects validates every property of every trace and
+plotly.io.to_json then walks the validated figure again (embedding the
+default template, which the pages never use). The graphs only need the
+figure JSON, so traces are built as dicts holding NumPy arrays and encoded
+in one pass: by orjson (native ndarray & datetime64 support) when it is
+installed, else by the json module.
+
+With binary set, numeric arrays are sent as plotly typed array specs
+({"dtype": "u1", "bdata": base64 of the little endian buffer}) instead of
+number lists, so the browser decodes them without parsing numbers.
+"""
+
+import base64
+import json
+
+import numpy as np
+
+import metrics
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Media type of JSON holding typed arrays (Accept it or pass format=bdata to the apis)
+bdata_mimetype = "application/vnd.airwaves.bdata+json"
+
+# Typed array dtypes for integers, smallest first (plotly has no 64 bit integers)
+int_dtypes = ["u1", "i1", "u2", "i2", "u4", "i4"]
+
+
+def trace(type, **properties) -> dict:
+    """Plotly trace of a type (i.e. "scatter") with the given properties
+    """
+    return {"type": type, **properties}
+
+
+def figure(data, layout=None) -> dict:
+    """Plotly figure of a list of traces
+    """
+    return {"data": data, "layout": layout or {}}
+
+
+def _default(obj):
+    # Objects orjson (or json) can't encode natively
+    if isinstance(obj, np.ndarray):
+        if np.issubdtype(obj.dtype, np.datetime64):
+            return np.datetime_as_string(obj, unit="s").tolist()
+
+        if np.issubdtype(obj.dtype, np.floating):
+            # NaN isn't valid JSON, plotly treats null as a gap
+            return np.where(np.isnan(obj), None, obj).tolist()
+
+        return obj.tolist()
+
+    if isinstance(obj, np.datetime64):
+        return np.datetime_as_string(obj, unit="s")
+
+    if isinstance(obj, np.generic):
+        return obj.item()
+
+    if hasattr(obj, "tolist"):
+        # pandas extension arrays (i.e. strings)
+        return obj.tolist()
+
+    if hasattr(obj, "isoformat"):
+        return obj.isoformat()
+
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def typed_array(array) -> dict:
+    """Plotly typed array spec of a numeric NumPy array
+
+    Integers get the smallest dtype holding their range (f8 past 32 bits),
+    datetimes are f8 milliseconds since the epoch (NaT is NaN).
+
+    @param[in] array - 1d NumPy array of numbers, booleans or datetimes
+    @return spec - dict of "dtype" and "bdata" (base64 of the little endian buffer)
+    """
+    if np.issubdtype(array.dtype, np.datetime64):
+        milliseconds = array.astype("datetime64[ms]")
+        array = np.where(np.isnat(milliseconds), np.nan, milliseconds.astype(np.int64).astype(np.float64))
+
+    if np.issubdtype(array.dtype, np.floating):
+        dtype = "f4" if array.dtype == np.float32 else "f8"
+    else:
+        low, high = (array.min(), array.max()) if len(array) else (0, 0)
+        dtype = next((kind for kind in int_dtypes if np.iinfo(kind).min <= low and high <= np.iinfo(kind).max), "f8")
+
+    return {"dtype": dtype, "bdata": base64.b64encode(array.astype(np.dtype(dtype).newbyteorder("<")).tobytes()).decode()}
+
+
+def _binary_default(obj):
+    # Numeric arrays as typed arrays, anything else as JSON
+    if isinstance(obj, np.ndarray) and obj.ndim == 1 and (obj.dtype.kind in "biuf" or np.issubdtype(obj.dtype, np.datetime64)):
+        return typed_array(obj)
+
+    return _default(obj)
+
+
+@metrics.timed
+def dumps(obj, binary=False) -> bytes:
+    """Serializes figures (or any object holding them) to JSON
+
+    @param[in] obj - dicts, lists, scalars, NumPy arrays and datetimes
+    @param[in] binary - numeric arrays as typed arrays (see typed_array)
+    @return json - UTF-8 encoded JSON
+    """
+    if binary:
+        # Without OPT_SERIALIZE_NUMPY orjson hands every array to the default hook
+        if orjson is not None:
+            return orjson.dumps(obj, default=_binary_default, option=orjson.OPT_NON_STR_KEYS)
+
+        return json.dumps(obj, default=_binary_default, separators=(",", ":")).encode()
+
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+
+    return json.dumps(obj, default=_default, separators=(",", ":")).encode()
+
+
+if __name__ == "__main__":
+    pass
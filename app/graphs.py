@@ -0,0 +1,61 @@
+"""Graph objects reused by the requests of each thread
+
+Every request used to build new graph objects, each running its metadata
+queries, and importing app.py imported every graph module (and pandas,
+pyarrow and the statistics code with them), so workers booted slowly.
+Here the graph modules are imported, and each thread's graph objects
+built, on first use. Later uses only refresh an object's defaults from
+the metadata store (a single lookup) and its data frames are dropped when
+a use ends, so nothing of a request outlives it.
+
+    with graphs.track_channels() as graph:
+        figure = graph.get_figure(antenna=antenna)
+"""
+
+import contextlib
+import importlib
+import threading
+
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def _reused(module, name):
+    graphs = getattr(_local, "graphs", None)
+
+    if graphs is None:
+        graphs = _local.graphs = {}
+
+    graph = graphs.get(name)
+
+    if graph is None:
+        graph = graphs[name] = getattr(importlib.import_module(module), name)()
+    else:
+        graph.refresh()
+
+    try:
+        yield graph
+    finally:
+        graph.reset()
+
+
+def track_channels():
+    """This thread's TrackChannels (context manager)
+    """
+    return _reused("track_channel", "TrackChannels")
+
+
+def scan_summary():
+    """This thread's ScanSummary (context manager)
+    """
+    return _reused("scan_summary", "ScanSummary")
+
+
+def channel_distribution():
+    """This thread's ChannelDistribution (context manager)
+    """
+    return _reused("channel_distribution", "ChannelDistribution")
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,168 @@
+"""Runs CPU heavy graph computations in a bounded process pool
+
+KDE fits, histograms and figure serialization hold the GIL, so one heavy
+request used to stall every other request thread of its worker. The graph
+APIs instead submit a job (a module level function returning the JSON body)
+to a pool of processes and wait for it. At most workers + queue_size
+jobs are admitted at a time, later ones are refused with Busy (429), and a
+request stops waiting after timeout seconds (TimedOut, 504). Jobs still
+queued are cancelled then, running ones finish and still count against the
+bound until they do.
+
+The pool is forked from a forkserver, a single threaded process started
+without the app's threads or sqlite connections that preloads the graph
+modules. Forking the app process itself (i.e. when the first job starts
+the pool, or a worker is replaced) copied whatever the warmer and request
+threads held: sqlite locks, a half done refresh. Workers get the app's db
+settings (and load the channel distribution cubes on their first
+distribution job, see cube.py).
+"""
+
+import concurrent.futures
+import multiprocessing
+import os
+import threading
+
+import db
+import figures
+import graphs
+import metrics
+
+# Pool processes (0 runs jobs in the calling thread, i.e. to profile or benchmark them)
+# & jobs admitted beyond them (read when the pool starts), seconds a request waits
+workers = 2
+queue_size = 8
+timeout = 30
+
+# Imported by the forkserver, so every worker starts with them
+preload = ["jobs", "track_channel", "scan_summary", "channel_distribution"]
+
+_executor = None
+_slots = None
+_lock = threading.Lock()
+
+
+class Busy(Exception):
+    """Raised when every pool slot is taken
+    """
+
+
+class TimedOut(Exception):
+    """Raised when a job didn't finish in time
+    """
+
+
+def _init_worker(busy_timeout):
+    # Runs in each pool worker before its first job
+    db.busy_timeout = busy_timeout
+
+
+def _pool():
+    global _executor, _slots
+
+    with _lock:
+        if _executor is None:
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload(preload)
+            _executor = concurrent.futures.ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker,
+                                                               initargs=(db.busy_timeout,))
+            _slots = threading.BoundedSemaphore(workers + queue_size)
+
+        return _executor, _slots
+
+
+def _restart(broken):
+    # A worker died (i.e. killed for memory), the next job starts a new pool
+    global _executor
+
+    with _lock:
+        if _executor is broken:
+            _executor = None
+
+    broken.shutdown(wait=False)
+
+
+def _reset_after_fork():
+    # Forked app workers (i.e. gunicorn --preload) start their own pool
+    global _executor, _slots, _lock
+    _executor = None
+    _slots = None
+    _lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _call(job, args, kwargs, profile):
+    # Runs in a pool worker, the job's timings (and stacks) go back to the request
+    with metrics.collect(profile) as collected:
+        result = job(*args, **kwargs)
+
+    return result, collected
+
+
+def run(job, *args, **kwargs):
+    """Runs job(*args, **kwargs) in the process pool and waits for its result
+
+    @param[in] job - module level function (pickled by name)
+    @return result - the job's return value
+    @raise Busy - when workers + queue_size jobs are pending
+    @raise TimedOut - when the job didn't finish within timeout seconds
+    """
+    if workers == 0:
+        return job(*args, **kwargs)
+
+    executor, slots = _pool()
+
+    if not slots.acquire(blocking=False):
+        raise Busy()
+
+    try:
+        future = executor.submit(_call, job, args, kwargs, metrics.profiling())
+    except concurrent.futures.process.BrokenProcessPool:
+        slots.release()
+        _restart(executor)
+        raise
+
+    future.add_done_callback(lambda future: slots.release())
+
+    try:
+        result, collected = future.result(timeout=timeout)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        raise TimedOut()
+    except concurrent.futures.process.BrokenProcessPool:
+        _restart(executor)
+        raise
+
+    metrics.merge(collected)
+    return result
+
+
+# ---- Jobs (run in pool workers, return JSON bodies) ----
+
+def track_channel(binary=False, **kwargs) -> bytes:
+    """Track Channel api body (see TrackChannels.get_figure, binary: see figures.dumps)
+    """
+    with graphs.track_channels() as graph:
+        figure = graph.get_figure(**kwargs)
+        return figures.dumps({"figure": figure, "labels": graph.labels, "annotations": graph.annotations, "times": graph.times, 
+                              "version": graph.version}, binary)
+
+
+def channel_distribution(binary=False, **kwargs) -> bytes:
+    """Channel Distribution api body (see ChannelDistribution.get_figure, binary: see figures.dumps)
+    """
+    with graphs.channel_distribution() as graph:
+        return figures.dumps(graph.get_figure(**kwargs), binary)
+
+
+def channel_distributions(binary=False, **kwargs) -> bytes:
+    """Batch Channel Distribution api body (see ChannelDistribution.get_figures, binary: see figures.dumps)
+    """
+    with graphs.channel_distribution() as graph:
+        return figures.dumps({"figures": graph.get_figures(**kwargs)}, binary)
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,190 @@
+"""Caches antenna, channel, mapping and weather metadata shared by the graphs
+"""
+
+import os
+import threading
+
+import numpy as np
+
+from db import data_version, load
+
+# Channel labels of each graph: real channel format, then (when mapped) the
+# lead & the virtual channels joined by the separator, then the suffix
+label_styles = {
+    "vertical": ("{}<br>---", "<br>", "<br>", "<br>"), # Track Channel, virtual channels sorted by number
+    "horizontal": ("{} |", "  ", "  ", ""), # Track Channel, virtual channels sorted by number
+    "distribution": ("{}: ", "", ", ", ""), # Channel Distribution, virtual channels in mapping order
+    "summary": ("{}<br>---", "<br>", "<br>", ""), # Scan Summary, virtual channel numbers in mapping order
+}
+
+
+class MetadataStore():
+    def __init__(self):
+        self.version = None # data version of the store (see db.data_version)
+        self.scan_instance = None # latest scan_instance included in the store
+        self.default_antenna = None
+        self.antenna_map = {}
+        self.virtuals = {} # real channel -> virtual channel & station strs
+
+        self._virtual_labels = {} # label style -> real channel -> joined virtual channels
+        self._labels = {} # (antenna, label style) -> real channel -> label
+
+        self._channels = {} # antenna -> real channels with snq>0
+        self._statuses = {} # antenna -> weather statuses (first seen order)
+        self._scans = {} # antenna -> (start_time, scan_instance) arrays sorted by start_time
+        self._lock = threading.Lock()
+
+        os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        # A refresh running in another thread at fork time never ends in the child
+        self._lock = threading.Lock()
+
+    @property
+    def antennas(self):
+        return list(self.antenna_map)
+
+    def _build_antenna_map(self):
+        # Keyed by antenna_instance, ids needn't be contiguous
+        antenna_df = load("SELECT * FROM antenna")
+        names = (antenna_df["antenna_instance"].astype(str) + "; Name: " + antenna_df["name"] + ", Location: " + antenna_df["location"]
+                 + ", Direction: " + antenna_df["direction"].astype(str) + " degrees, Comments: ")
+        names = names.str.replace("'", "", regex=False).str.replace("\"", "", regex=False)
+
+        self.antenna_map = {instance: {"name": name} for instance, name in zip(antenna_df["antenna_instance"].tolist(), names.tolist())}
+
+    def _build_virtuals(self):
+        """Builds the virtual channels of each real channel and their joined labels (see labels)
+        """
+        mapping = load("SELECT channel, virtual FROM mapping")
+
+        # Virtual channel float of "5.1 WXXX-1" strs (NaN when it isn't a number)
+        numbers = mapping["virtual"].str.split(n=1).str[0]
+        mapping["number"] = numbers.where(numbers.str.match(r"[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$", na=False)).astype(float)
+        ordered = mapping.sort_values(["channel", "number"], kind="mergesort")
+
+        parts = {
+            "vertical": ordered["virtual"].groupby(ordered["channel"]),
+            "horizontal": ordered["virtual"].groupby(ordered["channel"]),
+            "distribution": mapping["virtual"].groupby(mapping["channel"]),
+            "summary": mapping["number"].astype(str).groupby(mapping["channel"]),
+        }
+
+        self._virtual_labels = {style: parts[style].agg(separator.join).to_dict()
+                                for style, (form, lead, separator, suffix) in label_styles.items()}
+        self.virtuals = mapping["virtual"].groupby(mapping["channel"]).agg(list).to_dict()
+
+    def _add_scans(self, scan_instance):
+        """Adds channels and weather statuses of scans from scan_instance onwards
+        """
+        channeldf = load("""SELECT DISTINCT antenna_instance, channel FROM signal
+                            INNER JOIN scan ON signal.scan_instance = scan.scan_instance
+                            WHERE signal.scan_instance>=? AND snq>0""", scan_instance)
+
+        for antenna, channel in zip(channeldf["antenna_instance"].tolist(), channeldf["channel"].tolist()):
+            self._channels.setdefault(antenna, set()).add(channel)
+
+        statusdf = load("""SELECT DISTINCT antenna_instance, status FROM weather
+                           INNER JOIN scan ON weather.start_time = scan.start_time
+                           WHERE scan.scan_instance>=?""", scan_instance)
+
+        for antenna, status in zip(statusdf["antenna_instance"].tolist(), statusdf["status"].tolist()):
+            statuses = self._statuses.setdefault(antenna, [])
+
+            if status not in statuses:
+                statuses.append(status)
+
+    def _add_scan_times(self, scan_instance):
+        """Merges the start times of scans after scan_instance into the sorted arrays
+        """
+        scandf = load("SELECT antenna_instance, start_time, scan_instance FROM scan WHERE scan_instance>?", scan_instance)
+
+        for antenna, scans in scandf.groupby("antenna_instance"):
+            times, instances = self._scans.get(int(antenna), (np.empty(0, dtype="int64"), np.empty(0, dtype="int64")))
+            times = np.concatenate([times, scans["start_time"].values.astype("int64")])
+            instances = np.concatenate([instances, scans["scan_instance"].values.astype("int64")])
+
+            # Scans land in time order, so this sort is rarely needed
+            if np.any(times[1:] < times[:-1]):
+                order = np.argsort(times, kind="stable")
+                times, instances = times[order], instances[order]
+
+            # Replaced in one assignment, readers never see the arrays mismatched
+            self._scans[int(antenna)] = (times, instances)
+
+    def refresh(self):
+        """Brings the store up to date with the db
+
+        Costs a single data version lookup unless new scans, signal rows of
+        the latest scan or weather rows landed. Only signal and weather rows
+        of new scans are read; the latest scan seen is read again since its
+        rows can land after the scan row itself.
+        """
+        version = data_version()
+
+        with self._lock:
+            if version == self.version:
+                return
+
+            latest = load("SELECT COALESCE(MAX(scan_instance), 0) AS latest FROM scan")["latest"].tolist()[0]
+
+            self.default_antenna = load("SELECT configured_antenna_instance FROM monitor")["configured_antenna_instance"].to_list()[0]
+            self._build_antenna_map()
+            self._build_virtuals()
+            self._add_scans(self.scan_instance or 0)
+            self._add_scan_times(self.scan_instance or 0)
+            self._labels = {}
+            self.scan_instance = latest
+            self.version = version
+
+    def channels(self, antenna):
+        """Real channels of an antenna, in descending order
+        """
+        return sorted(self._channels.get(antenna, ()), reverse=True)
+
+    def scan_times(self, antenna):
+        """Start times (unix timestamps) & scan instances of an antenna's scans, sorted by start time
+        """
+        return self._scans.get(antenna, (np.empty(0, dtype="int64"), np.empty(0, dtype="int64")))
+
+    def _label(self, channel, style):
+        form, lead, separator, suffix = label_styles[style]
+        virtuals = self._virtual_labels[style].get(channel)
+
+        return form.format(channel) + (lead + virtuals if virtuals is not None else "") + suffix
+
+    def labels(self, antenna, style, channels=None):
+        """Graph labels of real channels with their virtual channels
+
+        Virtual channels are joined once per refresh and each antenna's
+        labels are memoized until new scans land.
+
+        @param[in] antenna - antenna instance
+        @param[in] style - "vertical" or "horizontal" (Track Channel), "distribution" or "summary" (see label_styles)
+        @param[in] channels - list of real channels (default all of the antenna's)
+        @return labels - dict of real channel -> label str, in channels order
+        """
+        key = (antenna, style)
+        labels = self._labels.get(key)
+
+        if labels is None:
+            labels = self._labels[key] = {channel: self._label(channel, style) for channel in self.channels(antenna)}
+
+        if channels is None:
+            return labels
+
+        return {channel: labels[channel] if channel in labels else self._label(channel, style) for channel in channels}
+
+    def virtual_channels(self, channel):
+        """Virtual channel & station strs mapped to a real channel
+        """
+        return self.virtuals.get(channel, [])
+
+    def weather_statuses(self, antenna):
+        return list(self._statuses.get(antenna, []))
+
+
+store = MetadataStore()
+
+if __name__ == "__main__":
+    pass
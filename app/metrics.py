@@ -0,0 +1,325 @@
+"""Request timing, hot path instrumentation and an opt-in sampling profiler
+
+Timed stages (graph methods decorated with timed, db.load queries and
+response cache lookups) are recorded as events of the current request, or
+of the current job in a pool worker, which hands them back to the request.
+When the request ends they are added to the process' Prometheus metrics
+(served by /metrics) and summed into its Server-Timing header.
+
+With profile_threshold set, the stacks of request threads (and of the pool
+workers running their jobs) are sampled every interval seconds, and requests
+slower than the threshold dump them in folded format (one "a;b;c count"
+line per stack, for flamegraph.pl or speedscope) to profile_dir.
+"""
+
+import collections
+import contextlib
+import functools
+import os
+import sys
+import threading
+import time
+
+# Seconds a request takes before its sampled stacks are dumped (None disables sampling)
+profile_threshold = None
+profile_dir = "profiles"
+
+buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf"))
+
+_local = threading.local()
+_lock = threading.Lock()
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace("\"", "\\\"")
+
+
+class Counter():
+    """Prometheus counter with labels
+    """
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = collections.defaultdict(float) # label values -> count
+
+    def inc(self, amount, *labels):
+        labels = tuple(str(label) for label in labels)
+
+        with _lock:
+            self.values[labels] += amount
+
+    def lines(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+
+        for labels, value in sorted(self.values.items()):
+            pairs = ",".join(f"{name}=\"{_escape(label)}\"" for name, label in zip(self.labels, labels))
+            lines.append(f"{self.name}{{{pairs}}} {value:g}")
+
+        return lines
+
+
+class Histogram():
+    """Prometheus histogram (cumulative buckets, sum & count) with labels
+    """
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {} # label values -> [bucket counts, sum]
+
+    def observe(self, value, *labels):
+        labels = tuple(str(label) for label in labels)
+
+        with _lock:
+            counts, total = self.values.get(labels, ([0] * len(buckets), 0))
+            self.values[labels] = ([count + (value <= bound) for count, bound in zip(counts, buckets)], total + value)
+
+    def lines(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+
+        for labels, (counts, total) in sorted(self.values.items()):
+            pairs = "".join(f"{name}=\"{_escape(label)}\"," for name, label in zip(self.labels, labels))
+
+            for bound, count in zip(buckets, counts):
+                lines.append(f"{self.name}_bucket{{{pairs}le=\"{'+Inf' if bound == float('inf') else bound}\"}} {count}")
+
+            lines.append(f"{self.name}_sum{{{pairs.rstrip(',')}}} {total:g}")
+            lines.append(f"{self.name}_count{{{pairs.rstrip(',')}}} {counts[-1]}")
+
+        return lines
+
+
+request_seconds = Histogram("airwaves_request_seconds", "Request duration by endpoint and status", ("endpoint", "status"))
+stage_seconds = Histogram("airwaves_stage_seconds", "Duration of timed graph stages", ("stage",))
+query_seconds = Histogram("airwaves_db_query_seconds", "Duration of db.load queries", ("query",))
+query_rows = Counter("airwaves_db_rows_total", "Rows returned by db.load queries", ("query",))
+cache_lookups = Counter("airwaves_cache_lookups_total", "Response cache lookups by result", ("result",))
+
+
+class Sampler():
+    """Samples the stacks of registered threads from a daemon thread
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._stacks = {} # thread id -> Counter of folded stacks
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self, thread_id):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Also after fork, which only keeps the forking thread
+                self._pid = os.getpid()
+                self._stacks = {}
+                threading.Thread(target=self._run, name="sampler", daemon=True).start()
+
+            self._stacks[thread_id] = collections.Counter()
+
+    def stop(self, thread_id) -> collections.Counter:
+        with self._lock:
+            return self._stacks.pop(thread_id, collections.Counter())
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+
+            with self._lock:
+                for thread_id, stacks in self._stacks.items():
+                    if thread_id in frames:
+                        stacks[_fold(frames[thread_id])] += 1
+
+
+def _fold(frame) -> str:
+    # Root to leaf frames joined by ";"
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+
+    return ";".join(reversed(names))
+
+
+sampler = Sampler()
+
+
+def _reset_after_fork():
+    global _lock
+    _lock = threading.Lock()
+    sampler._lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _publish(kind, event):
+    if kind == "stage":
+        stage_seconds.observe(event[1], event[0])
+    elif kind == "query":
+        query_seconds.observe(event[1], event[0])
+        query_rows.inc(event[2], event[0])
+    elif kind == "cache":
+        cache_lookups.inc(1, "hit" if event[0] else "miss")
+
+
+def _record(kind, *event):
+    # Events of a request (or job) are published when it ends
+    events = getattr(_local, "events", None)
+
+    if events is None:
+        _publish(kind, event)
+    else:
+        events.append((kind, event))
+
+
+def timed(function):
+    """Decorator recording the duration of each call as a stage
+
+    Stages are named Class.method, or module.function for functions.
+    """
+    name = function.__qualname__ if "." in function.__qualname__ else f"{function.__module__}.{function.__qualname__}"
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _record("stage", name, time.perf_counter() - start)
+
+    return wrapper
+
+
+def query(query, seconds, rows):
+    """Records a db query
+    """
+    _record("query", " ".join(query.split())[:160], seconds, rows)
+
+
+def cache_lookup(hit):
+    """Records a response cache lookup
+    """
+    _record("cache", hit)
+
+
+def profiling() -> bool:
+    """Whether the current request's stacks are sampled
+    """
+    return getattr(_local, "sampled", False)
+
+
+@contextlib.contextmanager
+def collect(profile=False):
+    """Collects the events (and sampled stacks) of a job run in a pool worker
+
+    @param[in] profile - sample the stacks of the current thread
+    @return collected - dict of "events" and "stacks", filled when the block exits
+    """
+    collected = {"events": [], "stacks": collections.Counter()}
+    _local.events = collected["events"]
+
+    if profile:
+        sampler.start(threading.get_ident())
+
+    try:
+        yield collected
+    finally:
+        _local.events = None
+
+        if profile:
+            collected["stacks"] = sampler.stop(threading.get_ident())
+
+
+def merge(collected):
+    """Adds the events and stacks of a job to the current request
+    """
+    for kind, event in collected["events"]:
+        _record(kind, *event)
+
+    if profiling():
+        _local.stacks.update(collected["stacks"])
+
+
+def begin():
+    """Starts recording the current request
+    """
+    _local.start = time.perf_counter()
+    _local.events = []
+    _local.sampled = profile_threshold is not None
+    _local.stacks = collections.Counter()
+
+    if _local.sampled:
+        sampler.start(threading.get_ident())
+
+
+def end(endpoint, status) -> str:
+    """Publishes the current request's metrics, dumps its stacks when it was slow
+
+    @param[in] endpoint - name of the request's view
+    @param[in] status - response status code
+    @return header - Server-Timing header value
+    """
+    if getattr(_local, "events", None) is None:
+        return ""
+
+    seconds = time.perf_counter() - _local.start
+    events, _local.events = _local.events, None
+
+    stages = collections.OrderedDict()
+    rows = 0
+    cache = None
+
+    for kind, event in events:
+        _publish(kind, event)
+
+        if kind == "stage":
+            stages[event[0]] = stages.get(event[0], 0) + event[1]
+        elif kind == "query":
+            stages["db.load"] = stages.get("db.load", 0) + event[1]
+            rows += event[2]
+        elif kind == "cache":
+            cache = "hit" if event[0] else "miss"
+
+    request_seconds.observe(seconds, endpoint, status)
+
+    if _local.sampled:
+        _local.sampled = False
+        stacks = _local.stacks + sampler.stop(threading.get_ident())
+
+        if seconds >= profile_threshold and stacks:
+            _dump(stacks, endpoint, seconds)
+
+    timings = [f"{name};dur={duration * 1000:.1f}" for name, duration in stages.items()]
+
+    if "db.load" in stages:
+        timings[list(stages).index("db.load")] += f";desc=\"{rows} rows\""
+
+    if cache is not None:
+        timings.append(f"cache;desc={cache}")
+
+    return ", ".join(timings + [f"total;dur={seconds * 1000:.1f}"])
+
+
+def _dump(stacks, endpoint, seconds):
+    os.makedirs(profile_dir, exist_ok=True)
+    path = os.path.join(profile_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{endpoint}-{int(seconds * 1000)}ms.folded")
+
+    with open(path, "w") as profile:
+        profile.writelines(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def exposition() -> str:
+    """All metrics of this process in the Prometheus text format
+    """
+    lines = []
+
+    for metric in (request_seconds, stage_seconds, query_seconds, query_rows, cache_lookups):
+        lines.extend(metric.lines())
+
+    return "\n".join(lines) + "\n"
+
+
+if __name__ == "__main__":
+    pass
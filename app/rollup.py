@@ -0,0 +1,280 @@
+"""Hourly and daily rollups of the signal measurements of each antenna & channel
+
+Long range graphs used to read every raw signal row. refresh (run by the
+cache warmer, or from cron: python rollup.py) maintains, in rollup.db,
+per antenna, channel and hour (hourly) or local day (daily):
+
+    scans - scans that measured the channel
+    {measurement}_min, _max, _sum - over those scans (the mean is _sum / scans)
+    {measurement}_values, _counts - histogram of the joined signal & weather
+                                    rows (as ChannelDistribution counts them),
+                                    distinct values (uint8) & their counts (uint32)
+
+Rows are split by whether the scan has weather, since distribution date
+ranges filter on weather.start_time. Each refresh recomputes the local days
+touched by scans after the sealed one, so only new rows are read. Weather
+rows that land after their day was rolled up need a rebuild (delete
+rollup.db). The graphs only use rollups matching the db's data version.
+"""
+
+import contextlib
+import fcntl
+import os
+import sqlite3 as sql
+
+import numpy as np
+import pandas as pd
+
+from db import data_version, in_use, load, path_to_db
+
+rollup_path = "rollup.db"
+
+signal_measurements = ["snq", "ss", "seq"]
+
+# Seconds of each rollup period, coarsest first
+periods = {"daily": 86400, "hourly": 3600}
+
+# Days are local (GMT-04:00), local midnight is 04:00 UTC
+day_offset = 4 * 3600
+
+# Days of rows aggregated at a time by a refresh
+window_days = 30
+
+schema = "\n".join(f"""
+CREATE TABLE IF NOT EXISTS {table} (antenna_instance INTEGER, channel INTEGER, period INTEGER, weather INTEGER, scans INTEGER,
+    {", ".join(f"{m}_min INTEGER, {m}_max INTEGER, {m}_sum INTEGER, {m}_values BLOB, {m}_counts BLOB" for m in signal_measurements)},
+    PRIMARY KEY (antenna_instance, channel, period, weather)) WITHOUT ROWID;""" for table in periods) + """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+"""
+
+
+def period_start(times, table):
+    """Start of the rollup period holding each unix timestamp
+    """
+    if table == "daily":
+        return (times - day_offset) // periods[table] * periods[table] + day_offset
+
+    return times // periods[table] * periods[table]
+
+
+@contextlib.contextmanager
+def _exclusive(path):
+    # Only one refresh at a time across processes
+    with open(path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _meta(conn) -> dict:
+    return dict(conn.execute("SELECT key, value FROM meta"))
+
+
+def _aggregate(df, table) -> list:
+    """Rollup rows of the joined rows of whole periods
+    """
+    df = df.assign(period=period_start(df["scan_time"].values, table), weather=df["start_time"].notna().astype(np.int64))
+    keys = ["antenna_instance", "channel", "period", "weather"]
+
+    # Min, max & sum over scans (weather rows of a scan repeat its signal rows)
+    stats = df.drop_duplicates(subset=["scan_instance", "channel"]).groupby(keys).agg(
+        scans=("scan_instance", "size"), **{f"{m}_{how}": (m, how) for m in signal_measurements for how in ["min", "max", "sum"]})
+
+    # Histograms over every joined row, in the same (sorted) group order
+    groups = df.groupby(keys).ngroup().values
+    columns = [stats.index.get_level_values(key).tolist() for key in keys]
+    columns += [stats["scans"].tolist()]
+
+    for m in signal_measurements:
+        # Distinct (group, value) pairs sorted by group, sliced into each group's blobs
+        pairs, counts = np.unique(groups * 256 + np.clip(df[m].values, 0, 255), return_counts=True)
+        bounds = np.searchsorted(pairs // 256, np.arange(len(stats) + 1)).tolist()
+        values = (pairs % 256).astype(np.uint8).tobytes()
+        counts = counts.astype(np.uint32).tobytes()
+
+        columns += [stats[f"{m}_min"].tolist(), stats[f"{m}_max"].tolist(), stats[f"{m}_sum"].tolist(),
+                    [values[first:last] for first, last in zip(bounds, bounds[1:])],
+                    [counts[first * 4:last * 4] for first, last in zip(bounds, bounds[1:])]]
+
+    return list(zip(*columns))
+
+
+def refresh(path=path_to_db, rollup=rollup_path) -> bool:
+    """Rolls up the scans that landed since the last refresh
+
+    @param[in] path - path to database
+    @param[in] rollup - path to rollup database
+    @return refreshed - False when the rollups were already up to date
+    """
+    with _exclusive(rollup):
+        conn = sql.connect(rollup)
+
+        try:
+            with in_use():
+                conn.execute("PRAGMA journal_mode=WAL") # readers keep reading while a refresh writes
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.executescript(schema)
+                meta = _meta(conn)
+
+            version = data_version(path)
+
+            if meta.get("version") == version:
+                return False
+
+            sealed = meta.get("sealed", 0)
+            first, last, latest = load("SELECT MIN(start_time) AS first, MAX(start_time) AS last, MAX(scan_instance) AS latest "
+                                       "FROM scan WHERE scan_instance>?", sealed, path=path).iloc[0].tolist()
+
+            if latest is not None:
+                # Whole local days from the earliest new scan on are recomputed
+                start = int(period_start(int(first), "daily"))
+
+                while start <= last:
+                    end = start + window_days * periods["daily"]
+                    df = load("""SELECT signal.scan_instance, signal.channel, signal.ss, signal.snq, signal.seq,
+                              scan.antenna_instance, scan.start_time AS scan_time, weather.start_time
+                              FROM signal INNER JOIN scan ON signal.scan_instance = scan.scan_instance
+                              LEFT JOIN weather ON scan.start_time = weather.start_time
+                              WHERE scan.start_time>=? AND scan.start_time<?""", start, end, path=path)
+                    rows = {table: _aggregate(df, table) if len(df) else [] for table in periods}
+
+                    # Committed window by window, the rollups are only read once meta has the new version
+                    with in_use():
+                        for table in periods:
+                            conn.execute(f"DELETE FROM {table} WHERE period>=? AND period<?", (start, end))
+                            conn.executemany(f"INSERT INTO {table} VALUES ({', '.join('?' * (5 + 5 * len(signal_measurements)))})",
+                                             rows[table])
+
+                        conn.commit()
+
+                    start = end
+
+                # Rows of the latest scan can still land, so its day is recomputed next time
+                sealed = max(int(latest) - 1, sealed)
+
+            with in_use():
+                conn.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                                 [("version", version), ("sealed", sealed), ("scan_instance", int(latest or sealed))])
+                conn.commit()
+        finally:
+            conn.close()
+
+    return True
+
+
+def current(rollup=rollup_path):
+    """Latest scan_instance rolled up, or None unless the rollups match the db's data version
+    """
+    if not os.path.exists(rollup):
+        return None
+
+    try:
+        meta = dict(load("SELECT key, value FROM meta", path=rollup).values.tolist())
+    except (sql.Error, pd.io.sql.DatabaseError):
+        return None
+
+    if meta.get("version") != data_version():
+        return None
+
+    return int(meta["scan_instance"])
+
+
+def choose(span, points):
+    """Coarsest rollup with at least points periods in span seconds, None when only raw scans are fine enough
+    """
+    for table, seconds in periods.items():
+        if span / seconds >= points:
+            return table
+
+    return None
+
+
+def trends(antenna, channels, measurements, table, start=None, end=None, rollup=rollup_path) -> pd.DataFrame:
+    """Mean of each measurement & channel per period, one row per period
+
+    @param[in] antenna - antenna instance
+    @param[in] channels - list of real channels
+    @param[in] measurements - list of signal measurements
+    @param[in] table - "hourly" or "daily"
+    @param[in] start, end - unix timestamps of the first and last periods
+    @return df - pandas data frame of period and {measurement}{channel} columns
+    """
+    conditions = "".join([" AND period>=?" if start is not None else "", " AND period<=?" if end is not None else ""])
+    df = load(f"""SELECT period, channel, SUM(scans) AS scans, {", ".join(f"SUM({m}_sum) AS {m}" for m in measurements)}
+              FROM {table} WHERE antenna_instance=? AND channel IN ({", ".join("?" for channel in channels)}){conditions}
+              GROUP BY period, channel""", antenna, *channels, *[bound for bound in (start, end) if bound is not None], path=rollup)
+
+    for m in measurements:
+        df[m] = df[m] / df["scans"]
+
+    wide = df.pivot(index="period", columns="channel", values=measurements)
+    wide.columns = [f"{measurement}{channel}" for measurement, channel in wide.columns]
+    return wide.reindex(columns=[f"{m}{channel}" for m in measurements for channel in channels]).reset_index()
+
+
+def spans(start, end):
+    """Splits the inclusive time range [start, end] into whole days, whole hours and raw remainders
+
+    @return periods - list of (table, first, stop) periods first <= period < stop
+    @return raw - list of (first, last) inclusive ranges shorter than an hour
+    """
+    hours = (-(-start // periods["hourly"]) * periods["hourly"], (end + 1) // periods["hourly"] * periods["hourly"])
+
+    if hours[0] >= hours[1]:
+        return [], [(start, end)]
+
+    days = (int(period_start(hours[0] + periods["daily"] - 1, "daily")), int(period_start(hours[1], "daily")))
+    whole = []
+
+    if days[0] < days[1]:
+        whole = [("hourly", hours[0], days[0]), ("daily", days[0], days[1]), ("hourly", days[1], hours[1])]
+    else:
+        whole = [("hourly", hours[0], hours[1])]
+
+    raw = [(first, last) for first, last in [(start, hours[0] - 1), (hours[1], end)] if first <= last]
+    return [(table, first, stop) for table, first, stop in whole if first < stop], raw
+
+
+def histograms(antenna, channels, start=None, end=None, rollup=rollup_path):
+    """Counts of each measurement value of channels over a time range
+
+    Without a range every joined row counts, with one only rows with
+    weather in it count (as with a daterange filter). Parts of the range
+    that aren't whole hours are returned for the caller to count.
+
+    @param[in] antenna - antenna instance
+    @param[in] channels - list of real channels
+    @param[in] start, end - inclusive range of weather start times (unix timestamps)
+    @return counts - dict of channel -> measurement -> counts (1d array, indexed by value)
+    @return raw - list of (first, last) inclusive ranges left to count from raw rows
+    """
+    raw = []
+
+    if start is None and end is None:
+        parts = [("daily", "")]
+        args = [[]]
+    else:
+        whole, raw = spans(start if start is not None else 0, end if end is not None else 2 ** 40)
+        parts = [(table, " AND weather=1 AND period>=? AND period<?") for table, first, stop in whole]
+        args = [[first, stop] for table, first, stop in whole]
+
+    counts = {channel: {m: np.zeros(256) for m in signal_measurements} for channel in channels}
+    placeholders = ", ".join("?" for channel in channels)
+
+    for (table, conditions), bounds in zip(parts, args):
+        df = load(f"""SELECT channel, {", ".join(f"{m}_values, {m}_counts" for m in signal_measurements)} FROM {table}
+                  WHERE antenna_instance=? AND channel IN ({placeholders}){conditions}""", antenna, *channels, *bounds, path=rollup)
+
+        for channel, rows in df.groupby("channel"):
+            for m in signal_measurements:
+                values = np.frombuffer(b"".join(rows[f"{m}_values"].tolist()), dtype=np.uint8)
+                weights = np.frombuffer(b"".join(rows[f"{m}_counts"].tolist()), dtype=np.uint32)
+                counts[int(channel)][m] += np.bincount(values, weights=weights, minlength=256)
+
+    return counts, raw
+
+
+if __name__ == "__main__":
+    print("Refreshed" if refresh() else "Up to date")
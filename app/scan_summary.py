@@ -1,98 +1,143 @@
 """Graphs channel signal measurements for a given scan
 """
 
-import pandas as pd
-import plotly
-import plotly.graph_objects as go
+import time
 
+import numpy as np
+
+import figures
+import metrics
 from db import load
+from metadata import store
+
+
+def nearest_scan(scantime, antenna):
+    """Scan of an antenna closest to scantime
+
+    Bisects the antenna's sorted scan start times kept by the metadata
+    store, the earlier scan wins a tie.
+
+    @param[in] scantime - unix timestamp (default now)
+    @param[in] antenna - antenna instance
+    @return scan - (scan_instance, start_time) or None when the antenna has no scans
+    """
+    try:
+        # Sets default and acts as an extra layer of sanitization
+        scantime = int(scantime)
+    except TypeError:
+        scantime = int(time.time())
+
+    store.refresh()
+    times, instances = store.scan_times(antenna)
+
+    if not len(times):
+        return None
+
+    # times[i - 1] <= scantime < times[i]
+    i = int(np.searchsorted(times, scantime, side="right"))
+
+    if i == len(times) or i > 0 and scantime - times[i - 1] <= times[i] - scantime:
+        i -= 1
+
+    return int(instances[i]), int(times[i])
 
 
 class ScanSummary():
     def __init__(self):
+        self.refresh()
+
+    def refresh(self):
+        """Brings the defaults up to date with the metadata store and clears the last figure (see graphs.py)
+        """
+        store.refresh()
+        self.default_antenna = store.default_antenna
+        self.antenna_map = store.antenna_map
+
+        self.reset()
+
+    def reset(self):
+        """Drops the state of the last figure
+        """
         # default scan is latest scan
         self.scan = None
         self.labels = None
+        self.fig = figures.figure([])
+        self.start_time = None
+        self.df = None
+        self.real_channels = None
 
-        self.default_antenna = load("SELECT configured_antenna_instance FROM monitor")["configured_antenna_instance"].to_list()[0]
-        antenna_df = load("SELECT * FROM antenna")
-        self.antenna_map = {instance: {"name": str(instance) + "; " + "Name: " + name + ", Location: " + location + ", Direction: " + str(direction) + " degrees, Comments: "}
-                            for instance, name, location, direction, comment in zip(antenna_df["antenna_instance"], antenna_df["name"], antenna_df["location"], 
-                            antenna_df["direction"], antenna_df["comment"])}
-
-        # Remove quotations
-        for i, description in enumerate(self.antenna_map.values()):
-            if "'" in self.antenna_map[i + 1]["name"]:
-                self.antenna_map[i + 1]["name"] = self.antenna_map[i + 1]["name"].replace("'", "")
-            
-            if "\"" in self.antenna_map[i + 1]["name"]:
-                self.antenna_map[i + 1]["name"] = self.antenna_map[i + 1]["name"].replace("\"", "")
-
+    @metrics.timed
     def _build_df(self):
         self.df = load(f"SELECT * FROM signal WHERE scan_instance={self.scan} AND snq>0")
         self.real_channels = self.df["channel"].values.tolist()
 
+    @metrics.timed
     def _build_labels(self, antenna):
-        """Builds graph labels with real and virtual channel numbers
+        """Builds graph labels with real and virtual channel numbers (see MetadataStore.labels)
         """
-        self.labels = [str(channel) + "<br>---" for channel in self.real_channels]
-        self.mapping = load("""SELECT channel, virtual FROM mapping 
-                                WHERE channel IN (SELECT DISTINCT channel 
-                                FROM signal INNER JOIN scan ON signal.scan_instance
-                                 = scan.scan_instance WHERE antenna_instance=? 
-                                AND snq>0)""", antenna)
-
-        # Converting virtual channel & station name str to sorted virtual channel float
-        self.mapping["virtual"] = pd.Series([float(virtual[0]) for virtual in self.mapping["virtual"].str.split().to_list()])
-
-        for real, virtual in zip(self.mapping["channel"].values, self.mapping["virtual"].values):
-            if real in self.real_channels:
-                i = self.real_channels.index(real)
-                self.labels[i] += "<br>" + str(virtual)
+        labels = store.labels(antenna, "summary", self.real_channels)
+        self.labels = [labels[channel] for channel in self.real_channels]
 
+    @metrics.timed
     def _graph(self):
-        self.fig = go.Figure(data=[
-            go.Bar(name="snq", x=self.labels, y=self.df["snq"], marker={"line": {"color": "black", "width": 1.5}}),
-            go.Bar(name="ss", x=self.labels, y=self.df["ss"], marker={"line": {"color": "black", "width": 1.5}}),
-            go.Bar(name="seq", x=self.labels, y=self.df["seq"], marker={"line": {"color": "black", "width": 1.5}}),
+        self.fig = figures.figure([
+            figures.trace("bar", name="snq", x=self.labels, y=self.df["snq"].values, marker={"line": {"color": "black", "width": 1.5}}),
+            figures.trace("bar", name="ss", x=self.labels, y=self.df["ss"].values, marker={"line": {"color": "black", "width": 1.5}}),
+            figures.trace("bar", name="seq", x=self.labels, y=self.df["seq"].values, marker={"line": {"color": "black", "width": 1.5}}),
         ])
 
-    def get_json(self, scantime=None, antenna=None):
-        existing_antennas = load("SELECT antenna_instance FROM antenna")["antenna_instance"].tolist()
-
-        if antenna not in existing_antennas:
+    def get_figure(self, scantime=None, antenna=None):
+        """Figure (dict) of the scan closest to scantime
+        """
+        if antenna not in store.antennas:
             # return figure rendered for last antenna
-            return plotly.io.to_json(self.fig)
+            return self.fig
 
-        try:
-            # Sets default and acts as an extra layer of sanitization
-            int(scantime)
-        except TypeError:
-            scantime = "SELECT strftime('%s', 'now')"
+        scan = nearest_scan(scantime, antenna)
 
-        df = load("""SELECT * FROM scan WHERE antenna_instance=?
-                     ORDER BY ABS(start_time - (?)) LIMIT 1;""", 
-                     antenna , scantime)[["scan_instance", "start_time"]]
+        if scan is None:
+            return self.fig
 
-        self.scan = df["scan_instance"].values.tolist()[0]
-        self.start_time = df["start_time"].values.tolist()[0] * 1000 # convert from seconds to miliseconds
+        self.scan, self.start_time = scan
+        self.start_time = self.start_time * 1000 # convert from seconds to miliseconds
 
         self._build_df()
         self._build_labels(antenna)
         self._graph()
-        return plotly.io.to_json(self.fig)
+        return self.fig
+
+    @metrics.timed
+    def get_json(self, scantime=None, antenna=None):
+        return figures.dumps(self.get_figure(scantime, antenna)).decode()
 
     def get_antenna_range(self, antenna=None):
-        existing_antennas = load("SELECT antenna_instance FROM antenna")["antenna_instance"].tolist()
+        times = store.scan_times(antenna)[0]
 
-        if antenna not in existing_antennas:
+        if antenna not in store.antennas or not len(times):
             return
 
         return {
             # Factor of 1000 used to convert from seconds to miliseconds
-            "start": load("SELECT * FROM scan WHERE antenna_instance=? ORDER BY scan_instance ASC LIMIT 1", antenna)["start_time"].values.tolist()[0] * 1000, 
-            "end": load("SELECT * FROM scan WHERE antenna_instance=? ORDER BY scan_instance DESC LIMIT 1", antenna)["start_time"].values.tolist()[0] * 1000
+            "start": int(times[0]) * 1000, 
+            "end": int(times[-1]) * 1000
         }
 
+    def get_timeline(self, antenna=None):
+        """Start times of every scan of an antenna, for the date picker to snap to
+
+        Delta encoded (scans are usually a fixed interval apart, so most
+        deltas repeat): the times are start followed by the cumulative sums
+        of deltas.
+
+        @param[in] antenna - antenna instance
+        @return timeline - dict of "start" (unix timestamp) and "deltas" (seconds), or None
+        """
+        times = store.scan_times(antenna)[0]
+
+        if antenna not in store.antennas or not len(times):
+            return
+
+        return {"start": int(times[0]), "deltas": np.diff(times)}
+
 if __name__ == "__main__":
     pass
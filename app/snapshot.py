@@ -0,0 +1,256 @@
+"""Columnar snapshot of the signal, scan and weather join
+
+The graphs all filter the same signal JOIN scan LEFT JOIN weather rows.
+refresh (run it after each scan, i.e. from cron: python snapshot.py)
+exports them to Arrow IPC files partitioned by antenna, which query reads
+memory mapped and filters with vectorized predicates instead of a SQL
+round trip through pd.read_sql_query.
+
+    snapshot/manifest.json - data version & files of each antenna
+    snapshot/antenna=1/000000001-000000420.arrow - sealed scans (append-only)
+    snapshot/antenna=1/tail-000000421-31.arrow - latest scan (rewritten)
+
+Rows of the latest scan can still land, so it lives in a tail file until
+a newer scan seals it (weather rows that land after their scan is sealed
+need a rebuild: delete the directory and refresh). pyarrow is optional: without it (or while the
+snapshot is behind the db) query returns None and the graphs use SQL.
+"""
+
+import contextlib
+import fcntl
+import json
+import os
+import threading
+
+from db import data_version, load, path_to_db
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.fs
+    import pyarrow.ipc
+except ImportError:
+    pa = None
+
+snapshot_dir = "snapshot"
+
+# Sealed part files kept per antenna before they are merged into one
+max_parts = 16
+
+columns = [
+    ("scan_instance", "int64"), ("channel", "int64"), ("ss", "int64"), ("snq", "int64"), ("seq", "int64"),
+    ("antenna_instance", "int64"), ("scan_time", "int64"), # scan.start_time
+    ("start_time", "int64"), ("hour_of_day", "int64"), ("reference_time", "int64"), # weather.start_time ...
+    ("status", "string"), ("temperature", "float64"), ("wind_direction", "int64"), ("wind_speed", "float64"),
+    ("humidity", "int64"), ("sunset", "int64"),
+]
+
+_datasets = {} # (directory, antenna) -> (files, memory mapped dataset)
+_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    # The lock may have been held by another thread when the process forked
+    global _lock
+    _lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _schema():
+    return pa.schema([(name, pa.string() if kind == "string" else pa.type_for_alias(kind)) for name, kind in columns])
+
+
+def _manifest(directory):
+    try:
+        with open(os.path.join(directory, "manifest.json")) as manifest:
+            return json.load(manifest)
+    except (OSError, ValueError):
+        return {"version": None, "sealed": 0, "parts": {}, "tails": {}}
+
+
+def _write_table(table, path):
+    with pa.OSFile(path + ".tmp", "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+    os.replace(path + ".tmp", path)
+
+
+@contextlib.contextmanager
+def _exclusive(directory):
+    # Only one refresh at a time across processes
+    os.makedirs(directory, exist_ok=True)
+
+    with open(os.path.join(directory, ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _compact(directory, antenna, parts):
+    # Merges an antenna's sealed parts (open readers keep their mapped files)
+    tables = [pa.ipc.open_file(pa.memory_map(os.path.join(directory, part))).read_all() for part in parts]
+    first = os.path.basename(parts[0]).split("-")[0]
+    last = os.path.splitext(os.path.basename(parts[-1]))[0].split("-")[1]
+    merged = f"antenna={antenna}/{first}-{last}.arrow"
+
+    _write_table(pa.concat_tables(tables), os.path.join(directory, merged))
+    return merged
+
+
+def rows(scan_instance=0, path=path_to_db, last=None, antenna=None):
+    """Joined rows (snapshot columns) of scans after scan_instance, read from the db
+
+    @param[in] scan_instance - rows of later scans are returned
+    @param[in] path - path to database
+    @param[in] last - rows of later scans than last aren't returned (None for every later scan)
+    @param[in] antenna - only rows of this antenna instance are returned (None for every antenna)
+    @return df - pandas data frame
+    """
+    conditions = "".join([" AND signal.scan_instance<=?" if last is not None else "", " AND scan.antenna_instance=?" if antenna is not None else ""])
+    args = [value for value in (last, antenna) if value is not None]
+
+    return load(f"""SELECT signal.scan_instance, signal.channel, signal.ss, signal.snq, signal.seq,
+                scan.antenna_instance, scan.start_time AS scan_time, weather.start_time,
+                weather.start_time - strftime('%s', weather.start_time, "unixepoch", "start of day")
+                AS hour_of_day, weather.reference_time, weather.status, weather.temperature,
+                weather.wind_direction, weather.wind_speed, weather.humidity, weather.sunset
+                FROM signal INNER JOIN scan ON signal.scan_instance = scan.scan_instance
+                LEFT JOIN weather ON scan.start_time = weather.start_time
+                WHERE signal.scan_instance>?{conditions}""", scan_instance, *args, path=path)
+
+
+def refresh(path=path_to_db, directory=snapshot_dir) -> bool:
+    """Appends scans that landed since the last refresh to the snapshot
+
+    @param[in] path - path to database
+    @param[in] directory - snapshot directory
+    @return refreshed - False when the snapshot was already up to date
+    """
+    if pa is None:
+        return False
+
+    with _exclusive(directory):
+        manifest = _manifest(directory)
+        version = data_version(path)
+
+        if manifest["version"] == version:
+            return False
+
+        df = rows(manifest["sealed"], path)
+
+        latest = int(df["scan_instance"].max()) if len(df) else manifest["sealed"]
+        parts = manifest["parts"]
+        tails = {}
+        stale = list(manifest["tails"].values())
+
+        for antenna, group in df.groupby("antenna_instance"):
+            antenna = str(antenna)
+            os.makedirs(os.path.join(directory, f"antenna={antenna}"), exist_ok=True)
+            sealed = group[group["scan_instance"] < latest]
+            tail = group[group["scan_instance"] == latest]
+
+            if len(sealed):
+                part = f"antenna={antenna}/{sealed['scan_instance'].min():09d}-{sealed['scan_instance'].max():09d}.arrow"
+                _write_table(pa.Table.from_pandas(sealed, schema=_schema(), preserve_index=False), os.path.join(directory, part))
+                parts.setdefault(antenna, []).append(part)
+
+                if len(parts[antenna]) > max_parts:
+                    stale.extend(parts[antenna])
+                    parts[antenna] = [_compact(directory, antenna, parts[antenna])]
+
+            if len(tail):
+                tails[antenna] = f"antenna={antenna}/tail-{latest:09d}-{len(tail)}.arrow"
+                _write_table(pa.Table.from_pandas(tail, schema=_schema(), preserve_index=False), os.path.join(directory, tails[antenna]))
+
+        manifest = {"version": version, "sealed": max(latest - 1, manifest["sealed"]), "parts": parts, "tails": tails}
+
+        with open(os.path.join(directory, "manifest.json.tmp"), "w") as tmp:
+            json.dump(manifest, tmp)
+
+        os.replace(os.path.join(directory, "manifest.json.tmp"), os.path.join(directory, "manifest.json"))
+
+        for name in set(stale) - set(tails.values()):
+            with contextlib.suppress(OSError):
+                os.remove(os.path.join(directory, name))
+
+    return True
+
+
+def _dataset(antenna, directory):
+    # Memory mapped dataset of an antenna's files, None when the snapshot is stale
+    manifest = _manifest(directory)
+
+    if manifest["version"] is None or manifest["version"] != data_version():
+        return None
+
+    antenna = str(antenna)
+    files = tuple(manifest["parts"].get(antenna, [])) + ((manifest["tails"][antenna],) if antenna in manifest["tails"] else ())
+
+    with _lock:
+        if _datasets.get((directory, antenna), (None,))[0] != files:
+            dataset = ds.dataset([os.path.join(directory, name) for name in files], schema=_schema(),
+                                 format="ipc", filesystem=pa.fs.LocalFileSystem(use_mmap=True))
+            _datasets[(directory, antenna)] = (files, dataset)
+
+        return _datasets[(directory, antenna)][1]
+
+
+def _predicate(clause):
+    # (column, op, value) or a list of them (ORed)
+    if isinstance(clause, list):
+        expressions = [_predicate(option) for option in clause]
+        expression = expressions[0]
+
+        for option in expressions[1:]:
+            expression = expression | option
+
+        return expression
+
+    column, op, value = clause
+    field = ds.field(column)
+
+    if op == "in":
+        return field.isin(list(value))
+
+    return {"==": field == value, ">=": field >= value, "<=": field <= value, ">": field > value}[op]
+
+
+def query(antenna, select, where=(), directory=snapshot_dir):
+    """Snapshot rows of an antenna matching every where clause
+
+    Clauses are (column, op, value) tuples with op "==", ">=", "<=", ">" or "in",
+    or lists of such tuples (any may match). Like SQL, comparisons with
+    NULL never match.
+
+    @param[in] antenna - antenna instance
+    @param[in] select - list of column names
+    @param[in] where - list of clauses (ANDed)
+    @param[in] directory - snapshot directory
+    @return df - pandas data frame, or None when the snapshot can't answer
+    """
+    if pa is None:
+        return None
+
+    expression = None
+    for clause in where:
+        expression = _predicate(clause) if expression is None else expression & _predicate(clause)
+
+    try:
+        dataset = _dataset(antenna, directory)
+
+        if dataset is None:
+            return None
+
+        return dataset.to_table(columns=list(select), filter=expression).to_pandas()
+    except OSError:
+        # Files merged away by a concurrent refresh
+        return None
+
+
+if __name__ == "__main__":
+    print("Refreshed" if refresh() else "Up to date")
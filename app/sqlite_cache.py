@@ -0,0 +1,177 @@
+"""Response cache shared by every app process on the host
+
+flask_caching's simple backend lives in each worker's memory, so every
+worker computes every figure itself. SQLiteCache keeps entries in a sqlite
+file (WAL mode, so readers never block each other) that all workers open,
+and evicts the least recently used entries past an entry count or total
+size limit. Hits only write an entry's access time when it is more than
+touch_interval seconds old, so reads don't queue up behind each other on
+the db's write lock. Select it with CACHE_TYPE = "sqlite_cache.sqlite".
+"""
+
+import os
+import pickle
+import sqlite3 as sql
+import threading
+from time import time
+
+from flask_caching.backends.base import BaseCache
+
+import metrics
+
+
+class SQLiteCache(BaseCache):
+    """LRU cache stored in a sqlite db
+
+    @param[in] path - path to the cache db (created when missing)
+    @param[in] threshold - max number of entries
+    @param[in] max_size - max total bytes of pickled values
+    @param[in] default_timeout - seconds entries live (0 never expires)
+    @param[in] touch_interval - seconds an entry's access time may lag behind its hits
+    """
+
+    def __init__(self, path="cache.db", threshold=500, max_size=256 * 1024 * 1024, default_timeout=300, touch_interval=60):
+        super().__init__(default_timeout)
+        self.path = path
+        self.threshold = threshold
+        self.max_size = max_size
+        self.touch_interval = touch_interval
+
+        self._conn = None
+        self._lock = threading.Lock()
+
+        # Forks wait for the statement in progress (see db.in_use)
+        os.register_at_fork(before=self._before_fork, after_in_parent=self._after_fork_in_parent,
+                            after_in_child=self._reset_after_fork)
+
+    def _before_fork(self):
+        self._lock.acquire()
+
+    def _after_fork_in_parent(self):
+        self._lock.release()
+
+    def _reset_after_fork(self):
+        # sqlite connections must not be shared with a forked child process
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sql.Connection:
+        # One connection per process, used under self._lock
+        if self._conn is None:
+            conn = sql.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL,
+                            expires REAL NOT NULL, accessed REAL NOT NULL, size INTEGER NOT NULL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)")
+            self._conn = conn
+
+        return self._conn
+
+    def _normalize_timeout(self, timeout):
+        timeout = BaseCache._normalize_timeout(self, timeout)
+        if timeout > 0:
+            timeout = time() + timeout
+        return timeout
+
+    def _prune(self, conn):
+        # Expired entries first, then least recently used ones while past the limits
+        conn.execute("DELETE FROM cache WHERE expires!=0 AND expires<=?", (time(),))
+        count, total = conn.execute("SELECT COUNT(*), TOTAL(size) FROM cache").fetchone()
+
+        if count <= self.threshold and total <= self.max_size:
+            return
+
+        evict = []
+        for key, size in conn.execute("SELECT key, size FROM cache ORDER BY accessed"):
+            if count <= self.threshold and total <= self.max_size:
+                break
+
+            evict.append((key,))
+            count -= 1
+            total -= size
+
+        conn.executemany("DELETE FROM cache WHERE key=?", evict)
+
+    def get(self, key):
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute("SELECT value, expires, accessed FROM cache WHERE key=?", (key,)).fetchone()
+            now = time()
+
+            if row is None or (row[1] != 0 and row[1] <= now):
+                metrics.cache_lookup(False)
+                return None
+
+            if now - row[2] > self.touch_interval:
+                conn.execute("UPDATE cache SET accessed=? WHERE key=?", (now, key))
+
+        metrics.cache_lookup(True)
+
+        try:
+            return pickle.loads(row[0])
+        except pickle.PickleError:
+            return None
+
+    def _store(self, key, value, timeout, replace):
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        expires = self._normalize_timeout(timeout)
+
+        with self._lock:
+            conn = self._connection()
+
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+
+                if not replace:
+                    # Expired entries don't block add
+                    conn.execute("DELETE FROM cache WHERE key=? AND expires!=0 AND expires<=?", (key, time()))
+
+                stored = conn.execute(f"INSERT OR {'REPLACE' if replace else 'IGNORE'} INTO cache VALUES (?, ?, ?, ?, ?)",
+                                      (key, value, expires, time(), len(value))).rowcount > 0
+
+                if stored:
+                    self._prune(conn)
+
+        return stored
+
+    def set(self, key, value, timeout=None):
+        return self._store(key, value, timeout, replace=True)
+
+    def add(self, key, value, timeout=None):
+        return self._store(key, value, timeout, replace=False)
+
+    def delete(self, key):
+        with self._lock:
+            return self._connection().execute("DELETE FROM cache WHERE key=?", (key,)).rowcount > 0
+
+    def has(self, key):
+        with self._lock:
+            row = self._connection().execute("SELECT expires FROM cache WHERE key=?", (key,)).fetchone()
+
+        return row is not None and (row[0] == 0 or row[0] > time())
+
+    def clear(self):
+        with self._lock:
+            self._connection().execute("DELETE FROM cache")
+
+        return True
+
+
+def sqlite(app, config, args, kwargs):
+    """flask_caching backend factory (CACHE_SQLITE_PATH, CACHE_THRESHOLD, CACHE_MAX_SIZE, CACHE_TOUCH_INTERVAL)
+    """
+    kwargs.update(
+        dict(
+            path=config.get("CACHE_SQLITE_PATH", "cache.db"),
+            threshold=config["CACHE_THRESHOLD"],
+            max_size=config.get("CACHE_MAX_SIZE", 256 * 1024 * 1024),
+            touch_interval=config.get("CACHE_TOUCH_INTERVAL", 60),
+        )
+    )
+    return SQLiteCache(*args, **kwargs)
+
+
+if __name__ == "__main__":
+    pass
@@ -1,14 +1,20 @@
 var antennaRange, filterConditions = {};
 
-// Initialize graph
-for (var i = 3; i < figure.data.length; i++) {
-    figure.data[i].y = figure.data[i].y.map(y => y * figure.data[0].x.length)
+// Number of scans in the current figure (bars hold per bin counts)
+function scanCount() {
+    return figure.data[0].y.reduce((total, count) => total + count, 0);
+}
+
+function histnormArg() {
+    if ($('input[name=freqradio]:checked').val() == "percents")
+        return "&histnorm=probability";
+    return "";
 }
 
 var layout = {
     title: { text: "Signal Measurement Distribution of Channel " + defaultChannel.split()[0] },
     yaxis: {
-        range: [0, figure.data[0].x.length + 5],
+        range: [0, scanCount() + 5],
         title: { text: "Scan Frequency (counts)" }
     },
     xaxis: {
@@ -32,7 +38,7 @@ var config = {
             var update = { 'yaxis.range': [], 'xaxis.range': [-1, 101] };
 
             if ($('input[type=radio][name=freqradio]:checked').val() == "counts")
-                update['yaxis.range'] = [0, figure.data[0].x.length + 5];
+                update['yaxis.range'] = [0, scanCount() + 5];
             else
                 update['yaxis.range'] = [0, 1]
 
@@ -159,19 +165,12 @@ function updateModel() {
         if (this.readyState == 4 && this.status == 200) {
             var update = { y: [] };
             var traces = [];
-            figure.data = JSON.parse(JSON.parse(this.responseText)).data
+            figure.data = parseResponse(this.responseText).data
 
-            if ($('input[name=freqradio]:checked').val() == "counts")
-                for (var i = figure.data.length / 2; i < figure.data.length; i++) {
-                    figure.data[i].y = figure.data[i].y.map(y => y * figure.data[0].x.length);
-                    update.y.push(figure.data[i].y);
-                    traces.push(i);
-                }
-            else
-                for (var i = figure.data.length / 2; i < figure.data.length; i++) {
-                    update.y.push(figure.data[i].y);
-                    traces.push(i);
-                }
+            for (var i = figure.data.length / 2; i < figure.data.length; i++) {
+                update.y.push(figure.data[i].y);
+                traces.push(i);
+            }
 
             // Replot
             Plotly.restyle('graph-container', update, traces)
@@ -188,7 +187,7 @@ function updateModel() {
     xhttp.open(
         "GET",
         "http://www.employees.org:58000/graphs/channeldistribution/channelapi?channel=" + $('#select-channel').val()
-        + "&antenna=" + $('#select-antenna').val() + "&model=" + $('input[name=modelradio]:checked').val() + filterArgs,
+        + "&antenna=" + $('#select-antenna').val() + "&model=" + $('input[name=modelradio]:checked').val() + histnormArg() + filterArgs + "&format=bdata",
         true
     );
     xhttp.send();
@@ -198,32 +197,20 @@ function updateChannel(range = false) {
     var xhttp, filterArgs = "";
     var selectedChannel = $('#select-channel').val();
 
-    if ($('input[name=freqradio]:checked').val() == "percents")
-        histnorm = "probability";
-
     setVisible('channel-loading', true);
 
     // Request
     xhttp = new XMLHttpRequest();
     xhttp.onreadystatechange = function () {
         if (this.readyState == 4 && this.status == 200) {
-            figure.data = JSON.parse(JSON.parse(this.responseText)).data
-
-            if ($('input[name=freqradio]:checked').val() == "counts")
-                for (var i = figure.data.length / 2; i < figure.data.length; i++) {
-                    figure.data[i].y = figure.data[i].y.map(y => y * figure.data[0].x.length);
-                }
-            else
-                for (var i = 0; i < figure.data.length / 2; i++) {
-                    figure.data[i].histnorm = "probability";
-                }
+            figure.data = parseResponse(this.responseText).data
 
             layout.title.text = "Signal Measurement Distribution of Channel " + selectedChannel;
             layout.legend.title.text = channelMap[selectedChannel].replace(": ", "<br>---<br>");
             layout.legend.title.text = layout.legend.title.text.replaceAll(", ", "<br>") + "<br>";
 
             if (range && $('input[name=freqradio]:checked').val() == "counts")
-                layout.yaxis.range = [0, figure.data[0].x.length + 5];
+                layout.yaxis.range = [0, scanCount() + 5];
 
             // Replot
             Plotly.react('graph-container', figure.data, layout, config)
@@ -243,7 +230,7 @@ function updateChannel(range = false) {
     xhttp.open(
         "GET",
         "http://www.employees.org:58000/graphs/channeldistribution/channelapi?channel=" + selectedChannel
-        + "&antenna=" + $('#select-antenna').val() + "&model=" + $('input[name=modelradio]:checked').val() + filterArgs,
+        + "&antenna=" + $('#select-antenna').val() + "&model=" + $('input[name=modelradio]:checked').val() + histnormArg() + filterArgs + "&format=bdata",
         true
     );
     xhttp.send();
@@ -470,27 +457,17 @@ $(document).ready(function () {
     });
 
     $('input[type=radio][name=freqradio]').change(function () {
-        var traceBuffer = figure.data.length / 2;
         // console.log(this.value)
-        // Update Signal Measurement
+        // Update Signal Measurement (bins are normalized by the server)
         if (this.value == "counts") {
-            for (var i = 0; i < figure.data.length / 2; i++) {
-                figure.data[i].histnorm = "";
-                figure.data[i + traceBuffer].y = figure.data[i + traceBuffer].y.map(y => y * figure.data[0].x.length);
-            }
             layout.yaxis.title.text = "Scan Frequency (counts)";
-            layout.yaxis.range = [0, figure.data[0].x.length + 5];
         } else {
-            for (var i = 0; i < figure.data.length / 2; i++) {
-                figure.data[i].histnorm = "probability";
-                figure.data[i + traceBuffer].y = figure.data[i + traceBuffer].y.map(y => y / figure.data[0].x.length);
-            }
             layout.yaxis.title.text = "Relative Scan Frequency (%)";
             layout.yaxis.range = [0, 1];
         }
 
         // Replot
-        Plotly.react('graph-container', figure.data, layout, config)
+        updateChannel(range = true);
     });
 
     $('input[type=radio][name=modelradio]').change(function () {
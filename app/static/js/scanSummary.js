@@ -1,4 +1,6 @@
 var antennaRange;
+var timeline = []; // scan start times (unix timestamps) of the selected antenna
+var plottedScanTime; // start time of the plotted (or requested) scan
 var config = { responsive: true, displaylogo: false }
 var layout = {
     title: { x: 0.5, font: { size: 15 } },
@@ -18,12 +20,62 @@ var layout = {
 }
 
 function plotNewScan(newScanData) {
-    figure = JSON.parse(newScanData.figure);
+    figure = newScanData.figure;
     layout.title.text = 'Signal Measurements of Scan at ' + moment.utc(newScanData.scantime).local().format("MMM DD, YYYY hh:mm A");
+    plottedScanTime = newScanData.scantime / 1000;
 
     Plotly.react('graph-container', figure.data, layout, config)
 }
 
+function loadTimeline(antenna) {
+    var xhttp;
+    xhttp = new XMLHttpRequest();
+    xhttp.onreadystatechange = function () {
+        if (this.readyState == 4 && this.status == 200) {
+            var response = JSON.parse(this.responseText).timeline;
+            var time;
+
+            if (!response)
+                return
+
+            // Delta encoded
+            time = response.start;
+            timeline = [time];
+
+            for (delta of response.deltas) {
+                time += delta;
+                timeline.push(time);
+            }
+        }
+    }
+
+    xhttp.open(
+        "GET",
+        "http://www.employees.org:58000/graphs/scansummary/timelineapi?antenna=" + antenna,
+        true
+    );
+    xhttp.send();
+}
+
+// Start time of the scan closest to a unix timestamp, picked like the scan api does (the earlier scan wins a tie)
+function snapToScan(time) {
+    var low = 0, high = timeline.length;
+
+    while (low < high) {
+        var middle = (low + high) >> 1;
+
+        if (timeline[middle] <= time)
+            low = middle + 1;
+        else
+            high = middle;
+    }
+
+    if (low == timeline.length || low > 0 && time - timeline[low - 1] <= timeline[low] - time)
+        low -= 1;
+
+    return timeline[low];
+}
+
 // Initial Requests
 var xhttp1;
 xhttp1 = new XMLHttpRequest();
@@ -55,6 +107,8 @@ xhttp2.open(
 );
 xhttp2.send();
 
+loadTimeline(defaultAntenna);
+
 // Fill Antenna instance selectbox
 antennaSelectbox = document.getElementById('select-antenna')
 
@@ -88,7 +142,18 @@ $(document).ready(function () {
     $('#datetimepicker')
         .datetimepicker()
         .on('dp.change', function (event) {
+            var scantime = $('#datetimepicker').data('DateTimePicker').date().unix();
             var xhttp;
+
+            if (timeline.length > 0) {
+                // Times within the plotted scan need no request
+                scantime = snapToScan(scantime);
+
+                if (scantime == plottedScanTime)
+                    return
+            }
+
+            plottedScanTime = scantime;
             xhttp = new XMLHttpRequest();
             xhttp.onreadystatechange = function () {
                 if (this.readyState == 4 && this.status == 200) {
@@ -98,7 +163,7 @@ $(document).ready(function () {
 
             xhttp.open(
                 "GET",
-                "http://www.employees.org:58000/graphs/scansummary/scanapi?scantime=" + $('#datetimepicker').data('DateTimePicker').date().unix() + "&antenna=" + $('#select-antenna').val(),
+                "http://www.employees.org:58000/graphs/scansummary/scanapi?scantime=" + scantime + "&antenna=" + $('#select-antenna').val(),
                 true
             );
             xhttp.send();
@@ -113,6 +178,11 @@ $(document).ready(function () {
     $('#select-antenna').on('select2:select', function (event) {
         var selectedInstance = $('#select-antenna').val();
 
+        // The scan api resolves times until the antenna's timeline loads
+        timeline = [];
+        plottedScanTime = undefined;
+        loadTimeline(selectedInstance);
+
         var xhttp;
         xhttp = new XMLHttpRequest();
         xhttp.onreadystatechange = function () {
@@ -2,6 +2,9 @@ var figure, labels, graphLoaded;
 var realChannels, realChannelCount, virtualChannelCount;
 var config, antennaSelectbox;
 var selectedSignal = "snq";
+var traceCache = {}; // antenna:measurement -> traces (fetched on demand)
+var traceVersions = {}; // antenna:measurement -> latest scan_instance of the cached traces
+var pollInterval = 60000; // ms between checks for new scans
 
 function diffTime(dt2, dt1) {
     dt1 = new Date(dt1);
@@ -21,6 +24,7 @@ var layout = {
     title: { x: 0.5, font: { size: 15 } },
     xaxis: {
         title: 'Time',
+        type: 'date', // times are numbers (ms) in typed arrays
         rangeselector: {
             buttons: [{
                 count: 1,
@@ -89,11 +93,13 @@ function setVisible(selector, visible) {
 function setPlotAntenna(antennaData, antenna = defaultAntenna) {
     // Update global variables
 
-    figure = JSON.parse(antennaData.figure);
-    labels = JSON.parse(antennaData.labels);
+    figure = antennaData.figure;
+    labels = antennaData.labels;
     annotations = antennaData.annotations;
     // console.log(annotations);
 
+    prepareTraces(figure.data, antennaData);
+
     // Set Channel Counts
     realChannels = Object.keys(labels).reverse();
     realChannelCount = realChannels.length;
@@ -110,11 +116,8 @@ function setPlotAntenna(antennaData, antenna = defaultAntenna) {
     layout.xaxis.rangeselector.buttons[layout.xaxis.rangeselector.buttons.length - 1].count = diffTime(figure.data[0].x[figure.data[0].x.length - 1], figure.data[0].x[0]);
     layout.legend.title.text = realChannelCount + ' Real Channels<br>' + virtualChannelCount + ' Virtual Channels';
 
-    // Set time & annotation data points of all traces
-    for (i = 1; i < figure.data.length; i++) {
-        figure.data[i].x = figure.data[0].x;
-        figure.data[i].text = annotations
-    }
+    traceCache[antenna + ':' + selectedSignal] = figure.data;
+    traceVersions[antenna + ':' + selectedSignal] = antennaData.version;
 
     // Set Default Legend Labels
     for (i = 0; i < realChannelCount; i++) {
@@ -125,15 +128,142 @@ function setPlotAntenna(antennaData, antenna = defaultAntenna) {
     Plotly.react('graph-container', figure.data, layout, config)
     graphLoaded = true;
 }
+
+// Times & annotations of a trace's points: downsampled traces index the response's
+// times and annotations by customdata, full resolution traces share the first trace's
+function traceTimes(trace, data, response) {
+    if (trace.customdata)
+        return Array.from(trace.customdata, position => response.times[position]);
+
+    return trace.x.length > 0 ? trace.x : data[0].x;
+}
+
+function traceText(trace, response) {
+    if (trace.customdata)
+        return Array.from(trace.customdata, position => response.annotations[position]);
+
+    return response.annotations;
+}
+
+function prepareTraces(data, response) {
+    // Set time & annotation data points of all traces (the first trace's come first)
+    for (i = 0; i < data.length; i++) {
+        data[i].text = traceText(data[i], response);
+        data[i].x = traceTimes(data[i], data, response);
+    }
+}
+
+// Traces are downsampled to about one point per horizontal pixel
+function widthArg() {
+    // Rounded so that visitors share (pre-warmed) cached responses
+    return "&width=" + Math.max(100, Math.round(window.innerWidth * 0.009) * 100);
+}
+
+// Only traces of the selected signal measurement are requested
+function measurementArg() {
+    return "&measurement=" + selectedSignal;
+}
+
+// Reload full resolution data for the visible time range after zooming
+function updateViewport(event) {
+    var range = "";
+
+    if (event['xaxis.range[0]'] !== undefined)
+        range = "&start=" + encodeURIComponent(event['xaxis.range[0]']) + "&end=" + encodeURIComponent(event['xaxis.range[1]']);
+    else if (event['xaxis.range'] !== undefined)
+        range = "&start=" + encodeURIComponent(event['xaxis.range'][0]) + "&end=" + encodeURIComponent(event['xaxis.range'][1]);
+    else if (event['xaxis.autorange'] === undefined)
+        return
+
+    var xhttp;
+    xhttp = new XMLHttpRequest();
+    xhttp.onreadystatechange = function () {
+        if (this.readyState == 4 && this.status == 200) {
+            var response = parseResponse(this.responseText);
+            var view = response.figure;
+            var update = { x: [], y: [], text: [] };
+
+            for (i = 0; i < view.data.length; i++) {
+                update.x.push(traceTimes(view.data[i], view.data, response));
+                update.y.push(view.data[i].y);
+                update.text.push(traceText(view.data[i], response));
+            }
+
+            Plotly.restyle('graph-container', update);
+        }
+    }
+
+    xhttp.open(
+        "GET",
+        "http://www.employees.org:58000/graphs/trackchannel/viewportapi?antenna=" + $('#select-antenna').val() + measurementArg() + widthArg() + "&format=bdata" + range,
+        true
+    );
+    xhttp.send();
+}
+
+// Append the scans that landed since the plotted version (only new points are downloaded)
+function pollNewScans() {
+    var antenna = $('#select-antenna').val();
+    var key = antenna + ':' + selectedSignal;
+
+    if (document.hidden || traceVersions[key] === undefined)
+        return
+
+    var xhttp;
+    xhttp = new XMLHttpRequest();
+    xhttp.onreadystatechange = function () {
+        if (this.readyState == 4 && this.status == 200) {
+            var response = parseResponse(this.responseText);
+            var delta = response.figure.data;
+
+            // Another antenna or measurement was plotted meanwhile, or nothing is new
+            if (key != $('#select-antenna').val() + ':' + selectedSignal || response.version == traceVersions[key])
+                return
+
+            // The antenna's channels changed, so its traces are reloaded
+            if (delta.length != figure.data.length) {
+                delete traceCache[key];
+                $('#select-antenna').trigger('select2:select');
+                return
+            }
+
+            var update = { x: [], y: [], text: [] };
+            var traces = [];
+
+            for (i = 0; i < delta.length; i++) {
+                update.x.push(traceTimes(delta[i], delta, response));
+                update.y.push(delta[i].y);
+                update.text.push(traceText(delta[i], response));
+                traces.push(i);
+            }
+
+            traceVersions[key] = response.version;
+            Plotly.extendTraces('graph-container', update, traces);
+        }
+    }
+
+    xhttp.open(
+        "GET",
+        "http://www.employees.org:58000/graphs/trackchannel/api?antenna=" + antenna + measurementArg() + widthArg() + "&format=bdata" + "&since=" + traceVersions[key],
+        true
+    );
+    xhttp.send();
+}
+
 var xhttp;
 xhttp = new XMLHttpRequest();
 xhttp.onreadystatechange = function () {
     if (this.readyState == 4 && this.status == 200) {
-        setPlotAntenna(JSON.parse(this.responseText), antenna = defaultAntenna)
+        setPlotAntenna(parseResponse(this.responseText), antenna = defaultAntenna)
 
         Plotly.react('graph-container', figure.data, layout, config)
             .then(gd => {
                 gd.on('plotly_legenddoubleclick', () => false) // Remove doubleclick functionality
+                gd.on('plotly_relayout', updateViewport)
+
+                // Initial view (last day) at full resolution
+                updateViewport({ 'xaxis.range': gd.layout.xaxis.range })
+                window.setInterval(pollNewScans, pollInterval);
                 gd.on('plotly_legendclick', (event) => {
                     var update = { visible: true }
                     var button = document.getElementById('hide-all-traces');
@@ -164,7 +294,7 @@ xhttp.onreadystatechange = function () {
 
 xhttp.open(
     "GET",
-    "http://www.employees.org:58000/graphs/trackchannel/api?antenna=" + defaultAntenna,
+    "http://www.employees.org:58000/graphs/trackchannel/api?antenna=" + defaultAntenna + measurementArg() + widthArg() + "&format=bdata",
     false
 );
 xhttp.send();
@@ -241,27 +371,10 @@ $(document).ready(function () {
     });
 
     $('#hide-all-traces').click(function () {
-        var traceStart, traceEnd, signalMeasurementFactor;
         var traces = [];
         var update = { visible: [] };
 
-        switch (selectedSignal) {
-            case "ss":
-                signalMeasurementFactor = 2
-                break;
-            case "seq":
-                signalMeasurementFactor = 3
-                break;
-            default:
-                // case "snq"
-                signalMeasurementFactor = 1
-                break;
-        }
-
-        traceStart = (signalMeasurementFactor * realChannelCount) - realChannelCount;
-        traceEnd = signalMeasurementFactor * realChannelCount;
-
-        for (i = traceStart; i < traceEnd; i++) {
+        for (i = 0; i < figure.data.length; i++) {
             update.visible.push(figure.data[i].visible);
             traces.push(i);
         }
@@ -280,40 +393,53 @@ $(document).ready(function () {
     });
 
     $('input[type=radio][name=smradio]').change(function () {
-        // Update Signal Measurement
-        var update = { visible: [] };
-        var visibilityMap = { snq: [], ss: [], seq: [] };
+        // Update Signal Measurement (its traces are fetched once per antenna)
+        var antenna = $('#select-antenna').val();
+        var visibility = figure.data.map(trace => trace.visible);
+        var names = figure.data.map(trace => trace.name);
 
-        for (i = 0; i < realChannelCount; i++) {
-            if (selectedSignal == "snq")
-                visibilityMap.snq.push(figure.data[i].visible)
-            else
-                visibilityMap.snq.push(false)
-        }
+        layout.title.text = layout.title.text.replace(layout.title.text.split(" ")[0], this.value)
+        selectedSignal = layout.yaxis.title.text = this.value
 
-        for (i = realChannelCount; i < 2 * realChannelCount; i++) {
-            if (selectedSignal == "ss")
-                visibilityMap.ss.push(figure.data[i].visible)
-            else
-                visibilityMap.ss.push(false)
+        function showMeasurement(data) {
+            // Channels keep their visibility and legend label
+            for (i = 0; i < data.length; i++) {
+                data[i].visible = visibility[i];
+                data[i].name = names[i];
+            }
+
+            figure.data = data;
+
+            // Replot (at full resolution for the visible range)
+            Plotly.react('graph-container', figure.data, layout, config)
+                .then(gd => updateViewport({ 'xaxis.range': gd.layout.xaxis.range }));
         }
 
-        for (i = 2 * realChannelCount; i < 3 * realChannelCount; i++) {
-            if (selectedSignal == "seq")
-                visibilityMap.seq.push(figure.data[i].visible)
-            else
-                visibilityMap.seq.push(false)
+        if (traceCache[antenna + ':' + selectedSignal] !== undefined) {
+            showMeasurement(traceCache[antenna + ':' + selectedSignal]);
+            return
         }
 
-        [visibilityMap[this.value], visibilityMap[selectedSignal]] = [visibilityMap[selectedSignal], visibilityMap[this.value]];
-        update = { visible: visibilityMap.snq.concat(visibilityMap.ss, visibilityMap.seq) }
-        setLegendView(resetCurrentView = true)
+        var xhttp;
+        xhttp = new XMLHttpRequest();
+        xhttp.onreadystatechange = function () {
+            if (this.readyState == 4 && this.status == 200) {
+                var response = parseResponse(this.responseText);
+                var data = response.figure.data;
 
-        layout.title.text = layout.title.text.replace(layout.title.text.split(" ")[0], this.value)
-        selectedSignal = layout.yaxis.title.text = this.value
+                prepareTraces(data, response);
+                traceCache[antenna + ':' + selectedSignal] = data;
+                traceVersions[antenna + ':' + selectedSignal] = response.version;
+                showMeasurement(data);
+            }
+        }
 
-        // Replot
-        Plotly.restyle('graph-container', update);
+        xhttp.open(
+            "GET",
+            "http://www.employees.org:58000/graphs/trackchannel/api?antenna=" + antenna + measurementArg() + widthArg() + "&format=bdata",
+            true
+        );
+        xhttp.send();
     });
 
     $('#select-antenna').on('select2:select', function (event) {
@@ -326,13 +452,13 @@ $(document).ready(function () {
         xhttp = new XMLHttpRequest();
         xhttp.onreadystatechange = function () {
             if (this.readyState == 4 && this.status == 200) {
-                setPlotAntenna(JSON.parse(this.responseText), antenna = selectedInstance)
+                setPlotAntenna(parseResponse(this.responseText), antenna = selectedInstance)
             }
         }
 
         xhttp.open(
             "GET",
-            "http://www.employees.org:58000/graphs/trackchannel/api?antenna=" + selectedInstance,
+            "http://www.employees.org:58000/graphs/trackchannel/api?antenna=" + selectedInstance + measurementArg() + widthArg() + "&format=bdata",
             true
         );
         xhttp.send();
@@ -0,0 +1,35 @@
+// Api responses requested with format=bdata hold numeric arrays as
+// { dtype, bdata } (base64 little endian buffers), decoded here into
+// typed arrays that plotly plots as is. Dates are milliseconds since the epoch.
+var typedArrayTypes = {
+    u1: Uint8Array, i1: Int8Array, u2: Uint16Array, i2: Int16Array,
+    u4: Uint32Array, i4: Int32Array, f4: Float32Array, f8: Float64Array
+};
+
+function decodeTypedArray(spec) {
+    var binary = atob(spec.bdata);
+    var bytes = new Uint8Array(binary.length);
+
+    for (var i = 0; i < binary.length; i++)
+        bytes[i] = binary.charCodeAt(i);
+
+    return new typedArrayTypes[spec.dtype](bytes.buffer);
+}
+
+// Replaces every typed array spec of a parsed response (in place)
+function decodeTypedArrays(value) {
+    if (value === null || typeof value !== 'object')
+        return value;
+
+    if (typeof value.bdata === 'string' && typedArrayTypes[value.dtype] !== undefined)
+        return decodeTypedArray(value);
+
+    for (var key of Object.keys(value))
+        value[key] = decodeTypedArrays(value[key]);
+
+    return value;
+}
+
+function parseResponse(text) {
+    return decodeTypedArrays(JSON.parse(text));
+}
@@ -1,14 +1,20 @@
 """Graphs differences in signal measurements of channels over time (scan instances)
 """
 
-import json
+import csv
+import io
 from itertools import cycle
 
+import numpy as np
 import pandas as pd
-import plotly
-import plotly.graph_objects as go
 
-from db import load
+import downsample
+import figures
+import metrics
+import rollup
+import snapshot
+from db import load, stream
+from metadata import store
 
 
 class TrackChannels():
@@ -23,97 +29,197 @@ class TrackChannels():
                 "greenyellow", "dodgerblue",  "darksalmon", "khaki", "plum", "lightgreen", 
                 "mediumslateblue", "olive", "darkgray", "fuschia", "ivory"]
 
-        self.color_cycle = cycle(self.colors)
+        self.refresh()
+
+    def refresh(self):
+        """Brings the defaults up to date with the metadata store and clears the last figure (see graphs.py)
+        """
+        store.refresh()
+        self.default_antenna = store.default_antenna
+        self.antenna_map = store.antenna_map
+
+        self.reset()
 
-        self.default_antenna = load("SELECT configured_antenna_instance FROM monitor")["configured_antenna_instance"].to_list()[0]
+    def reset(self):
+        """Drops the state (and data frames) of the last figure
+        """
         self.current_antenna = self.default_antenna
-        antenna_df = load("SELECT * FROM antenna")
-        self.antenna_map = {instance: {"name": str(instance) + "; " + "Name: " + name + ", Location: " + location + ", Direction: " + str(direction) + " degrees, Comments: "}
-                            for instance, name, location, direction, comment in zip(antenna_df["antenna_instance"], antenna_df["name"], antenna_df["location"], 
-                            antenna_df["direction"], antenna_df["comment"])}
-
-        # Remove quotations
-        for i, description in enumerate(self.antenna_map.values()):
-            if "'" in self.antenna_map[i + 1]["name"]:
-                self.antenna_map[i + 1]["name"] = self.antenna_map[i + 1]["name"].replace("'", "")
-            
-            if "\"" in self.antenna_map[i + 1]["name"]:
-                self.antenna_map[i + 1]["name"] = self.antenna_map[i + 1]["name"].replace("\"", "")
+        self.measurements = self.signal_measurements # measurements plotted by get_json
+        self.color_cycle = cycle(self.colors)
 
         self.fig = None
         self.real_channels = None
         self.labels = None
         self.mdf = None
+        self.indices = None
+        self.annotations = None
+        self.times = None # start times of kept_rows
+        self.kept_rows = None # rows of mdf any trace kept, when downsampled
+        self.version = None # latest scan_instance plotted (the cursor of delta updates)
+
+    @metrics.timed
+    def _build_df(self, since=None):
+        where = [("channel", "in", self.real_channels)]
+        if since is not None:
+            where.append(("scan_instance", ">", since))
+
+        df = snapshot.query(self.current_antenna, ["scan_instance", "channel", *self.measurements, "scan_time", "status", 
+                            "temperature", "wind_direction", "wind_speed", "humidity"], where)
 
-    def _build_df(self):
-        signals = pd.DataFrame()        
-        for channel in self.real_channels:
-            df = load("""SELECT signal.scan_instance, snq, ss, seq 
-                        FROM signal LEFT JOIN scan ON signal.scan_instance = scan.scan_instance 
-                        WHERE channel=? AND antenna_instance=?""", channel, self.current_antenna)
+        if df is not None:
+            # Same local time as datetime(scan.start_time,'unixepoch','-4 hours')
+            df["start_time"] = pd.to_datetime(df.pop("scan_time") - 4 * 3600, unit="s")
+        else:
+            channels = ", ".join("?" for channel in self.real_channels)
+            after = "" if since is None else " AND signal.scan_instance>?"
+            df = load(f"""SELECT signal.scan_instance, channel, {", ".join(self.measurements)}, 
+                        datetime(scan.start_time,'unixepoch','-4 hours') as start_time, 
+                        status, temperature, wind_direction, wind_speed, humidity 
+                        FROM signal INNER JOIN scan ON signal.scan_instance = scan.scan_instance 
+                        LEFT JOIN weather ON scan.start_time = weather.start_time 
+                        WHERE antenna_instance=? AND channel IN ({channels}){after}""", 
+                        self.current_antenna, *self.real_channels, *([] if since is None else [since]))
 
-            df.columns = ["scan_instance"] + [f"{measurement}{channel}" for measurement in self.signal_measurements]
-            signals = pd.merge(signals, df, how="inner", on="scan_instance") if not signals.empty else df
+        # Duplicate weather rows for a start_time would otherwise repeat signal rows
+        df = df.drop_duplicates(subset=["scan_instance", "channel"])
 
-        annotationsdf = load("""SELECT status, temperature, wind_direction, wind_speed, 
-                            humidity FROM weather LEFT JOIN scan ON scan.start_time = 
-                            weather.start_time WHERE antenna_instance=?""", self.current_antenna)
+        # Only keep scans that measured every channel
+        complete = df.groupby("scan_instance")["channel"].transform("size") == len(self.real_channels)
+        df = df[complete]
 
-        annotationsdf["annotations"] = [
+        # Wide layout: one row per scan, one {measurement}{channel} column per trace
+        signals = df.pivot(index="scan_instance", columns="channel", values=self.measurements)
+        signals.columns = [f"{measurement}{channel}" for measurement, channel in signals.columns]
+        # (no columns are pivoted when there are no new scans since a delta's cursor)
+        signals = signals.reindex(columns=[f"{measurement}{channel}" for measurement in self.measurements for channel in self.real_channels])
+        signals = signals.astype({f"{measurement}{channel}": df[measurement].dtype 
+                                  for channel in self.real_channels for measurement in self.measurements})
+
+        scans = df.drop_duplicates(subset="scan_instance").set_index("scan_instance")
+        # Scans without weather turn the integer columns into floats ("65.0 Degrees")
+        scans = scans.astype({"start_time":"datetime64[ns]", "wind_direction": "Int64", "humidity": "Int64"})
+        scans["annotations"] = [
                 f"""Status: {status}<br>Temp: {str(temp)} F<br>Wind Direction: {str(winddirection)} Degrees<br>Wind Speed: {str(windspeed)} mph<br>Humidity: {str(humidity)}%"""
+                if isinstance(status, str) else None
                 for status, temp, winddirection, windspeed, humidity in
-                zip(annotationsdf["status"], annotationsdf["temperature"], annotationsdf["wind_direction"], 
-                annotationsdf["wind_speed"], annotationsdf["humidity"])
+                zip(scans["status"], scans["temperature"], scans["wind_direction"], 
+                scans["wind_speed"], scans["humidity"])
             ]
 
-        annotationsdf = annotationsdf.drop(columns=["status", "temperature", "wind_direction", "wind_speed", "humidity"])
+        # Weather is joined on the scan's start_time rather than by row position
+        self.mdf = signals.join(scans[["start_time", "annotations"]]).reset_index() # merged data frame
+        self.version = int(self.mdf["scan_instance"].max()) if len(self.mdf) else since
+
+    @metrics.timed
+    def _build_rollup_df(self, points, start=None, end=None) -> bool:
+        """Builds mdf from the coarsest rollup that still has points periods in the range
+
+        Only used when the range holds more than points scans (it is
+        downsampled anyway) and the rollups are current. Each point is the
+        mean of a period, without annotations.
+
+        @return built - False when the scans themselves are plotted
+        """
+        times = store.scan_times(self.current_antenna)[0]
+
+        if not points or not len(times) or not self.real_channels:
+            return False
+
+        # Local (GMT-04:00) times to unix timestamps
+        first = int(pd.Timestamp(start).timestamp()) + 4 * 3600 if start is not None else int(times[0])
+        last = int(pd.Timestamp(end).timestamp()) + 4 * 3600 if end is not None else int(times[-1])
+        table = rollup.choose(last - first, points)
+
+        if table is None or np.searchsorted(times, last, side="right") - np.searchsorted(times, first) <= points:
+            return False
 
-        scans = load("SELECT scan_instance, datetime(start_time,'unixepoch','-4 hours') as start_time FROM scan")
-        # scans = scans.rename(columns={"datetime(start_time,'unixepoch','localtime')":"start_time"})
-        scans = scans.astype({"start_time":"datetime64[ns]"})
-        self.mdf = pd.merge(signals, scans, how="inner", on=["scan_instance"]) # merged data frame
-        self.mdf = self.mdf.join(annotationsdf)
+        version = rollup.current()
 
+        if version is None:
+            return False
+
+        # Like scans, only periods that measured every channel are kept
+        df = rollup.trends(self.current_antenna, self.real_channels, self.measurements, table, first, last).dropna()
+        df["start_time"] = pd.to_datetime(df.pop("period") - 4 * 3600, unit="s")
+        df["annotations"] = None
+
+        self.mdf = df
+        self.version = version
+        return True
+
+    @metrics.timed
     def _build_labels(self):
-        """Builds graph labels with real and virtual channel numbers
+        """Builds graph labels with real and virtual channel numbers (see MetadataStore.labels)
+        """
+        vertical = store.labels(self.current_antenna, "vertical", self.real_channels)
+        horizontal = store.labels(self.current_antenna, "horizontal", self.real_channels)
+
+        self.labels = {channel: {"vertical": vertical[channel], "horizontal": horizontal[channel]} for channel in self.real_channels}
+
+    def _downsample(self, points=None, method="lttb", start=None, end=None):
+        """Trims mdf to a time range and selects the rows plotted per trace
+
+        self.indices maps each trace's column to its selected rows when the
+        range holds more than points scans, else it is None (all rows).
+        Downsampled traces keep different rows, so the start times (times)
+        and annotations of every row any trace kept are then sent once, and
+        each trace points into them (see _graph).
         """
-        vertical_labels = [str(channel) + "<br>---" for channel in self.real_channels]
-        horizontal_labels = [str(channel) + " |" for channel in self.real_channels]
-        self.mapping = load("""SELECT channel, virtual FROM mapping 
-                                WHERE channel IN (SELECT DISTINCT channel 
-                                FROM signal INNER JOIN scan ON signal.scan_instance
-                                 = scan.scan_instance WHERE antenna_instance=? 
-                                AND snq>0)""", self.current_antenna)
-
-        # Converting virtual channel & station name str to sorted virtual channel float
-        self.mapping["floatVirtuals"] = pd.Series([float(virtual[0]) for virtual in self.mapping["virtual"].str.split().to_list()])
-        self.mapping = self.mapping.sort_values(by="floatVirtuals")
-
-        for real, virtual in zip(self.mapping["channel"].values, self.mapping["virtual"].values):
-            if real in self.real_channels:
-                i = self.real_channels.index(real)
-                vertical_labels[i] += "<br>" + str(virtual)
-                horizontal_labels[i] += "  " + str(virtual)
-
-        self.labels = {channel: {"vertical": vertical + "<br>", "horizontal": horizontal} for (channel, vertical, horizontal) in zip(self.real_channels, vertical_labels, horizontal_labels)}
+        if start is not None:
+            self.mdf = self.mdf[self.mdf["start_time"] >= pd.Timestamp(start)]
+
+        if end is not None:
+            self.mdf = self.mdf[self.mdf["start_time"] <= pd.Timestamp(end)]
 
+        self.mdf = self.mdf.reset_index(drop=True)
+        self.indices = None
+        self.times = None
+
+        if points and len(self.mdf) > points:
+            columns = [f"{signal_measurement}{channel}" for signal_measurement in self.measurements for channel in self.real_channels]
+            select = downsample.methods.get(method, downsample.lttb)
+            rows = select(self.mdf["start_time"].values.astype("int64"), self.mdf[columns].values, points)
+
+            # Budgets the methods can't meet select every row
+            if len(rows) < len(self.mdf):
+                self.indices = dict(zip(columns, rows.T))
+                self.kept_rows = np.unique(rows)
+                self.times = self.mdf["start_time"].values[self.kept_rows]
+
+        if self.indices is None:
+            self.annotations = self.mdf["annotations"].tolist()
+        else:
+            self.annotations = self.mdf["annotations"].values[self.kept_rows].tolist()
+
+    @metrics.timed
     def _graph(self):
-        self.fig = go.Figure()
-        xdata = self.mdf["start_time"]
+        traces = []
+        xdata = self.mdf["start_time"].values
         mode = "markers" if len(self.mdf["start_time"]) == 1 else "lines"
 
         update_xdata = True
-        for signal_measurement in self.signal_measurements:
-            visible = True if signal_measurement == self.default_signal_measurement else False
+        for signal_measurement in self.measurements:
+            visible = True if signal_measurement == self.measurements[0] else False
             self.color_cycle = cycle(self.colors) # reset color cycle
             for channel, color in zip(self.real_channels, self.color_cycle):
                 col = f"{signal_measurement}{channel}"
-                self.fig.add_trace(go.Scatter(x=xdata, y=self.mdf[col], mode=mode, name=channel, marker= {"color": color}))
-                self.fig["data"][-1].visible = visible
-                
+
+                if self.indices is None:
+                    traces.append(figures.trace("scatter", x=xdata, y=self.mdf[col].values, mode=mode, name=str(channel), 
+                                    marker={"color": color}, visible=visible))
+                else:
+                    # Downsampled traces keep different scans, each carries the positions of
+                    # its scans in times & annotations as customdata (x is looked up from them)
+                    rows = self.indices[col]
+                    traces.append(figures.trace("scatter", x=[], y=self.mdf[col].values[rows], 
+                                    customdata=np.searchsorted(self.kept_rows, rows), mode=mode, name=str(channel), 
+                                    marker={"color": color}, visible=visible))
+
                 if update_xdata:
                     xdata = []
                     update_xdata = False
+
+        self.fig = figures.figure(traces)
         
         # self.fig.layout = {
         #     "paper_bgcolor": 'rgba(0,0,0,0)',
@@ -123,7 +229,26 @@ class TrackChannels():
         # }
         return self.fig
 
-    def get_json(self, antenna=None):
+    def get_figure(self, antenna=None, points=None, method="lttb", start=None, end=None, measurements=None, channels=None, since=None):
+        """Figure (dict) of the antenna's channels over time
+
+        Only traces of the requested measurements and channels are built,
+        measurement by measurement (the first one is visible). Ranges too
+        long to plot every scan are built from hourly or daily means (see
+        _build_rollup_df). With since,
+        only scans after that scan_instance are read, so a page polling with
+        the previous version gets just the new points of each trace. self.version
+        is the latest scan_instance of the figure (since when there is none).
+
+        @param[in] antenna - antenna instance
+        @param[in] points - max points per trace (downsampled past it)
+        @param[in] method - downsampling method ("lttb" or "minmax")
+        @param[in] start, end - visible time range (local Timestamps or datetime strs)
+        @param[in] measurements - list of signal measurements (default all)
+        @param[in] channels - list of real channels (default all)
+        @param[in] since - scan_instance cursor (only later scans are plotted)
+        @return figure - plotly figure dict (see figures.dumps)
+        """
         try:
             # Sets default and acts as an extra layer of sanitization
             int(antenna)
@@ -131,16 +256,122 @@ class TrackChannels():
         except TypeError:
             pass
 
-        self.real_channels = load(f"""SELECT DISTINCT channel FROM (SELECT * FROM signal 
-                                WHERE signal.scan_instance IN (SELECT scan_instance 
-                                FROM scan WHERE antenna_instance={self.current_antenna})) WHERE snq>0;""")["channel"].to_list()
-        self.real_channels = sorted(self.real_channels, reverse=True)
+        self.real_channels = store.channels(self.current_antenna)
+
+        # Unknown names are dropped (they are also used as column names in _build_df)
+        if measurements:
+            self.measurements = [measurement for measurement in self.signal_measurements if measurement in measurements] or self.signal_measurements
+
+        if channels:
+            self.real_channels = [channel for channel in self.real_channels if channel in channels]
 
         self._build_labels()
-        self._build_df()
-        self._graph()
 
-        return plotly.io.to_json(self.fig)
+        if since is not None or not self._build_rollup_df(points, start, end):
+            self._build_df(since)
+
+        self._downsample(points, method, start, end)
+        return self._graph()
+
+    @metrics.timed
+    def get_json(self, *args, **kwargs):
+        """Figure of the antenna's channels over time as a JSON str (see get_figure)
+        """
+        return figures.dumps(self.get_figure(*args, **kwargs)).decode()
+
+    def export(self, antenna=None, format="ndjson", start=None, end=None, measurements=None, channels=None):
+        """Raw rows of the antenna's channels, streamed in scan order
+
+        Rows are read with a db cursor and encoded chunk by chunk, so memory
+        stays bounded however long the history is. ndjson yields one line per
+        channel and chunk holding that channel's series (columns of lists,
+        ready for Plotly.extendTraces), csv yields one line per scan & channel.
+        Unlike get_figure, scans that missed a channel are kept.
+
+        @param[in] antenna - antenna instance
+        @param[in] format - "ndjson" or "csv"
+        @param[in] start, end - time range (local Timestamps or datetime strs)
+        @param[in] measurements - list of signal measurements (default all)
+        @param[in] channels - list of real channels (default all)
+        @return chunks - generator of bytes
+        """
+        try:
+            int(antenna)
+            self.current_antenna = antenna
+        except TypeError:
+            pass
+
+        self.real_channels = store.channels(self.current_antenna)
+
+        if measurements:
+            self.measurements = [measurement for measurement in self.signal_measurements if measurement in measurements] or self.signal_measurements
+
+        if channels:
+            self.real_channels = [channel for channel in self.real_channels if channel in channels]
+
+        columns = ["scan_instance", "start_time", "channel", *self.measurements, "status", "temperature",
+                   "wind_direction", "wind_speed", "humidity"]
+        conditions = []
+        args = [self.current_antenna, *self.real_channels]
+
+        # Times are local (GMT-04:00) like start_time, scan.start_time is UTC
+        if start is not None:
+            conditions.append(" AND scan.start_time>=?")
+            args.append(int(pd.Timestamp(start).timestamp()) + 4 * 3600)
+
+        if end is not None:
+            conditions.append(" AND scan.start_time<=?")
+            args.append(int(pd.Timestamp(end).timestamp()) + 4 * 3600)
+
+        if not self.real_channels:
+            chunks = iter([])
+        else:
+            chunks = stream(f"""SELECT signal.scan_instance, datetime(scan.start_time,'unixepoch','-4 hours') as start_time,
+                            channel, {", ".join(self.measurements)}, status, temperature, wind_direction, wind_speed, humidity
+                            FROM signal INNER JOIN scan ON signal.scan_instance = scan.scan_instance
+                            LEFT JOIN weather ON scan.start_time = weather.start_time
+                            WHERE antenna_instance=? AND channel IN ({", ".join("?" for channel in self.real_channels)})"""
+                            + "".join(conditions) + " ORDER BY scan.start_time, scan.scan_instance, channel", *args)
+
+        return self._ndjson(chunks, columns) if format == "ndjson" else self._csv(chunks, columns)
+
+    @staticmethod
+    def _unique(chunks):
+        # Duplicate weather rows for a start_time repeat signal rows (adjacent in scan & channel order)
+        last = None
+        for chunk in chunks:
+            rows = []
+            for row in chunk:
+                if (row[0], row[2]) != last:
+                    rows.append(row)
+                    last = (row[0], row[2])
+
+            yield rows
+
+    def _ndjson(self, chunks, columns):
+        for rows in self._unique(chunks):
+            series = {}
+            for row in rows:
+                series.setdefault(row[2], []).append(row)
+
+            for channel, channel_rows in series.items():
+                line = {"channel": channel}
+                line.update((column, values) for column, values in zip(columns, zip(*channel_rows)) if column != "channel")
+                yield figures.dumps(line) + b"\n"
+
+    def _csv(self, chunks, columns):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+
+        for rows in self._unique(chunks):
+            writer.writerows(rows)
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+
+        if buffer.tell():
+            yield buffer.getvalue().encode()
 
 
 if __name__ == "__main__":
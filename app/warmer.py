@@ -0,0 +1,132 @@
+"""Precomputes the graphs in the background whenever new scans land
+
+Cold requests used to build their figures inline, so the first visitor
+after new scans waited seconds. A daemon thread in every app process polls
+db.data_version and keeps the process' metadata store current. One process on the host (whichever holds warmer.lock) also
+refreshes the Arrow snapshot and the rollups and requests the default figures, maps and
+latest scan summaries through the app, which stores the responses in the
+shared response cache under the new data version.
+"""
+
+import fcntl
+import logging
+import os
+import threading
+import time
+
+from db import data_version
+from metadata import store
+
+logger = logging.getLogger(__name__)
+
+# Track Channel plot widths warmed (the page rounds its width to a multiple of 100 pixels)
+widths = [1200, 1300, 1400, 1700]
+
+
+class Warmer():
+    """Background cache warmer of a flask app
+
+    @param[in] interval - seconds between data version checks
+    @param[in] lock_path - lock file electing the process that warms the cache
+    """
+    def __init__(self, interval=30, lock_path="warmer.lock"):
+        self.interval = interval
+        self.lock_path = lock_path
+        self.version = None # data version of the warmed responses
+        self.enabled = True # set False before the app is imported to never start the thread (i.e. benchmarks)
+
+        self._app = None
+        self._pid = None
+        self._lock_file = None
+        self._started = threading.Lock()
+
+    def start(self, app):
+        """Starts the warmer thread of this process (once, forked workers start their own)
+        """
+        with self._started:
+            if not self.enabled or self._pid == os.getpid():
+                return
+
+            self._app = app
+            self._pid = os.getpid()
+            self._lock_file = None # a flock isn't inherited across fork
+            self.version = None
+            threading.Thread(target=self._run, name="warmer", daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                self.warm()
+            except Exception:
+                logger.exception("Cache warming failed")
+
+            time.sleep(self.interval)
+
+    def _leader(self) -> bool:
+        # Holds an exclusive flock on lock_path for the life of the process
+        if self._lock_file is None:
+            lock_file = open(self.lock_path, "w")
+
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+
+            self._lock_file = lock_file
+
+        return True
+
+    def urls(self) -> list:
+        """Requests warmed after new scans land
+        """
+        antenna = store.default_antenna
+        urls = ["/graphs/trackchannel", "/graphs/scansummary", "/graphs/channeldistribution"]
+        # Exactly as the page requests them (the cache keys hold every query arg)
+        urls += [f"/graphs/trackchannel/api?antenna={antenna}&measurement=snq&width={width}&format=bdata" for width in widths]
+
+        for instance in store.antennas:
+            urls.append(f"/graphs/scansummary/scanapi?antenna={instance}&scantime={int(time.time())}")
+            urls.append(f"/graphs/scansummary/antennaapi?antenna={instance}")
+            urls.append(f"/graphs/scansummary/timelineapi?antenna={instance}")
+            urls.append(f"/graphs/channeldistribution/antennaapi?antenna={instance}")
+
+        return urls
+
+    def warm(self):
+        """Refreshes this process' data and, in the leader process, warms the response cache
+        """
+        # Imported on this thread, so the app boots without pandas & pyarrow
+        import rollup
+        import snapshot
+
+        leader = self._leader()
+
+        if leader:
+            snapshot.refresh()
+            rollup.refresh()
+
+        store.refresh()
+
+        version = data_version()
+
+        if not leader or version == self.version:
+            return
+
+        start = time.perf_counter()
+        client = self._app.test_client()
+
+        for url in self.urls():
+            response = client.get(url)
+
+            if response.status_code != 200:
+                logger.warning("Warming %s failed with status %s", url, response.status_code)
+
+        self.version = version
+        logger.info("Warmed the cache for data version %s in %.1f s", version, time.perf_counter() - start)
+
+
+warmer = Warmer()
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,320 @@
+"""Benchmarks every endpoint and graph method against a monitor.db
+
+Each case runs repeat times through the Flask test client (endpoints, with
+the response cache cleared first so every run computes) or directly (graph
+methods), then once more under tracemalloc. Latency percentiles, peak
+memory and payload sizes are printed and compared with a stored baseline;
+regressions past the tolerance make the exit status 1.
+
+    python generate.py monitor.db --antennas 10 --channels 40 --days 1825
+    python benchmark.py monitor.db --save   # stores baseline.json
+    python benchmark.py monitor.db          # compares with baseline.json
+
+The app runs in a temporary directory (its cache, snapshot and lock files
+go there) with the background warmer off. Jobs run inline so that their
+memory is measured, --pool runs them in the process pool instead. The app
+adds its indexes to the db on startup and the rollups and cubes are built
+before the cases run, like the warmer builds them in production.
+
+Startup cases boot fresh app processes (as a worker (re)spawn does), time
+importing the app and its first request, and report the process' peak
+RSS as their peak memory.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sqlite3 as sql
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+app_dir = os.path.join(here, os.pardir, "app")
+sys.path.insert(0, app_dir)
+
+
+def _scan_times(path):
+    conn = sql.connect(path)
+    first, last = conn.execute("SELECT MIN(start_time), MAX(start_time) FROM scan").fetchone()
+    conn.close()
+    return first, last
+
+
+def _rows(path):
+    conn = sql.connect(path)
+    rows = {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in ["antenna", "scan", "signal", "weather"]}
+    conn.close()
+    return rows
+
+
+# Run in a fresh process: seconds to import the app & to answer a first request, peak RSS (KiB, Linux)
+_boot = """
+import re, sys, time
+start = time.perf_counter()
+from warmer import warmer
+warmer.enabled = False
+import app, jobs
+imported = time.perf_counter()
+jobs.workers = int(sys.argv[2])
+app.cache.clear()
+assert app.app.test_client().get(sys.argv[1]).status_code == 200, sys.argv[1]
+print(imported - start, time.perf_counter() - imported, re.search(r"VmHWM:\\s+(\\d+)", open("/proc/self/status").read()).group(1))
+"""
+
+
+def _local(timestamp):
+    # GMT-04:00 datetime str, as the Track Channel page sends
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(timestamp - 4 * 3600))
+
+
+def endpoints(store, first, last):
+    """Endpoint cases: (name, url)
+    """
+    antenna = store.default_antenna
+    channel = store.channels(antenna)[-1]
+    week = f"start={_local(last - 7 * 86400)}&end={_local(last)}"
+
+    return [
+        ("home", "/"),
+        ("help", "/help"),
+        ("api", "/api"),
+        ("trackchannel page", "/graphs/trackchannel"),
+        ("trackchannel api", f"/graphs/trackchannel/api?antenna={antenna}"),
+        ("trackchannel api width", f"/graphs/trackchannel/api?antenna={antenna}&measurement=snq&width=1700"),
+        ("trackchannel api minmax", f"/graphs/trackchannel/api?antenna={antenna}&measurement=snq&points=1000&downsample=minmax"),
+        ("trackchannel viewport week", f"/graphs/trackchannel/viewportapi?antenna={antenna}&measurement=snq&width=1700&{week}"),
+        ("trackchannel export ndjson", f"/graphs/trackchannel/export?antenna={antenna}"),
+        ("trackchannel export csv", f"/graphs/trackchannel/export?antenna={antenna}&format=csv"),
+        ("scansummary page", "/graphs/scansummary"),
+        ("scansummary scan latest", f"/graphs/scansummary/scanapi?antenna={antenna}&scantime={last}"),
+        ("scansummary scan middle", f"/graphs/scansummary/scanapi?antenna={antenna}&scantime={(first + last) // 2}"),
+        ("scansummary antenna", f"/graphs/scansummary/antennaapi?antenna={antenna}"),
+        ("scansummary timeline", f"/graphs/scansummary/timelineapi?antenna={antenna}"),
+        ("channeldistribution page", "/graphs/channeldistribution"),
+        ("channeldistribution channel", f"/graphs/channeldistribution/channelapi?channel={channel}&antenna={antenna}"),
+        ("channeldistribution filtered", f"/graphs/channeldistribution/channelapi?channel={channel}&antenna={antenna}"
+                                         "&model=normal&histnorm=probability&temp=40&temp=80&tod=20&tod=6&inversetod=true"),
+        ("channeldistribution daterange", f"/graphs/channeldistribution/channelapi?channel={channel}&antenna={antenna}"
+                                          f"&daterange={first + 86400 + 1234}&daterange={last - 86400 - 4321}"),
+        ("channeldistribution raw", f"/graphs/channeldistribution/channelapi?channel={channel}&antenna={antenna}&raw=true"),
+        ("channeldistribution batch", f"/graphs/channeldistribution/batchapi?antenna={antenna}&channels=all"),
+        ("channeldistribution antenna", f"/graphs/channeldistribution/antennaapi?antenna={antenna}"),
+        ("metrics", "/metrics"),
+    ]
+
+
+def boots(store):
+    """Startup cases: (name, url of the first request)
+    """
+    antenna = store.default_antenna
+
+    return [
+        ("startup first home", "/"),
+        ("startup first scansummary antenna", f"/graphs/scansummary/antennaapi?antenna={antenna}"),
+        ("startup first trackchannel api", f"/graphs/trackchannel/api?antenna={antenna}&measurement=snq&width=1700"),
+    ]
+
+
+def methods(store):
+    """Graph method cases: (name, function returning the result)
+    """
+    from channel_distribution import ChannelDistribution
+    from scan_summary import ScanSummary
+    from track_channel import TrackChannels
+
+    antenna = store.default_antenna
+    channel = store.channels(antenna)[-1]
+
+    return [
+        ("TrackChannels.get_figure", lambda: TrackChannels().get_figure(antenna=antenna)),
+        ("TrackChannels.get_figure points", lambda: TrackChannels().get_figure(antenna=antenna, points=1700, measurements=["snq"])),
+        ("TrackChannels.get_json", lambda: TrackChannels().get_json(antenna=antenna)),
+        ("ScanSummary.get_figure", lambda: ScanSummary().get_figure(antenna=antenna)),
+        ("ScanSummary.get_antenna_range", lambda: ScanSummary().get_antenna_range(antenna=antenna)),
+        ("ScanSummary.get_timeline", lambda: ScanSummary().get_timeline(antenna=antenna)),
+        ("ChannelDistribution.get_figure", lambda: ChannelDistribution().get_figure(channel=channel, antenna=antenna)),
+        ("ChannelDistribution.get_figures", lambda: ChannelDistribution().get_figures(antenna=antenna)),
+        ("ChannelDistribution.get_channel_map", lambda: ChannelDistribution().get_channel_map(antenna=antenna)),
+        ("ChannelDistribution.get_weather_map", lambda: ChannelDistribution().get_weather_map(antenna=antenna)),
+    ]
+
+
+def measure(run, repeat):
+    """Latency percentiles (ms), peak traced memory (MiB) and payload size (bytes) of run
+
+    @param[in] run - function returning the payload size
+    @param[in] repeat - timed runs
+    @return result - dict
+    """
+    seconds = []
+
+    for i in range(repeat):
+        start = time.perf_counter()
+        size = run()
+        seconds.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    p50, p90, p99 = np.percentile(np.array(seconds) * 1000, [50, 90, 99])
+    return {"p50": float(p50), "p90": float(p90), "p99": float(p99), "max": max(seconds) * 1000, "peak": peak / 2 ** 20, "bytes": size}
+
+
+def startup(url, repeat, workers):
+    """Import and first request latencies (ms) of fresh app processes
+
+    @param[in] url - first request
+    @param[in] repeat - processes started
+    @param[in] workers - jobs.workers of the processes
+    @return imported, first - results (see measure), peak is the peak RSS
+    """
+    runs = []
+
+    for i in range(repeat):
+        output = subprocess.run([sys.executable, "-c", _boot, url, str(workers)], env=dict(os.environ, PYTHONPATH=app_dir),
+                                stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+        runs.append([float(value) for value in output.split()])
+
+    imported, first, rss = np.array(runs).T
+    peak = rss.max() / 1024
+
+    def result(seconds):
+        p50, p90, p99 = np.percentile(seconds * 1000, [50, 90, 99])
+        return {"p50": float(p50), "p90": float(p90), "p99": float(p99), "max": float(seconds.max() * 1000), "peak": peak, "bytes": 0}
+
+    return result(imported), result(first)
+
+
+def compare(results, baseline, tolerance) -> list:
+    """Names of the cases whose p50 or peak memory regressed past the tolerance
+    """
+    regressions = []
+
+    for name, result in results.items():
+        before = baseline.get(name)
+
+        if before is None:
+            continue
+
+        # Sub-millisecond cases are noise
+        if (result["p50"] > before["p50"] * (1 + tolerance) and result["p50"] - before["p50"] > 1
+                or result["peak"] > before["peak"] * (1 + tolerance) and result["peak"] - before["peak"] > 1):
+            regressions.append(name)
+
+    return regressions
+
+
+def report(results, baseline, regressions):
+    print(f"{'case':<38}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}{'peak MiB':>10}{'bytes':>12}{'p50 vs base':>13}{'peak vs base':>14}")
+
+    for name, result in results.items():
+        line = (f"{name:<38}{result['p50']:>10.1f}{result['p90']:>10.1f}{result['p99']:>10.1f}{result['max']:>10.1f}"
+                f"{result['peak']:>10.1f}{result['bytes']:>12}")
+
+        if name in baseline:
+            before = baseline[name]
+            line += f"{result['p50'] / max(before['p50'], 1e-9):>12.2f}x{result['peak'] / max(before['peak'], 1e-9):>13.2f}x"
+
+        print(line + ("  REGRESSED" if name in regressions else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("db", help="monitor.db to benchmark against (see generate.py)")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--baseline", default=os.path.join(here, "baseline.json"))
+    parser.add_argument("--save", action="store_true", help="store the results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown or memory growth (0.25 = 25%%)")
+    parser.add_argument("--pool", action="store_true", help="run graph jobs in the process pool")
+    args = parser.parse_args()
+
+    path = os.path.abspath(args.db)
+    first, last = _scan_times(path)
+    workdir = tempfile.mkdtemp(prefix="airwaves-bench-")
+    os.symlink(path, os.path.join(workdir, "monitor.db"))
+
+    # The app looks its templates and static files up in the working directory
+    for folder in ["templates", "static"]:
+        os.symlink(os.path.abspath(os.path.join(app_dir, folder)), os.path.join(workdir, folder))
+    os.chdir(workdir)
+
+    from warmer import warmer
+    warmer.enabled = False
+
+    import app
+    import jobs
+    import figures
+    import rollup
+    from cube import cubes
+    from metadata import store
+
+    rollup.refresh()
+    cubes.refresh()
+
+    if not args.pool:
+        jobs.workers = 0
+
+    client = app.app.test_client()
+    results = {}
+    covered = set()
+
+    for name, url in boots(store):
+        imported, request = startup(url, args.repeat, jobs.workers)
+        results.setdefault("startup import", imported)
+        results[name] = request
+
+    for name, url in endpoints(store, first, last):
+        def request(url=url):
+            app.cache.clear()
+            response = client.get(url)
+            assert response.status_code == 200, f"{url}: {response.status_code}"
+            return len(response.data)
+
+        results[name] = measure(request, args.repeat)
+        covered.add(app.app.url_map.bind("").match(url.split("?")[0])[0])
+
+    for name, function in methods(store):
+        def call(function=function):
+            result = function()
+            return len(result.encode()) if isinstance(result, str) else len(figures.dumps(result))
+
+        results[name] = measure(call, args.repeat)
+
+    uncovered = {rule.endpoint for rule in app.app.url_map.iter_rules()} - covered - {"static"}
+
+    if uncovered:
+        print("Endpoints without a case:", ", ".join(sorted(uncovered)))
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as stored:
+            stored = json.load(stored)
+
+        if stored["rows"] != _rows(path):
+            print("The baseline was measured against a different db:", stored["rows"])
+
+        baseline = stored["results"]
+
+    regressions = [] if args.save else compare(results, baseline, args.tolerance)
+    report(results, baseline, regressions)
+
+    if args.save:
+        with open(args.baseline, "w") as stored:
+            json.dump({"rows": _rows(path), "python": platform.python_version(), "machine": platform.platform(),
+                       "pool": args.pool, "results": results}, stored, indent=1)
+
+        print("Saved the baseline to", args.baseline)
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
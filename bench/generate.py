@@ -0,0 +1,123 @@
+"""Generates a synthetic monitor.db at a configurable scale
+
+The tables and columns match those the app reads (monitor, antenna, scan,
+signal, mapping and weather). Every antenna scans every channel each
+interval; signal quality follows a per channel baseline with a daily cycle,
+weather a seasonal one. A few scans have no weather row or two of them,
+and some channels aren't received by some antennas (snq 0), as in the
+real db. Rows are generated with NumPy a day at a time, so even multi year
+dbs are built in minutes.
+
+    python generate.py monitor.db --antennas 10 --channels 40 --days 1825
+"""
+
+import argparse
+import os
+import sqlite3 as sql
+
+import numpy as np
+
+schema = """
+CREATE TABLE monitor (configured_antenna_instance INTEGER);
+CREATE TABLE antenna (antenna_instance INTEGER PRIMARY KEY, name TEXT, location TEXT, direction INTEGER, comment TEXT);
+CREATE TABLE scan (scan_instance INTEGER PRIMARY KEY, antenna_instance INTEGER, start_time INTEGER);
+CREATE TABLE signal (scan_instance INTEGER, channel INTEGER, ss INTEGER, snq INTEGER, seq INTEGER);
+CREATE TABLE mapping (channel INTEGER, virtual TEXT);
+CREATE TABLE weather (start_time INTEGER, reference_time INTEGER, status TEXT, temperature REAL,
+                      wind_direction INTEGER, wind_speed REAL, humidity INTEGER, sunset INTEGER);
+"""
+
+statuses = ["Clear", "Clouds", "Rain", "Drizzle", "Mist", "Snow", "Thunderstorm", "Fog"]
+
+# 2020-01-01 00:00:00 GMT-04:00
+epoch = 1577851200
+
+
+def generate(path, antennas=2, channels=10, days=30, interval=30, seed=0):
+    """Writes a synthetic monitor.db (replacing any file at path)
+
+    @param[in] path - path to database
+    @param[in] antennas - number of antennas
+    @param[in] channels - real channels per antenna
+    @param[in] days - days of scans
+    @param[in] interval - minutes between scans of an antenna
+    @param[in] seed - random seed (the same arguments build the same db)
+    @return rows - dict of table -> number of rows
+    """
+    if os.path.exists(path):
+        os.remove(path)
+
+    rng = np.random.default_rng(seed)
+    conn = sql.connect(path)
+    conn.executescript(schema)
+
+    real = np.sort(rng.choice(np.arange(2, 52), size=min(channels, 50), replace=False))
+    conn.execute("INSERT INTO monitor VALUES (1)")
+    conn.executemany("INSERT INTO antenna VALUES (?, ?, ?, ?, ?)",
+                     [(antenna, f"Antenna {antenna}", "Boston", int(rng.integers(0, 360)), "") for antenna in range(1, antennas + 1)])
+    conn.executemany("INSERT INTO mapping VALUES (?, ?)",
+                     [(int(channel), f"{channel}.{subchannel} W{channel:02d}TV-{subchannel}")
+                      for channel in real for subchannel in range(1, int(rng.integers(1, 4)) + 1)])
+
+    # Per antenna & channel: mean quality (0 when the channel isn't received) and daily swing
+    baseline = rng.uniform(20, 95, size=(antennas, len(real))) * (rng.random((antennas, len(real))) > 0.1)
+    swing = rng.uniform(0, 15, size=(antennas, len(real)))
+
+    per_day = 24 * 60 // interval
+    scan_instance = 1
+
+    for day in range(days):
+        # Scan rounds of the day, antennas scan a minute apart
+        rounds = epoch + day * 86400 + np.arange(per_day) * interval * 60
+        times = (rounds[:, None] + np.arange(antennas)[None, :] * 60).ravel()
+        antenna = np.tile(np.arange(1, antennas + 1), per_day)
+        instances = np.arange(scan_instance, scan_instance + len(times))
+        scan_instance += len(times)
+
+        conn.executemany("INSERT INTO scan VALUES (?, ?, ?)", zip(instances.tolist(), antenna.tolist(), times.tolist()))
+
+        hour = (times % 86400) / 3600
+        cycle = np.sin((hour - 14) / 24 * 2 * np.pi)[:, None]
+        snq = baseline[antenna - 1] + swing[antenna - 1] * cycle + rng.normal(0, 6, size=(len(times), len(real)))
+        snq = np.where(baseline[antenna - 1] > 0, np.clip(snq, 0, 100), 0).round().astype(int)
+        ss = np.clip(snq * 0.4 + 55 + rng.normal(0, 4, size=snq.shape), 0, 100).round().astype(int)
+        seq = np.where(snq > 35, 100, 0)
+
+        conn.executemany("INSERT INTO signal VALUES (?, ?, ?, ?, ?)", zip(
+            np.repeat(instances, len(real)).tolist(), np.tile(real, len(times)).tolist(),
+            ss.ravel().tolist(), snq.ravel().tolist(), seq.ravel().tolist()))
+
+        # Weather of each scan (2% have none, 0.5% two rows)
+        copies = rng.choice([0, 1, 2], size=len(times), p=[0.02, 0.975, 0.005])
+        weather_times = np.repeat(times, copies)
+        season = np.cos((day % 365 - 200) / 365 * 2 * np.pi)
+        temperature = 50 + 25 * season + 10 * np.sin((weather_times % 86400 / 3600 - 9) / 24 * 2 * np.pi) + rng.normal(0, 3, len(weather_times))
+        sunset = epoch + day * 86400 + int((19.5 - 1.5 * season) * 3600)
+
+        conn.executemany("INSERT INTO weather VALUES (?, ?, ?, ?, ?, ?, ?, ?)", zip(
+            weather_times.tolist(), (weather_times // 3600 * 3600).tolist(),
+            rng.choice(statuses, size=len(weather_times), p=[0.3, 0.3, 0.15, 0.05, 0.05, 0.08, 0.02, 0.05]).tolist(),
+            temperature.round(1).tolist(), rng.integers(0, 361, len(weather_times)).tolist(),
+            rng.gamma(2, 4, len(weather_times)).round(2).tolist(), rng.integers(20, 101, len(weather_times)).tolist(),
+            [sunset] * len(weather_times)))
+
+        conn.commit()
+
+    rows = {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            for table in ["monitor", "antenna", "scan", "signal", "mapping", "weather"]}
+    conn.close()
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path", nargs="?", default="monitor.db")
+    parser.add_argument("--antennas", type=int, default=2)
+    parser.add_argument("--channels", type=int, default=10)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--interval", type=int, default=30, help="minutes between scans")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rows = generate(args.path, args.antennas, args.channels, args.days, args.interval, args.seed)
+    print(", ".join(f"{table}: {count}" for table, count in rows.items()))
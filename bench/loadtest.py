@@ -0,0 +1,289 @@
+"""Load tests the graph APIs while a simulated scanner writes to monitor.db
+
+Client threads replay a mix of Track Channel, Scan Summary and Channel
+Distribution API requests (random antennas, channels, widths, viewports,
+scan times and filters) at a fixed concurrency, while a writer process
+inserts a scan (scan, signal and weather rows in one transaction) every
+few seconds, as the scanner does. Throughput, latency percentiles and
+statuses are reported per API; 503s are requests that hit "database is
+locked" (the app's DB_BUSY_TIMEOUT ran out), 429s ones the job pool
+refused. The writer's commit latency and its lock errors are reported too.
+
+    python loadtest.py monitor.db --concurrency 16 --duration 60
+    python loadtest.py monitor.db --concurrency 16 --duration 60 --wal
+
+The app runs in this process, behind a threaded HTTP server, in a
+temporary directory with a copy of the db (the writer never touches the
+original), so --wal compares the journal modes on the same data. With
+--url the requests go to a running app instead and the writer writes to
+the db given, which must be that app's monitor.db.
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3 as sql
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+app_dir = os.path.join(here, os.pardir, "app")
+sys.path.insert(0, app_dir)
+
+# Relative frequency of each API in the mix
+mix = {"trackchannel": 4, "scansummary": 3, "channeldistribution": 3}
+
+statuses = ["Clear", "Clouds", "Rain", "Mist"]
+
+
+def _local(timestamp):
+    # GMT-04:00 datetime str, as the Track Channel page sends (quoted)
+    return urllib.parse.quote(time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(timestamp - 4 * 3600)))
+
+
+class Traffic():
+    """Random requests of each API, drawn from the db's antennas, channels and time range
+    """
+    def __init__(self, path):
+        conn = sql.connect(path)
+        self.first, self.last = conn.execute("SELECT MIN(start_time), MAX(start_time) FROM scan").fetchone()
+        self.channels = {}
+
+        for antenna, channel in conn.execute("""SELECT DISTINCT antenna_instance, channel FROM signal
+                                                INNER JOIN scan ON signal.scan_instance = scan.scan_instance
+                                                WHERE signal.scan_instance>(SELECT MAX(scan_instance) FROM scan) - 1000 AND snq>0"""):
+            self.channels.setdefault(antenna, []).append(channel)
+
+        conn.close()
+        self.antennas = sorted(self.channels)
+
+    def url(self, api, rng):
+        antenna = rng.choice(self.antennas)
+
+        if api == "trackchannel":
+            url = f"/graphs/trackchannel/api?antenna={antenna}&measurement=snq&width={rng.choice([1200, 1300, 1400, 1700])}"
+
+            # Half the requests zoom into a viewport of a few days
+            if rng.random() < 0.5:
+                end = rng.randint(self.first, self.last)
+                url = url.replace("/api?", "/viewportapi?") + f"&start={_local(end - rng.randint(1, 7) * 86400)}&end={_local(end)}"
+
+            return url
+
+        if api == "scansummary":
+            return f"/graphs/scansummary/scanapi?antenna={antenna}&scantime={rng.randint(self.first, self.last)}"
+
+        url = f"/graphs/channeldistribution/channelapi?channel={rng.choice(self.channels[antenna])}&antenna={antenna}"
+
+        # Half the requests filter on temperature
+        if rng.random() < 0.5:
+            low = rng.randint(0, 60)
+            url += f"&temp={low}&temp={low + rng.randint(10, 40)}"
+
+        return url
+
+
+def client(base, traffic, stop, results, seed):
+    """Requests random APIs back to back until stop is set
+
+    @param[in] results - list of (api, status, seconds, locked) appended to
+    """
+    rng = random.Random(seed)
+    apis, weights = zip(*mix.items())
+
+    while not stop.is_set():
+        api = rng.choices(apis, weights)[0]
+        start = time.perf_counter()
+
+        try:
+            with urllib.request.urlopen(base + traffic.url(api, rng), timeout=120) as response:
+                response.read()
+                status, body = response.status, b""
+        except urllib.error.HTTPError as error:
+            status, body = error.code, error.read()
+        except OSError:
+            status, body = 0, b""
+
+        results.append((api, status, time.perf_counter() - start, b"database is busy" in body))
+
+
+def writer(path, interval, hold, timeout, stop, results):
+    """Inserts a scan of the next antenna every interval seconds until stop is set
+
+    Runs in a process of its own, like the scanner. Each scan copies the
+    channels of the antenna's latest scan with new signal values, and gets
+    a weather row. hold seconds are slept inside the transaction, like a
+    slow scanner.
+
+    @param[in] results - queue the commit latencies (seconds) & lock error strs are put on
+    """
+    commits, errors = [], []
+    conn = sql.connect(path, timeout=timeout, isolation_level=None)
+    rng = np.random.default_rng(0)
+    antennas = [antenna for (antenna,) in conn.execute("SELECT DISTINCT antenna_instance FROM scan ORDER BY antenna_instance")]
+    scan_instance, start_time = conn.execute("SELECT MAX(scan_instance), MAX(start_time) FROM scan").fetchone()
+    turn = 0
+
+    while not stop.wait(interval):
+        antenna = antennas[turn % len(antennas)]
+        scan_instance, start_time, turn = scan_instance + 1, start_time + 60, turn + 1
+        start = time.perf_counter()
+
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            channels = [channel for (channel,) in conn.execute(
+                "SELECT channel FROM signal WHERE scan_instance=(SELECT MAX(scan_instance) FROM scan WHERE antenna_instance=?)", (antenna,))]
+            snq = rng.integers(0, 101, len(channels))
+
+            conn.execute("INSERT INTO scan (scan_instance, antenna_instance, start_time) VALUES (?, ?, ?)", (scan_instance, antenna, start_time))
+            conn.executemany("INSERT INTO signal (scan_instance, channel, ss, snq, seq) VALUES (?, ?, ?, ?, ?)",
+                             [(scan_instance, channel, int(value * 0.4 + 55), int(value), 100 if value > 35 else 0)
+                              for channel, value in zip(channels, snq)])
+            conn.execute("""INSERT INTO weather (start_time, reference_time, status, temperature, wind_direction, wind_speed, humidity, sunset)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                         (start_time, start_time // 3600 * 3600, statuses[turn % len(statuses)], float(rng.normal(60, 10)),
+                          int(rng.integers(0, 361)), float(rng.gamma(2, 4)), int(rng.integers(20, 101)), start_time + 3600))
+            time.sleep(hold)
+            conn.execute("COMMIT")
+            commits.append(time.perf_counter() - start)
+        except sql.OperationalError as error:
+            errors.append(str(error))
+
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+
+    conn.close()
+    results.put((commits, errors))
+
+
+def serve(path, wal, busy_timeout, job_workers):
+    """Starts the app behind a threaded HTTP server in a temporary directory holding a copy of the db
+
+    @return base - base url of the server
+    """
+    workdir = tempfile.mkdtemp(prefix="airwaves-load-")
+    shutil.copy(path, os.path.join(workdir, "monitor.db"))
+
+    # The app looks its templates and static files up in the working directory
+    for folder in ["templates", "static"]:
+        os.symlink(os.path.abspath(os.path.join(app_dir, folder)), os.path.join(workdir, folder))
+    os.chdir(workdir)
+
+    from werkzeug.serving import make_server
+
+    import app
+    import db
+    import jobs
+
+    db.busy_timeout = busy_timeout
+    db.close_connections()
+
+    if wal:
+        db.journal_mode = "WAL"
+        db.migrate()
+
+    if job_workers is not None:
+        jobs.workers = job_workers
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING) # no line per request
+    server = make_server("127.0.0.1", 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="server", daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def report(results, duration, commits, errors, journal_mode):
+    print(f"journal mode {journal_mode}, {len(results)} requests in {duration:.1f} s ({len(results) / duration:.1f}/s)")
+    print(f"{'api':<22}{'requests':>10}{'per s':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}{'locked':>8}  statuses")
+
+    for api in [*mix, "all"]:
+        rows = results if api == "all" else [row for row in results if row[0] == api]
+
+        if not rows:
+            continue
+
+        seconds = np.array([row[2] for row in rows]) * 1000
+        p50, p90, p99 = np.percentile(seconds, [50, 90, 99])
+        counts = {}
+
+        for row in rows:
+            counts[row[1]] = counts.get(row[1], 0) + 1
+
+        print(f"{api:<22}{len(rows):>10}{len(rows) / duration:>8.1f}{p50:>10.1f}{p90:>10.1f}{p99:>10.1f}{seconds.max():>10.1f}"
+              f"{sum(row[3] for row in rows):>8}  {json.dumps(dict(sorted(counts.items())))}")
+
+    if commits:
+        p50, p99 = np.percentile(np.array(commits) * 1000, [50, 99])
+        print(f"writer: {len(commits)} scans, commit p50 {p50:.1f} ms, p99 {p99:.1f} ms, max {max(commits) * 1000:.1f} ms, "
+              f"{len(errors)} lock errors")
+    else:
+        print(f"writer: no scans, {len(errors)} lock errors")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("db", help="monitor.db (copied unless --url is given, see generate.py)")
+    parser.add_argument("--concurrency", type=int, default=16, help="client threads")
+    parser.add_argument("--duration", type=float, default=60, help="seconds")
+    parser.add_argument("--write-interval", type=float, default=2, help="seconds between scans written (0 disables the writer)")
+    parser.add_argument("--write-hold", type=float, default=0.1, help="seconds each write transaction stays open")
+    parser.add_argument("--wal", action="store_true", help="switch the copy to WAL mode (DB_JOURNAL_MODE)")
+    parser.add_argument("--busy-timeout", type=int, default=5000, help="milliseconds reads wait on locks (DB_BUSY_TIMEOUT)")
+    parser.add_argument("--job-workers", type=int, default=None, help="graph job processes (default JOB_WORKERS)")
+    parser.add_argument("--url", help="base url of a running app to load instead (the writer writes to db)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    path = os.path.abspath(args.db)
+    traffic = Traffic(path)
+
+    if args.url:
+        base = args.url.rstrip("/")
+    else:
+        base = serve(path, args.wal, args.busy_timeout, args.job_workers)
+        path = os.path.abspath("monitor.db")
+
+    conn = sql.connect(path)
+    journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+    conn.close()
+
+    # Spawned, so the writer shares no sqlite state with the app
+    context = multiprocessing.get_context("spawn")
+    stop, written = threading.Event(), context.Event()
+    results, writes = [], context.Queue()
+    threads = [threading.Thread(target=client, args=(base, traffic, stop, results, args.seed + i), daemon=True)
+               for i in range(args.concurrency)]
+    scanner = context.Process(target=writer, args=(path, args.write_interval, args.write_hold, args.busy_timeout / 1000, written, writes))
+
+    if args.write_interval > 0:
+        scanner.start()
+
+    start = time.perf_counter()
+
+    for thread in threads:
+        thread.start()
+
+    time.sleep(args.duration)
+    stop.set()
+    written.set()
+
+    for thread in threads:
+        thread.join()
+
+    commits, errors = writes.get() if args.write_interval > 0 else ([], [])
+    report(results, time.perf_counter() - start, commits, errors, journal_mode)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,76 @@
+import os
+import shutil
+import sys
+import threading
+
+import pytest
+
+# The app modules import each other by their flat names (run from app/), generate.py is in bench/
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, os.pardir, "app"))
+sys.path.insert(0, os.path.join(here, os.pardir, "bench"))
+
+
+@pytest.fixture(scope="session")
+def generated_db(tmp_path_factory):
+    """monitor.db built by bench/generate.py (2 antennas, 6 channels, 3 days of hourly scans)
+    """
+    import generate
+
+    path = tmp_path_factory.mktemp("generated") / "monitor.db"
+    generate.generate(str(path), antennas=2, channels=6, days=3, interval=60, seed=1)
+    return path
+
+
+@pytest.fixture
+def generated(generated_db, tmp_path, monkeypatch):
+    """Working directory holding a copy of the generated monitor.db, with fresh module state
+
+    The db, snapshot and rollup paths are relative to the working directory.
+    The metadata store, cubes & graph objects are replaced by new ones for the test.
+    """
+    import cube
+    import db
+    import graphs
+    import metadata
+    import snapshot
+
+    shutil.copy(generated_db, tmp_path / "monitor.db")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(snapshot, "_datasets", {})
+    monkeypatch.setattr(graphs, "_local", threading.local())
+
+    store = metadata.MetadataStore()
+    for module in [sys.modules[name] for name in ["metadata", "cube", "channel_distribution", "track_channel", "scan_summary", "warmer"]
+                   if name in sys.modules]:
+        monkeypatch.setattr(module, "store", store)
+
+    cubes = cube.CubeStore()
+    for module in [sys.modules[name] for name in ["cube", "channel_distribution"] if name in sys.modules]:
+        monkeypatch.setattr(module, "cubes", cubes)
+
+    yield tmp_path
+
+    # A cube loader started by the test must not outlive its working directory
+    if cubes._loader is not None:
+        cubes._loader.join()
+
+    db.close_connections()
+
+
+@pytest.fixture
+def client(generated, monkeypatch):
+    """Flask test client of the app, answering on the generated db with jobs run in the request's thread
+    """
+    import warmer
+
+    monkeypatch.setattr(warmer.warmer, "enabled", False)
+
+    import app
+    import jobs
+
+    monkeypatch.setattr(jobs, "workers", 0)
+    # Entries are keyed by data version, which each test's copy of the db shares
+    app.cache.clear()
+
+    return app.app.test_client()
@@ -0,0 +1,151 @@
+import csv
+import functools
+import io
+import json
+import sqlite3
+
+import pytest
+
+import db
+
+# 2020-01-01 00:00:00 GMT-04:00, the first scan of generate.py's dbs (3 days of hourly scans)
+epoch = 1577851200
+
+api = "/graphs/trackchannel/api?antenna=1&measurement=snq"
+
+
+def add_scan(channels, scan_time=epoch + 3 * 86400):
+    # A scan of antenna 1 with weather, returns its scan_instance
+    with sqlite3.connect("monitor.db") as conn:
+        scan_instance = conn.execute("SELECT MAX(scan_instance) FROM scan").fetchone()[0] + 1
+        conn.execute("INSERT INTO scan VALUES (?, 1, ?)", (scan_instance, scan_time))
+        conn.executemany("INSERT INTO signal VALUES (?, ?, 60, 70, 100)", [(scan_instance, channel) for channel in channels])
+        conn.execute("INSERT INTO weather VALUES (?, ?, 'Clear', 40, 10, 2, 50, ?)", (scan_time, scan_time, scan_time))
+
+    return scan_instance
+
+
+def test_since_returns_only_later_scans(client):
+    full = client.get(api).get_json()
+    version = full["version"]
+    traces = full["figure"]["data"]
+
+    with sqlite3.connect("monitor.db") as conn:
+        scans = [row[0] for row in conn.execute("SELECT scan_instance FROM scan WHERE antenna_instance=1 ORDER BY scan_instance")]
+
+    assert version == scans[-1]
+
+    # Antenna 1's scans after the cursor, those of other antennas in between don't count
+    delta = client.get(f"{api}&since={scans[-4]}").get_json()
+    assert delta["version"] == version
+    assert len(delta["figure"]["data"]) == len(traces)
+    assert delta["figure"]["data"][0]["x"] == traces[0]["x"][-3:]
+    assert [trace["y"] for trace in delta["figure"]["data"]] == [trace["y"][-3:] for trace in traces]
+    assert delta["annotations"] == full["annotations"][-3:]
+
+    # Nothing new: no points, and the same version
+    delta = client.get(f"{api}&since={version}").get_json()
+    assert delta["version"] == version
+    assert all(len(trace["y"]) == 0 for trace in delta["figure"]["data"])
+
+    # A new scan is the only point of the next poll
+    channels = sorted(int(channel) for channel in full["labels"])
+    scan_instance = add_scan(channels)
+    delta = client.get(f"{api}&since={version}").get_json()
+
+    assert delta["version"] == scan_instance
+    assert len(delta["figure"]["data"]) == len(traces)
+    assert [trace["y"] for trace in delta["figure"]["data"]] == [[70]] * len(traces)
+
+
+def test_stale_cursor_after_new_channels_reloads(client):
+    full = client.get(api).get_json()
+    channels = sorted(int(channel) for channel in full["labels"])
+
+    scan_instance = add_scan(channels + [60])
+
+    # The page reloads the antenna when a poll's traces don't match its plotted ones
+    delta = client.get(f"{api}&since={full['version']}").get_json()
+    assert delta["version"] == scan_instance
+    assert len(delta["figure"]["data"]) == len(full["figure"]["data"]) + 1
+
+    reloaded = client.get(api).get_json()
+    assert reloaded["version"] == scan_instance
+    assert "60" in reloaded["labels"]
+    assert len(reloaded["figure"]["data"]) == len(delta["figure"]["data"])
+    assert [trace["y"][-1] for trace in reloaded["figure"]["data"] if trace["name"] == "60"] == [70]
+
+
+def exported_rows(channels, start=None):
+    # Rows of antenna 1 as the export reads them, one per scan & channel in scan order
+    query = """SELECT signal.scan_instance, datetime(scan.start_time,'unixepoch','-4 hours'), channel, snq, status, temperature,
+               wind_direction, wind_speed, humidity FROM signal INNER JOIN scan ON signal.scan_instance = scan.scan_instance
+               LEFT JOIN weather ON scan.start_time = weather.start_time WHERE antenna_instance=1 AND scan.start_time>=?
+               ORDER BY scan.start_time, scan.scan_instance, channel"""
+
+    with sqlite3.connect("monitor.db") as conn:
+        rows = conn.execute(query, (start or 0,)).fetchall()
+
+    return [row for i, row in enumerate(rows) if row[2] in channels and (i == 0 or row[:3] != rows[i - 1][:3])]
+
+
+@pytest.fixture
+def small_chunks(client, monkeypatch):
+    # Chunks of 7 rows end mid scan, and rows repeated by scans with two weather rows straddle chunk boundaries
+    import track_channel
+
+    monkeypatch.setattr(track_channel, "stream", functools.partial(db.stream, size=7))
+
+    with sqlite3.connect("monitor.db") as conn:
+        scan_time = conn.execute("SELECT start_time FROM scan WHERE antenna_instance=1 ORDER BY start_time LIMIT 1 OFFSET 10").fetchone()[0]
+        conn.execute("INSERT INTO weather VALUES (?, ?, 'Rain', 35, 20, 3, 90, ?)", (scan_time, scan_time, scan_time))
+
+    return client
+
+
+def test_csv_export_streams_every_row_in_scan_order(small_chunks):
+    channels = sorted(int(channel) for channel in small_chunks.get(api).get_json()["labels"])
+    response = small_chunks.get("/graphs/trackchannel/export?antenna=1&measurement=snq&format=csv")
+    chunks = list(response.response)
+    response.close()
+
+    assert response.status_code == 200 and response.mimetype == "text/csv"
+    assert len(chunks) > 2
+
+    lines = list(csv.reader(io.StringIO(b"".join(chunks).decode())))
+    expected = exported_rows(channels)
+
+    assert lines[0] == ["scan_instance", "start_time", "channel", "snq", "status", "temperature", "wind_direction", "wind_speed", "humidity"]
+    assert lines[1:] == [["" if value is None else str(value) for value in row] for row in expected]
+
+
+def test_ndjson_export_streams_each_channels_series_in_scan_order(small_chunks):
+    channels = sorted(int(channel) for channel in small_chunks.get(api).get_json()["labels"])
+    start = "2020-01-02 06:30:00"
+    response = small_chunks.get(f"/graphs/trackchannel/export?antenna=1&measurement=snq&start={start}")
+    body = response.get_data()
+
+    assert response.status_code == 200 and response.mimetype == "application/x-ndjson"
+
+    # A line per channel and chunk, appending to the channel's series
+    lines = [json.loads(line) for line in body.decode().splitlines()]
+    series = {}
+
+    for line in lines:
+        rows = list(zip(line["scan_instance"], line["start_time"], line["snq"], line["status"], line["temperature"],
+                        line["wind_direction"], line["wind_speed"], line["humidity"]))
+        series.setdefault(line["channel"], []).extend(rows)
+
+    assert len(lines) > len(channels)
+
+    expected = exported_rows(channels, start=epoch + 86400 + 6 * 3600 + 1800)
+    assert sorted(series) == channels
+    assert series == {channel: [row[:2] + row[3:] for row in expected if row[2] == channel] for channel in channels}
+
+
+@pytest.mark.parametrize("args", ["start=yesterday", "end=2020-13-01", "format=xml"])
+def test_bad_export_args_get_a_400_before_the_stream(client, args):
+    response = client.get(f"/graphs/trackchannel/export?antenna=1&{args}")
+
+    assert response.status_code == 400
+    assert response.mimetype == "application/json" and "error" in response.get_json()
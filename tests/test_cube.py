@@ -0,0 +1,86 @@
+import pytest
+
+import channel_distribution
+import cube
+import snapshot
+
+columns = ["scan_instance", "channel", "ss", "snq", "seq", "start_time", "status", "temperature"]
+
+# (filter_conditions, inversetod), hours of day in seconds as the api passes them
+unfiltered = {"hour_of_day": [], "weather.start_time": [], "temperature": [], "wind_direction": [], "wind_speed": [],
+              "humidity": [], "status": None}
+filter_sets = [
+    (None, False),
+    (dict(unfiltered, temperature=[20, 30]), False),
+    (dict(unfiltered, hour_of_day=[6 * 3600, 18 * 3600]), False),
+    (dict(unfiltered, hour_of_day=[20 * 3600, 6 * 3600]), True),
+    (dict(unfiltered, status="Clear"), False),
+    (dict(unfiltered, **{"weather.start_time": [1577894400, 1578000000], "humidity": [30, 80]}), False),
+    (dict(unfiltered, wind_speed=[0, 10], wind_direction=[0, 180], status="Clouds"), False),
+]
+
+
+def rows(df):
+    # The SQL query selects some weather columns twice
+    df = df.loc[:, ~df.columns.duplicated()]
+    values = df[columns].astype(object).where(df[columns].notna(), None).values.tolist()
+    return sorted(repr([float(value) if isinstance(value, (int, float)) else value for value in row]) for row in values)
+
+
+def built(graph, antenna, filter_conditions, inversetod):
+    graph._build_df(channel_distribution.store.channels(antenna), antenna, filter_conditions, inversetod)
+    return graph.df
+
+
+@pytest.mark.parametrize("filter_conditions, inversetod", filter_sets)
+def test_cubes_snapshot_and_sql_return_the_same_rows(generated, monkeypatch, filter_conditions, inversetod):
+    pytest.importorskip("pyarrow")
+    monkeypatch.setattr(cube, "window_scans", 7) # several windows per antenna
+
+    graph = channel_distribution.ChannelDistribution()
+    channel_distribution.cubes.refresh()
+    snapshot.refresh()
+
+    for antenna in channel_distribution.store.antennas:
+        from_cubes = built(graph, antenna, filter_conditions, inversetod)
+
+        with monkeypatch.context() as patched:
+            patched.setattr(channel_distribution.cubes, "query", lambda *args: None)
+            from_snapshot = built(graph, antenna, filter_conditions, inversetod)
+
+            patched.setattr(snapshot, "query", lambda *args: None)
+            from_sql = built(graph, antenna, filter_conditions, inversetod)
+
+        assert len(from_sql)
+        assert rows(from_cubes) == rows(from_sql)
+        assert rows(from_snapshot) == rows(from_sql)
+
+
+def test_scans_without_weather_have_null_weather(generated):
+    cubes = channel_distribution.cubes
+    cubes.refresh()
+    df = cubes.query(1, ["scan_instance", "start_time", "status", "temperature"])
+    missing = df["start_time"].isna()
+
+    assert missing.any()
+    assert df.loc[missing, "status"].isna().all() and df.loc[missing, "temperature"].isna().all()
+    assert not cubes.query(1, ["scan_instance"], [("temperature", ">=", -1000)])["scan_instance"].isin(df.loc[missing, "scan_instance"]).any()
+
+
+def test_refresh_appends_new_scans(generated):
+    import sqlite3
+
+    cubes = channel_distribution.cubes
+    cubes.refresh()
+    before = len(cubes.query(2, ["scan_instance"]))
+
+    with sqlite3.connect("monitor.db") as conn:
+        latest, start_time = conn.execute("SELECT MAX(scan_instance), MAX(start_time) FROM scan").fetchone()
+        conn.execute("INSERT INTO scan VALUES (?, 2, ?)", (latest + 1, start_time + 3600))
+        conn.executemany("INSERT INTO signal VALUES (?, ?, 60, 70, 100)", [(latest + 1, 5), (latest + 1, 99)])
+
+    cubes.refresh()
+    df = cubes.query(2, ["scan_instance", "channel", "snq"], [("scan_instance", ">", latest)])
+
+    assert len(cubes.query(2, ["scan_instance"])) == before + 2
+    assert sorted(df["channel"].tolist()) == [5, 99]
@@ -0,0 +1,122 @@
+import numpy as np
+
+import density
+
+
+def gaussian_kde(samples, x):
+    # Reference kernel density (scipy.stats.gaussian_kde with Scott's rule), one sample at a time
+    samples = np.asarray(samples, dtype=float)
+    bandwidth = samples.std(ddof=1) * len(samples) ** (-1 / 5)
+
+    return sum(np.exp(-0.5 * ((x - sample) / bandwidth) ** 2) for sample in samples) / (len(samples) * bandwidth * np.sqrt(2 * np.pi))
+
+
+def test_support_counts_distinct_values():
+    values, counts = density.support([[3, 1, 3, np.nan], [1, 2]])
+
+    assert values.tolist() == [1, 2, 3]
+    assert counts.tolist() == [[1, 0, 2], [1, 1, 0]]
+
+
+def test_support_weights():
+    values, counts = density.support([[1, 2]], weights=[[5, 3]])
+
+    assert values.tolist() == [1, 2]
+    assert counts.tolist() == [[5, 3]]
+
+
+def test_moments():
+    n, mean, std = density.moments(np.array([0., 2.]), np.array([[1., 1.], [3., 1.]]), ddof=1)
+
+    assert n.tolist() == [2, 4]
+    assert np.allclose(mean, [1, 0.5])
+    assert np.allclose(std, [np.sqrt(2), 1])
+
+
+def test_kde_known_values():
+    # Two samples 2 apart: bandwidth sqrt(2) * 2 ** -0.2 ~ 1.2311
+    values, counts = density.support([[0, 2]])
+    y = density.kde(values, counts, np.array([0., 1., 2.]))
+
+    assert np.allclose(y[0], [0.2053237, 0.2329900, 0.2053237], atol=1e-6)
+
+
+def test_kde_matches_reference():
+    samples = [55, 60, 60, 61, 70, 70, 70, 82]
+    x = np.linspace(40, 100, 61)
+    values, counts = density.support([samples])
+
+    assert np.allclose(density.kde(values, counts, x)[0], gaussian_kde(samples, x))
+
+
+def test_kde_has_unit_area():
+    values, counts = density.support([[10, 12, 15, 15, 20]])
+    x = np.linspace(-40, 70, 4001)
+    y = density.kde(values, counts, x)[0]
+
+    # Trapezoidal rule
+    assert np.isclose(((y[1:] + y[:-1]) / 2 * np.diff(x)).sum(), 1, atol=1e-6)
+
+
+def test_kde_without_spread():
+    # A constant series is a point mass drawn as a min_bandwidth gaussian
+    values, counts = density.support([[100, 100, 100]])
+    y = density.kde(values, counts, np.array([100., 100.5]))
+
+    peak = 1 / (density.min_bandwidth * np.sqrt(2 * np.pi))
+    assert np.allclose(y[0], [peak, peak * np.exp(-0.5)])
+
+
+def test_kde_per_series_grids():
+    values, counts = density.support([[0, 2], [0, 2]])
+    y = density.kde(values, counts, np.array([[0., 1.], [1., 2.]]))
+
+    assert np.allclose(y, [[0.2053237, 0.2329900], [0.2329900, 0.2053237]], atol=1e-6)
+
+
+def test_normal_is_maximum_likelihood_fit():
+    values, counts = density.support([[0, 2]])
+    y = density.normal(values, counts, np.array([1.]))
+
+    # Mean 1, std 1 (ddof=0)
+    assert np.isclose(y[0][0], 1 / np.sqrt(2 * np.pi))
+
+
+def test_histograms_centered_bins():
+    x, y, n = density.histograms([[0.4, 0.6, 2, 2]])
+
+    assert x.tolist() == [0, 1, 2]
+    assert y.tolist() == [[1, 1, 2]]
+    assert n.tolist() == [4]
+
+
+def test_histograms_probability_and_groups():
+    x, y, n = density.histograms([[1, 1, 2], [5], [8, 9]], histnorm="probability", groups=[0, 0, 1])
+
+    assert [bins.tolist() for bins in x] == [[1, 2, 3, 4, 5], [1, 2, 3, 4, 5], [8, 9]]
+    assert np.allclose(y[0], [2 / 3, 1 / 3, 0, 0, 0])
+    assert np.allclose(y[1], [0, 0, 0, 0, 1])
+    assert np.allclose(y[2], [0.5, 0.5])
+
+
+def test_histograms_empty():
+    x, y, n = density.histograms([[], []])
+
+    assert len(x) == 0
+    assert y.shape == (2, 0)
+    assert n.tolist() == [0, 0]
+
+
+def test_curves_grid_spans_the_values():
+    x, y = density.curves([[10, 20, 30]])
+
+    assert len(x) == density.grid_points
+    assert (x[0], x[-1]) == (10, 30)
+    assert y.shape == (1, density.grid_points)
+
+
+def test_curves_probability_scales_by_bin_size():
+    x, density_y = density.curves([[10, 20, 30]])
+    x, probability_y = density.curves([[10, 20, 30]], histnorm="probability", bin_size=2)
+
+    assert np.allclose(probability_y, density_y * 2)
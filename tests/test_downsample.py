@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+
+import downsample
+
+
+def series(n, traces=3, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.arange(n) * 60, rng.integers(0, 101, (n, traces)).astype(float)
+
+
+@pytest.mark.parametrize("method", [downsample.lttb, downsample.minmax])
+@pytest.mark.parametrize("threshold", [-5, 0, 1, 2, 100, 150])
+def test_every_row_below_three_points_or_past_n(method, threshold):
+    # minmax can select with 2 points (one bucket), lttb can't
+    if method is downsample.minmax and threshold == 2:
+        return
+
+    x, ys = series(100)
+    rows = method(x, ys, threshold)
+
+    assert rows.shape == (100, 3)
+    assert (rows == np.arange(100)[:, np.newaxis]).all()
+
+
+def test_lttb_keeps_endpoints_and_one_point_per_bucket():
+    x, ys = series(1000)
+    rows = downsample.lttb(x, ys, 50)
+    edges = np.linspace(1, 999, 49).astype(np.int64)
+
+    assert rows.shape == (50, 3)
+    assert (rows[0] == 0).all() and (rows[-1] == 999).all()
+
+    for bucket in range(48):
+        assert ((edges[bucket] <= rows[bucket + 1]) & (rows[bucket + 1] < edges[bucket + 1])).all()
+
+
+def test_lttb_three_points():
+    x, ys = series(10)
+    rows = downsample.lttb(x, ys, 3)
+
+    assert rows[:, 0].tolist()[::2] == [0, 9]
+    assert 1 <= rows[1, 0] < 9
+
+
+def test_lttb_keeps_spikes():
+    x = np.arange(1000)
+    ys = np.zeros((1000, 2))
+    ys[500, 0] = 100
+    ys[250, 1] = -100
+
+    rows = downsample.lttb(x, ys, 20)
+
+    assert 500 in rows[:, 0]
+    assert 250 in rows[:, 1]
+
+
+def test_minmax_buckets():
+    x, ys = series(1000)
+    rows = downsample.minmax(x, ys, 50)
+
+    assert rows.shape == (50, 3)
+    assert (np.diff(rows, axis=0) >= 0).all()
+
+    # Each bucket of 40 rows keeps its lowest and highest point
+    for bucket in range(25):
+        start = bucket * 40
+        for trace in range(3):
+            kept = ys[rows[2 * bucket:2 * bucket + 2, trace], trace]
+            assert kept.min() == ys[start:start + 40, trace].min()
+            assert kept.max() == ys[start:start + 40, trace].max()
+
+
+def test_minmax_uneven_buckets_stay_in_range():
+    x, ys = series(101)
+    rows = downsample.minmax(x, ys, 20)
+
+    assert rows.shape == (20, 3)
+    assert rows.max() <= 100
+    assert ys[:, 0].argmax() in rows[:, 0]
+    assert ys[:, 0].argmin() in rows[:, 0]
+
+
+def test_minmax_ignores_nan():
+    x = np.arange(10)
+    ys = np.array([[np.nan], [3], [1], [np.nan], [2], [5], [np.nan], [0], [4], [np.nan]])
+
+    rows = downsample.minmax(x, ys, 4)
+
+    assert sorted(ys[rows[:2, 0], 0].tolist()) == [1, 3]
+    assert sorted(ys[rows[2:, 0], 0].tolist()) == [0, 5]
+
+
+def test_methods():
+    assert downsample.methods == {"lttb": downsample.lttb, "minmax": downsample.minmax}
@@ -0,0 +1,86 @@
+import sqlite3
+
+import numpy as np
+
+import metadata
+
+# 2020-01-01 00:00:00 GMT-04:00, the first scan of generate.py's dbs
+epoch = 1577851200
+
+
+def insert(query, *rows):
+    with sqlite3.connect("monitor.db") as conn:
+        conn.executemany(query, rows)
+
+
+def assert_same_store(store, fresh):
+    for antenna in fresh.antennas:
+        assert store.channels(antenna) == fresh.channels(antenna)
+        assert sorted(store.weather_statuses(antenna)) == sorted(fresh.weather_statuses(antenna))
+        assert all(np.array_equal(a, b) for a, b in zip(store.scan_times(antenna), fresh.scan_times(antenna)))
+
+        for style in metadata.label_styles:
+            assert store.labels(antenna, style) == fresh.labels(antenna, style)
+
+
+def test_refresh_adds_what_landed_since_the_last_one(generated):
+    store = metadata.store
+    store.refresh()
+    latest = store.scan_instance
+    channels = store.channels(1)
+    labels = store.labels(1, "distribution")
+
+    assert store.labels(1, "distribution") is labels
+    assert 60 not in channels
+
+    # A scan row whose signal rows haven't landed yet, with a new weather status
+    scan_time = epoch + 3 * 86400
+    insert("INSERT INTO scan VALUES (?, ?, ?)", (latest + 1, 1, scan_time))
+    insert("INSERT INTO weather VALUES (?, ?, 'Hail', 30, 90, 12, 40, ?)", (scan_time, scan_time, scan_time + 3600))
+    store.refresh()
+
+    assert store.scan_instance == latest + 1
+    assert store.scan_times(1)[0][-1] == scan_time and store.scan_times(1)[1][-1] == latest + 1
+    assert store.weather_statuses(1)[-1] == "Hail"
+    assert "Hail" not in store.weather_statuses(2)
+    assert store.channels(1) == channels
+
+    # Its signal rows land later, one on a new (mapped) channel and one not received (snq 0)
+    insert("INSERT INTO mapping VALUES (?, ?)", (60, "60.1 W60TV-1"), (60, "60.2 W60TV-2"))
+    insert("INSERT INTO signal VALUES (?, ?, ?, ?, ?)", (latest + 1, channels[0], 70, 80, 100), (latest + 1, 60, 60, 50, 100),
+           (latest + 1, 61, 0, 0, 0))
+    store.refresh()
+
+    assert store.channels(1) == sorted(channels + [60], reverse=True)
+    assert 61 not in store.channels(1) and 60 not in store.channels(2)
+    assert store.virtual_channels(60) == ["60.1 W60TV-1", "60.2 W60TV-2"]
+
+    # Labels are built again after a refresh, with the new channel & its mapping
+    refreshed = store.labels(1, "distribution")
+    assert refreshed is not labels
+    assert refreshed[60] == "60: 60.1 W60TV-1, 60.2 W60TV-2"
+    assert store.labels(1, "distribution") is refreshed
+
+    # A scan of another antenna that started earlier than the latest ones
+    insert("INSERT INTO scan VALUES (?, ?, ?)", (latest + 2, 2, epoch - 600))
+    insert("INSERT INTO signal VALUES (?, ?, ?, ?, ?)", (latest + 2, 62, 50, 40, 100))
+    store.refresh()
+
+    assert store.scan_times(2)[0][0] == epoch - 600 and store.scan_times(2)[1][0] == latest + 2
+    assert 62 in store.channels(2) and 62 not in store.channels(1)
+
+    fresh = metadata.MetadataStore()
+    fresh.refresh()
+    assert_same_store(store, fresh)
+
+
+def test_refresh_without_new_rows_keeps_the_labels(generated):
+    store = metadata.store
+    store.refresh()
+    labels = store.labels(1, "summary")
+
+    # Mappings alone don't change the data version
+    insert("INSERT INTO mapping VALUES (?, ?)", (60, "60.1 W60TV-1"))
+    store.refresh()
+
+    assert store.labels(1, "summary") is labels
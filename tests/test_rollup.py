@@ -0,0 +1,118 @@
+import json
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import channel_distribution
+import figures
+import rollup
+from db import load
+
+# 2020-01-01 00:00:00 GMT-04:00, the first scan of generate.py's dbs (3 days of hourly scans)
+epoch = 1577851200
+hour = 3600
+day = 86400
+
+ranges = [
+    (epoch, epoch + 2 * day - 1), # whole days
+    (epoch + 5 * hour + 1800, epoch + day + 13 * hour + 900), # mid hour to mid day
+    (epoch + 2 * day + 7 * hour, epoch + 2 * day + 20 * hour - 1), # whole hours of a day
+    (epoch + day + 3 * hour + 60, epoch + day + 3 * hour + 120), # within an hour
+    (epoch - day, epoch + 10 * day), # past both ends
+]
+
+
+def figure(graph, channel, antenna, daterange):
+    filter_conditions = {label: [] for label in graph.filter_col_labels}
+    filter_conditions["status"] = None
+    filter_conditions["weather.start_time"] = list(daterange)
+
+    return json.loads(figures.dumps(graph.get_figure(channel, antenna, filter_conditions=filter_conditions)))
+
+
+def assert_same_figure(a, b):
+    assert len(a["data"]) == len(b["data"])
+
+    for trace_a, trace_b in zip(a["data"], b["data"]):
+        assert np.allclose(trace_a["x"], trace_b["x"])
+        assert np.allclose(trace_a["y"], trace_b["y"])
+
+
+def raw_rows(antenna):
+    return load("""SELECT signal.channel, signal.snq, signal.ss, signal.seq, scan.start_time FROM signal
+                INNER JOIN scan ON signal.scan_instance = scan.scan_instance WHERE antenna_instance=?""", antenna)
+
+
+@pytest.mark.parametrize("table", ["hourly", "daily"])
+def test_trends_are_period_means_of_the_scans(generated, table):
+    rollup.refresh()
+    df = raw_rows(1)
+    channels = sorted(df["channel"].unique().tolist())
+    df["period"] = rollup.period_start(df["start_time"].values, table)
+    expected = df.groupby(["period", "channel"])["snq"].mean().unstack()
+
+    trends = rollup.trends(1, channels, ["snq"], table).set_index("period")
+
+    assert trends.index.tolist() == expected.index.tolist()
+    assert np.allclose(trends[[f"snq{channel}" for channel in channels]].values, expected[channels].values)
+
+
+def test_daily_periods_start_at_local_midnight():
+    assert rollup.period_start(np.array([epoch, epoch + day - 1, epoch + day]), "daily").tolist() == [epoch, epoch, epoch + day]
+
+
+@pytest.mark.parametrize("start, end", ranges)
+def test_spans_cover_the_range_once(start, end):
+    whole, raw = rollup.spans(start, end)
+    covered = [(first, stop - 1) for table, first, stop in whole] + raw
+
+    assert sorted(covered)[0][0] == start and sorted(covered)[-1][1] == end
+    assert sum(last - first + 1 for first, last in covered) == end - start + 1
+    assert all(first % (day if table == "daily" else hour) == (epoch % day if table == "daily" else 0) for table, first, stop in whole)
+
+
+@pytest.mark.parametrize("start, end", ranges)
+def test_date_range_figures_from_rollups_match_raw_rows(generated, monkeypatch, start, end):
+    rollup.refresh()
+    graph = channel_distribution.ChannelDistribution()
+    channel = graph.default_channel
+
+    from_rollups = figure(graph, channel, 1, (start, end))
+    assert graph.counts is not None
+
+    monkeypatch.setattr(rollup, "current", lambda: None)
+    from_rows = figure(graph, channel, 1, (start, end))
+    assert graph.counts is None
+
+    assert_same_figure(from_rollups, from_rows)
+
+
+def test_stale_rollups_fall_back_to_sql(generated):
+    rollup.refresh()
+    channel_distribution.cubes.refresh() # loaded up front, not by a loader thread racing the inserts
+    graph = channel_distribution.ChannelDistribution()
+    channel = graph.default_channel
+    start, end = epoch, epoch + 4 * day
+    before = figure(graph, channel, 1, (start, end))
+
+    with sqlite3.connect("monitor.db") as conn:
+        latest = conn.execute("SELECT MAX(scan_instance) FROM scan").fetchone()[0]
+        scan_time = epoch + 3 * day + 600
+        conn.execute("INSERT INTO scan VALUES (?, 1, ?)", (latest + 1, scan_time))
+        conn.execute("INSERT INTO signal VALUES (?, ?, 50, 100, 100)", (latest + 1, channel))
+        conn.execute("INSERT INTO weather VALUES (?, ?, 'Clear', 40, 10, 2, 50, ?)", (scan_time, scan_time, scan_time))
+
+    assert rollup.current() is None
+    stale = figure(graph, channel, 1, (start, end))
+    assert graph.counts is None
+
+    # One more sample of 100 in the snq histogram
+    snq = [trace for trace in stale["data"] if trace["type"] == "bar" and trace["name"] == "snq"][0]
+    old = [trace for trace in before["data"] if trace["type"] == "bar" and trace["name"] == "snq"][0]
+    assert sum(snq["y"]) == sum(old["y"]) + 1
+
+    assert rollup.refresh()
+    assert_same_figure(figure(graph, channel, 1, (start, end)), stale)
+    assert graph.counts is not None
@@ -0,0 +1,78 @@
+import sqlite3
+
+import pytest
+
+import db
+import snapshot
+
+schema = """
+CREATE TABLE scan (scan_instance INTEGER PRIMARY KEY, antenna_instance INTEGER, start_time INTEGER);
+CREATE TABLE signal (scan_instance INTEGER, channel INTEGER, ss INTEGER, snq INTEGER, seq INTEGER);
+CREATE TABLE weather (start_time INTEGER, reference_time INTEGER, status TEXT, temperature REAL,
+                      wind_direction INTEGER, wind_speed REAL, humidity INTEGER, sunset INTEGER);
+"""
+
+
+def add_scan(scan_instance, antenna, start_time, weather=True):
+    with sqlite3.connect("monitor.db") as conn:
+        conn.execute("INSERT INTO scan VALUES (?, ?, ?)", (scan_instance, antenna, start_time))
+        conn.executemany("INSERT INTO signal VALUES (?, ?, ?, ?, ?)",
+                         [(scan_instance, channel, 70, (scan_instance * 7 + channel) % 101, 100) for channel in [7, 20, 36]])
+
+        if weather:
+            conn.execute("INSERT INTO weather VALUES (?, ?, 'Clear', 60.5, 180, 4.5, 65, ?)", (start_time, start_time, start_time + 3600))
+
+
+@pytest.fixture
+def monitor(tmp_path, monkeypatch):
+    # monitor.db (the default path of the db & snapshot functions) in a fresh directory
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(snapshot, "_datasets", {})
+
+    with sqlite3.connect("monitor.db") as conn:
+        conn.executescript(schema)
+
+    for scan_instance in range(1, 7):
+        add_scan(scan_instance, scan_instance % 2 + 1, 1593561600 + scan_instance * 600, weather=scan_instance != 3)
+
+    yield tmp_path
+    db.close_connections()
+
+
+def sorted_rows(df):
+    return sorted(df[["scan_instance", "channel", "snq", "status"]].fillna("").values.tolist())
+
+
+def test_without_pyarrow_the_graphs_use_sql(monitor, monkeypatch):
+    monkeypatch.setattr(snapshot, "pa", None)
+
+    assert snapshot.refresh() is False
+    assert snapshot.query(1, ["scan_instance", "snq"]) is None
+    assert not (monitor / "snapshot").exists()
+    assert len(snapshot.rows(4)) == 6
+
+
+def test_query_matches_the_db(monitor):
+    pytest.importorskip("pyarrow")
+
+    assert snapshot.refresh() is True
+    assert snapshot.refresh() is False
+
+    df = snapshot.query(2, ["scan_instance", "channel", "snq", "status"], [("snq", ">=", 30), ("channel", "in", [7, 36])])
+    expected = snapshot.rows()
+    expected = expected[(expected["antenna_instance"] == 2) & (expected["snq"] >= 30) & expected["channel"].isin([7, 36])]
+
+    assert len(df)
+    assert sorted_rows(df) == sorted_rows(expected)
+
+
+def test_stale_snapshot_answers_none_until_refreshed(monitor):
+    pytest.importorskip("pyarrow")
+
+    snapshot.refresh()
+    add_scan(7, 2, 1593561600 + 7 * 600)
+
+    assert snapshot.query(2, ["scan_instance"]) is None
+
+    snapshot.refresh()
+    assert snapshot.query(2, ["scan_instance"])["scan_instance"].max() == 7
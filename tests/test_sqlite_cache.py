@@ -0,0 +1,62 @@
+import pytest
+
+import sqlite_cache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # sqlite_cache's time(), advanced by hand
+    now = [1000.0]
+    monkeypatch.setattr(sqlite_cache, "time", lambda: now[0])
+    return now
+
+
+def accessed(cache, key):
+    return cache._connection().execute("SELECT accessed FROM cache WHERE key=?", (key,)).fetchone()[0]
+
+
+def test_hits_touch_entries_only_after_touch_interval(tmp_path, clock):
+    cache = sqlite_cache.SQLiteCache(str(tmp_path / "cache.db"), touch_interval=60)
+    cache.set("figure", b"body")
+
+    clock[0] += 30
+    assert cache.get("figure") == b"body"
+    assert accessed(cache, "figure") == 1000
+
+    clock[0] += 31
+    assert cache.get("figure") == b"body"
+    assert accessed(cache, "figure") == 1061
+
+
+def test_evicts_least_recently_used_past_threshold(tmp_path, clock):
+    cache = sqlite_cache.SQLiteCache(str(tmp_path / "cache.db"), threshold=3, touch_interval=0)
+
+    for key in ["a", "b", "c"]:
+        cache.set(key, key)
+        clock[0] += 1
+
+    cache.get("a")
+    clock[0] += 1
+    cache.set("d", "d")
+
+    assert [cache.has(key) for key in ["a", "b", "c", "d"]] == [True, False, True, True]
+
+
+def test_evicts_past_max_size(tmp_path, clock):
+    cache = sqlite_cache.SQLiteCache(str(tmp_path / "cache.db"), max_size=2500)
+
+    for key in ["a", "b", "c"]:
+        cache.set(key, bytes(1000))
+        clock[0] += 1
+
+    assert [cache.has(key) for key in ["a", "b", "c"]] == [False, True, True]
+
+
+def test_expired_entries_miss_and_are_pruned(tmp_path, clock):
+    cache = sqlite_cache.SQLiteCache(str(tmp_path / "cache.db"))
+    cache.set("old", 1, timeout=10)
+    clock[0] += 11
+
+    assert cache.get("old") is None
+    assert cache.add("old", 2)
+    assert cache.get("old") == 2